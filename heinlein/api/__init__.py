@@ -1,3 +1,3 @@
-from ._cmds import add, get, prep_catalog, remove
+from ._cmds import add, build_sidecars, get, prep_catalog, prep_masks, remove
 
-__all__ = ["add", "remove", "get", "prep_catalog"]
+__all__ = ["add", "remove", "get", "prep_catalog", "prep_masks", "build_sidecars"]
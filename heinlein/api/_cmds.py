@@ -1,5 +1,6 @@
 from pathlib import Path
 
+from heinlein.dtypes.handlers import sidecar
 from heinlein.manager.manager import get_manager, initialize_dataset
 from heinlein.utilities import prep, warning_prompt_tf
 
@@ -66,10 +67,13 @@ def get(name: str, dtype: str) -> Path:
     return path
 
 
-def prep_catalog(name: str, path: Path):
+def prep_catalog(name: str, path: Path, nside: int = None, workers: int = None):
     """
     Prepare a catalog for a dataset. The path should be a directory containing
-    the data as CSV files. The database will be created in the same directory.
+    the data as CSV files. The database will be created in the same directory,
+    with a HEALPix pixel column at the given nside (CATALOG_HPIX_NSIDE
+    by default). The files are parsed by the given number of processes
+    (one per CPU by default).
     """
     if path.suffix == ".sqlite3":
         prep.register_database(name, path)
@@ -77,4 +81,30 @@ def prep_catalog(name: str, path: Path):
     csvs = list(path.glob("*.csv"))
     if not csvs:
         raise FileNotFoundError(f"No CSV files found in {path}")
-    prep.database_from_csvs(name, csvs)
+    prep.database_from_csvs(name, csvs, nside, workers)
+
+
+def prep_masks(name: str, path: Path, workers: int = None) -> list[Path]:
+    """
+    Prepare the masks for a dataset. The path should be a directory containing
+    the mask planes as FITS files. Each one is converted into a bit-packed
+    store in the same directory, which the FITS mask handler uses instead of
+    the original file. The files are converted by the given number of
+    processes (one per CPU by default).
+    """
+    if not path.is_dir():
+        raise NotADirectoryError(f"{path} is not a directory")
+    manager = get_manager(name)
+    mask_key = manager.config["dconfig"].get("mask", {}).get("mask_key", 0)
+    return prep.mask_stores_from_fits(path, mask_key, workers)
+
+
+def build_sidecars(path: Path, workers: int = None, force: bool = False) -> dict:
+    """
+    Build binary sidecars for all the CSV catalog files in a directory, so
+    they never have to be parsed when they are loaded. Files are parsed in
+    parallel by the given number of processes (one per CPU by default).
+    """
+    if not path.is_dir():
+        raise NotADirectoryError(f"{path} is not a directory")
+    return sidecar.build_sidecars(path, workers, force)
@@ -53,14 +53,62 @@ def get(dataset_name, data_type) -> str:
     type=click.Choice(["catalog", "mask", "image"]),
     default="catalog",
 )
-def prep(dataset_name: str, path: Path, data_type: str = "catalog"):
+@click.option(
+    "--nside",
+    required=False,
+    type=int,
+    default=None,
+    help="HEALPix nside of the pixel column added to catalogs",
+)
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=int,
+    default=None,
+    help="Number of processes parsing the data (one per CPU by default)",
+)
+def prep(
+    dataset_name: str,
+    path: Path,
+    data_type: str = "catalog",
+    nside: int = None,
+    workers: int = None,
+):
     """
     Prepare a catalog for a dataset. The path should be a directory containing
     the data as CSV files. The database will be created in the same directory.
+
+    With "-d mask", prepare a directory of FITS mask planes instead. Each plane
+    is converted into a bit-packed store next to the file it came from.
     """
     match data_type:
         case "catalog":
-            api.prep_catalog(dataset_name, path)
+            api.prep_catalog(dataset_name, path, nside, workers)
+        case "mask":
+            api.prep_masks(dataset_name, path, workers)
         case _:
             raise NotImplementedError()
     return True
+
+
+@click.command(name="sidecar")
+@click.argument("path", type=click.Path(exists=True, file_okay=False, path_type=Path))
+@click.option(
+    "-j",
+    "--workers",
+    required=False,
+    type=int,
+    default=None,
+    help="Number of files to parse at once (one per CPU by default)",
+)
+@click.option("force", "-f", "--force", is_flag=True, help="Rebuild existing sidecars")
+def sidecar(path: Path, workers: int = None, force: bool = False):
+    """
+    Build binary sidecars for a directory of CSV catalog files, so they are
+    memory mapped rather than parsed when they are loaded.
+    """
+    results = api.build_sidecars(path, workers, force)
+    built = sum(results.values())
+    click.echo(f"Built {built} sidecars, {len(results) - built} files skipped")
+    return True
@@ -1,4 +1,7 @@
-from pydantic import ByteSize, Field
+from pathlib import Path
+from typing import Literal, Optional
+
+from pydantic import ByteSize, Field, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -6,3 +9,59 @@ class HeinleinConfig(BaseSettings):
     model_config = SettingsConfigDict(env_prefix="HEINLEIN_", validate_assignment=True)
     CACHE_ENABLED: bool = Field(False)
     CACHE_SIZE: ByteSize = Field(4e9, ge=1e9)
+    # "local" keeps a cache per process, "shared" publishes cached data into
+    # shared memory so other processes working on the same dataset can use it.
+    CACHE_BACKEND: Literal["local", "shared"] = Field("local")
+    # Eviction policy: least recently used, least frequently used or
+    # GreedyDual-Size, which weighs the cost of loading a region against its size.
+    CACHE_POLICY: Literal["lru", "lfu", "gds"] = Field("lru")
+    # Size of the on-disk tier behind the in-memory cache. 0 disables it.
+    CACHE_SPILL_SIZE: ByteSize = Field(0, ge=0)
+    CACHE_SPILL_DIR: Optional[Path] = Field(None)
+    # Number of threads used to load regions in parallel. 1 loads serially.
+    LOADER_THREADS: int = Field(8, ge=1)
+    # HEALPix nside of the spatial index built on cached catalogs. Must be a
+    # power of 2. 0 disables the index.
+    CATALOG_INDEX_NSIDE: int = Field(8192, ge=0)
+    # HEALPix nside of the pixel column "heinlein prep" adds to catalog
+    # databases. Must be a power of 2.
+    CATALOG_HPIX_NSIDE: int = Field(4096, ge=1)
+    # "region" loads and caches catalogs one survey region at a time.
+    # "subregion" loads and caches them in HEALPix pixels at
+    # CATALOG_SUBREGION_NSIDE, so small queries only read the rows near them.
+    # Only catalogs with a pixel column (see CATALOG_HPIX_NSIDE) can do this.
+    CATALOG_CACHE_MODE: Literal["region", "subregion"] = Field("region")
+    CATALOG_SUBREGION_NSIDE: int = Field(256, ge=1)
+    # Keep a binary copy of each CSV catalog file after it is first parsed,
+    # which later reads memory map instead of parsing the file again. Copies
+    # are kept next to the files unless CATALOG_SIDECAR_DIR is set.
+    CATALOG_SIDECARS: bool = Field(True)
+    CATALOG_SIDECAR_DIR: Optional[Path] = Field(None)
+    # Settings for the read-only connections catalog databases are read through.
+    # Databases are memory mapped up to SQLITE_MMAP_SIZE, and each connection
+    # keeps up to SQLITE_CACHE_SIZE of database pages in memory.
+    SQLITE_MMAP_SIZE: ByteSize = Field(2**30, ge=0)
+    SQLITE_CACHE_SIZE: ByteSize = Field(64e6, ge=0)
+    SQLITE_TEMP_STORE: Literal["default", "file", "memory"] = Field("memory")
+    # Open catalog databases as immutable, which skips all file locking. Turn
+    # this off if databases can change while they are being read.
+    SQLITE_IMMUTABLE: bool = Field(True)
+    # Read FITS mask planes from disk a window at a time, rather than loading
+    # whole planes into memory.
+    MASK_LAZY_FITS: bool = Field(True)
+    # HEALPix order of the cells used to work out the unmasked fraction of regions,
+    # for masks that can't work it out exactly.
+    MASK_FRACTION_ORDER: int = Field(17, ge=0, le=29)
+    # Maximum number of queries a dataset runs at once through the async API.
+    ASYNC_MAX_QUERIES: int = Field(16, ge=1)
+
+    @field_validator(
+        "CATALOG_INDEX_NSIDE", "CATALOG_HPIX_NSIDE", "CATALOG_SUBREGION_NSIDE"
+    )
+    @classmethod
+    def _check_nside(cls, value: int) -> int:
+        # HEALPix NEST indices only work for powers of 2. 0 gets through here,
+        # the fields that can't be 0 are already limited by their Field.
+        if value & (value - 1):
+            raise ValueError(f"HEALPix nside must be 0 or a power of 2, got {value}")
+        return value
@@ -1,18 +1,27 @@
 from __future__ import annotations
 
+import asyncio
 import logging
+import weakref
+from collections import OrderedDict
 from functools import partial
 from typing import Any, Optional, Union
 
 import astropy.units as u
+import numpy as np
 from astropy.coordinates import SkyCoord
+from astropy.table import Table, vstack
 
+import heinlein
 from heinlein.dataset.extension import get_extension, load_extensions
+from heinlein.dtypes.catalog import get_column_selection, pixel_region_name
+from heinlein.dtypes.dobj import HeinleinDataObject
+from heinlein.dtypes.filters import apply_filters, normalize_filters
 from heinlein.manager import get_manager
-from heinlein.manager.cache import clear_cache
+from heinlein.manager.cache import clear_cache, get_cache
 from heinlein.manager.manager import DataManager, MissingDataError
 from heinlein.region import BaseRegion, Region
-from heinlein.region.footprint import Footprint
+from heinlein.region.footprint import Footprint, get_healpix_pixels
 
 logger = logging.getLogger("Dataset")
 
@@ -65,12 +74,17 @@ class Dataset:
 
     The dataset class should not be created directly. Instead use "load_dataset."
 
+    The query methods have async versions (acone_search, abox_search and
+    aget_data_from_region) which can be awaited from an event loop without
+    blocking it. These share the cache with the regular methods.
     """
 
     def __init__(self, manager: DataManager, *args, **kwargs):
         self.manager = manager
         self._extensions = {}
         self._parameters = {}
+        self._query_limits = weakref.WeakKeyDictionary()
+        self._region_pixels = {}
 
     @property
     def name(self):
@@ -103,7 +117,8 @@ class Dataset:
         {"datta_type": data}
 
         The center can be passed in as a sky coordinate or a tuple of (ra, dec). If
-        a tuple, it is assumed to be in degrees.
+        a tuple, it is assumed to be in degrees. Pass columns to only get (and
+        load) some of the catalog columns, see get_data_from_region.
         """
         reg = Region.circle(center=center, radius=radius)
         return self.get_data_from_region(reg, *args, **kwargs)
@@ -118,17 +133,11 @@ class Dataset:
     ) -> dict[str, Any]:
         """
         Perform a box search on the dataset. Will return a dictionary of format:
-        {"datta_type": data}
+        {"datta_type": data}. Pass columns to only get (and load) some of the
+        catalog columns, and filters to only get some of the rows, see
+        get_data_from_region.
         """
-        if isinstance(center, tuple):
-            center = SkyCoord(*center, unit="deg")
-        if height is None:
-            height = width
-        minx = center.ra - width / 2
-        maxx = center.ra + width / 2
-        miny = center.dec - height / 2
-        maxy = center.dec + height / 2
-        reg = Region.box([minx, miny, maxx, maxy])
+        reg = _box_region(center, width, height)
         return self.get_data_from_region(reg, *args, **kwargs)
 
     def get_data_from_region(
@@ -136,6 +145,8 @@ class Dataset:
         query_region: BaseRegion,
         dtypes: Union[str, list] = "catalog",
         *args,
+        columns: Optional[list] = None,
+        filters: Optional[list] = None,
         **kwargs,
     ) -> dict[str, Any]:
         """
@@ -147,8 +158,378 @@ class Dataset:
 
         region <BaseRegion> heinlein Region object
         dtypes <str> or <list>: list of data types to return
+        columns <list>: catalog columns to return. Only these columns are loaded
+            and cached, if the dataset supports it. The ra and dec columns are
+            always returned.
+        filters <list>: (column, op, value) triples, for example
+            [("mag_i", "<", 24)]. Only catalog rows that pass all of them are
+            returned. If the dataset supports it, the other rows are never
+            loaded. See heinlein.dtypes.filters for the available operators.
+
+        """
+        overlaps = self._get_overlaps(query_region)
+        if isinstance(dtypes, str):
+            dtypes = [dtypes]
+        filters = normalize_filters(filters)
+
+        if self.manager.get_external("get_data") is not None:
+            data = self.manager.get_data(
+                dtypes, query_region, overlaps, *args, **kwargs
+            )
+            data = _filter_rows(_filter_to_region(data, query_region), filters)
+            return _select_columns(data, columns)
+
+        # The objects for each survey region are filtered separately, rather than
+        # combined first, so the spatial indexes of the cached objects get reused.
+        load_columns, post_filters = self._plan_filters(columns, filters)
+        storage = {}
+        for dtypes_, regions in self._plan_requests(dtypes, overlaps, query_region):
+            storage |= self.manager.get_from(
+                dtypes_, regions, *args, columns=load_columns, filters=filters, **kwargs
+            )
+        return _filter_storage(storage, query_region, columns, post_filters)
+
+    def get_data_from_regions(
+        self,
+        query_regions: list[BaseRegion],
+        dtypes: Union[str, list] = "catalog",
+        *args,
+        as_generator: bool = False,
+        columns: Optional[list] = None,
+        filters: Optional[list] = None,
+        **kwargs,
+    ):
+        """
+        Get data for many regions at once. This is much faster than calling
+        get_data_from_region in a loop. The overlaps of all the regions with the
+        survey footprint are computed in one pass, each survey region is loaded
+        once, and every query is filtered against the survey regions it overlaps
+        with directly, without building a combined object first.
+
+        Returns a list with one result per query region, in the same order as the
+        input. Each result is a dictionary of format {"data_type": data}, or None
+        if the region does not fall in the footprint or its data is missing. If
+        as_generator is True, a generator is returned instead, which loads data
+        as it goes. Columns and filters work the same way as in
+        get_data_from_region.
+
+        Queries that overlap the same survey regions are processed together,
+        so when returning a list each survey region is only loaded once as long
+        as all the regions needed by a single query fit in the cache. The
+        generator has to follow the input order, so it may reload regions that
+        are evicted in between queries that need them.
+        """
+        if isinstance(dtypes, str):
+            dtypes = [dtypes]
+        query_regions = list(query_regions)
+        overlaps = self._get_many_overlaps(query_regions)
+        keys = [
+            tuple(sorted(r if isinstance(r, str) else r.name for r in o)) or None
+            for o in overlaps
+        ]
+        kwargs["columns"] = columns
+        kwargs["filters"] = normalize_filters(filters)
+        if as_generator:
+            order = range(len(query_regions))
+            return self._query_many(query_regions, keys, order, dtypes, *args, **kwargs)
+
+        # Process queries that need the same survey regions together
+        order = sorted(range(len(query_regions)), key=lambda i: keys[i] or ())
+        results = [None] * len(query_regions)
+        batch = self._query_many(query_regions, keys, order, dtypes, *args, **kwargs)
+        for index, result in zip(order, batch):
+            results[index] = result
+        return results
+
+    def cone_search_many(
+        self,
+        centers: tuple | SkyCoord,
+        radius: u.Quantity,
+        *args,
+        columns: Optional[list] = None,
+        filters: Optional[list] = None,
+        **kwargs,
+    ) -> tuple[Table, np.ndarray, np.ndarray]:
+        """
+        Perform many cone searches on the catalog at once. This is much faster
+        than calling cone_search in a loop, and scales to millions of cones.
+
+        The centers can be passed in as a sky coordinate, or a tuple of (ra, dec)
+        arrays in degrees. The radius can be a single value or one per cone.
 
+        Returns a catalog with every object that falls in at least one cone, and
+        the members of each cone in CSR form: an array of offsets of length
+        n_cones + 1 and a flat array of row indices into the catalog. The
+        members of cone i are catalog[indices[offsets[i]:offsets[i + 1]]].
+        Columns and filters work the same way as in get_data_from_region.
         """
+        if self.manager.get_external("get_data") is not None:
+            raise NotImplementedError(
+                f"Dataset {self.name} does not support batched cone searches"
+            )
+        if isinstance(centers, SkyCoord):
+            ra, dec = centers.ra.to_value(u.deg), centers.dec.to_value(u.deg)
+        else:
+            ra, dec = (np.asarray(c, dtype=np.float64) for c in centers)
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        radius = np.broadcast_to(radius.to_value(u.deg), ra.shape)
+
+        cones_near = self.footprint.get_cones_near_regions(ra, dec, radius)
+        if not cones_near:
+            raise ValueError("None of the cones fall within the survey footprint")
+        filters = normalize_filters(filters)
+        load_columns, post_filters = self._plan_filters(columns, filters)
+        storage = self.manager.get_from(
+            ["catalog"],
+            list(cones_near),
+            *args,
+            columns=load_columns,
+            filters=filters,
+            **kwargs,
+        )
+        # Survey regions can share a single object, which is queried with all the
+        # cones near any of them
+        objects = {}
+        for region_name, obj in storage["catalog"].items():
+            if len(obj) > 0:
+                objects.setdefault(id(obj), (obj, []))[1].append(
+                    cones_near[region_name]
+                )
+
+        offsets = np.zeros(len(ra) + 1, dtype=np.int64)
+        if not objects:
+            return Table(), offsets, np.empty(0, dtype=np.int64)
+
+        pieces = []
+        all_cones = []
+        all_rows = []
+        n_rows = 0
+        for obj, cone_indices in objects.values():
+            cone_indices = np.unique(np.concatenate(cone_indices))
+            obj_offsets, obj_rows = obj.query_cones(
+                ra[cone_indices], dec[cone_indices], radius[cone_indices]
+            )
+            obj_cones = np.repeat(cone_indices, np.diff(obj_offsets))
+            if post_filters:
+                passed = obj.passes_filters(post_filters)[obj_rows]
+                obj_rows, obj_cones = obj_rows[passed], obj_cones[passed]
+            rows, inverse = np.unique(obj_rows, return_inverse=True)
+            pieces.append(obj.select_columns(columns)[rows])
+            all_cones.append(obj_cones)
+            all_rows.append(inverse + n_rows)
+            n_rows += len(rows)
+
+        cones = np.concatenate(all_cones)
+        order = np.argsort(cones, kind="stable")
+        offsets[1:] = np.cumsum(np.bincount(cones, minlength=len(ra)))
+        catalog = pieces[0] if len(pieces) == 1 else vstack(pieces)
+        return catalog, offsets, np.concatenate(all_rows)[order]
+
+    def _get_many_overlaps(self, query_regions: list[BaseRegion]) -> list[list]:
+        get_overlaps = self.manager.get_external("get_overlapping_regions")
+        if get_overlaps is not None:
+            return [get_overlaps(self, r) for r in query_regions]
+        return self.footprint.get_overlapping_regions(query_regions)
+
+    def _query_many(
+        self,
+        query_regions: list[BaseRegion],
+        keys: list[tuple],
+        order: list[int],
+        dtypes: list,
+        *args,
+        columns: Optional[list] = None,
+        filters: tuple = (),
+        **kwargs,
+    ):
+        if (
+            self.manager.get_external("get_data") is not None
+            or self._subregion_nside(dtypes) is not None
+        ):
+            # The dataset loads data its own way, or only loads the data near
+            # each query, so we can't do better than querying one region at
+            # a time.
+            for index in order:
+                if keys[index] is None:
+                    yield None
+                    continue
+                try:
+                    yield self.get_data_from_region(
+                        query_regions[index],
+                        dtypes,
+                        *args,
+                        columns=columns,
+                        filters=filters,
+                        **kwargs,
+                    )
+                except MissingDataError:
+                    yield None
+            return
+
+        # Data for the last few sets of survey regions used. These are references
+        # to the objects in the cache, so holding on to them is cheap.
+        load_columns, post_filters = self._plan_filters(columns, filters)
+        recent = OrderedDict()
+        for index in order:
+            key = keys[index]
+            if key is None:
+                yield None
+                continue
+            if key not in recent:
+                try:
+                    recent[key] = self.manager.get_from(
+                        dtypes,
+                        list(key),
+                        *args,
+                        columns=load_columns,
+                        filters=filters,
+                        **kwargs,
+                    )
+                except MissingDataError:
+                    recent[key] = None
+                if len(recent) > 16:
+                    recent.popitem(last=False)
+            storage = recent[key]
+            if storage is None:
+                yield None
+                continue
+            yield _filter_storage(storage, query_regions[index], columns, post_filters)
+
+    def _plan_filters(self, columns: list, filters: tuple) -> tuple[list, tuple]:
+        """
+        Work out which columns to load, and which filters still have to be
+        applied once the data is loaded. If the catalog handler can't filter
+        rows itself, the catalog is loaded in full (with the columns the
+        filters need) and filtered as each query is served.
+        """
+        if not filters or self.manager.supports_filters("catalog"):
+            return columns, ()
+        if columns is not None:
+            columns = list(dict.fromkeys([*columns, *(f[0] for f in filters)]))
+        return columns, filters
+
+    def _plan_requests(
+        self, dtypes: list, overlaps: list, query_region: BaseRegion
+    ) -> list[tuple[list, list]]:
+        """
+        Work out which regions each data type has to be loaded for. In the
+        "subregion" cache mode, catalogs are loaded in the HEALPix pixels
+        around the query rather than in whole survey regions, if the catalog
+        handler supports it. Returns a list of (data types, regions) pairs.
+        """
+        nside = self._subregion_nside(dtypes)
+        if nside is None:
+            return [(dtypes, overlaps)]
+        pixels = get_healpix_pixels(query_region, nside)
+        names = []
+        for region in overlaps:
+            if isinstance(region, str):
+                region_pixels = pixels
+            else:
+                # Pixels near the query but outside the survey region are empty
+                region_pixels = np.intersect1d(
+                    pixels, self._get_region_pixels(region, nside)
+                )
+                region = region.name
+            names.extend(pixel_region_name(region, nside, p) for p in region_pixels)
+
+        if not names:
+            return [(dtypes, overlaps)]
+        requests = [(["catalog"], names)]
+        others = [dtype for dtype in dtypes if dtype != "catalog"]
+        if others:
+            requests.append((others, overlaps))
+        return requests
+
+    def _subregion_nside(self, dtypes: list) -> Optional[int]:
+        if "catalog" not in dtypes:
+            return None
+        if heinlein.get_option("CATALOG_CACHE_MODE") != "subregion":
+            return None
+        pixel_nside = self.manager.pixel_nside("catalog")
+        if pixel_nside is None:
+            return None
+        return min(heinlein.get_option("CATALOG_SUBREGION_NSIDE"), pixel_nside)
+
+    def _get_region_pixels(self, region: BaseRegion, nside: int) -> np.ndarray:
+        key = (region.name, nside)
+        if key not in self._region_pixels:
+            self._region_pixels[key] = get_healpix_pixels(region, nside)
+        return self._region_pixels[key]
+
+    async def acone_search(
+        self, center: tuple | SkyCoord, radius: u.Quantity, *args, **kwargs
+    ) -> dict[str, Any]:
+        """
+        Async version of cone_search.
+        """
+        reg = Region.circle(center=center, radius=radius)
+        return await self.aget_data_from_region(reg, *args, **kwargs)
+
+    async def abox_search(
+        self,
+        center: tuple | SkyCoord,
+        width: u.Quantity,
+        height: Optional[u.Quantity] = None,
+        *args,
+        **kwargs,
+    ) -> dict[str, Any]:
+        """
+        Async version of box_search.
+        """
+        reg = _box_region(center, width, height)
+        return await self.aget_data_from_region(reg, *args, **kwargs)
+
+    async def aget_data_from_region(
+        self,
+        query_region: BaseRegion,
+        dtypes: Union[str, list] = "catalog",
+        *args,
+        columns: Optional[list] = None,
+        filters: Optional[list] = None,
+        **kwargs,
+    ) -> dict[str, Any]:
+        """
+        Async version of get_data_from_region. Finding the overlapping regions,
+        loading the data and filtering it all happen in worker threads. At most
+        ASYNC_MAX_QUERIES queries run at once, the rest wait their turn. If the
+        query is cancelled, region loads that haven't started yet are dropped.
+        """
+        loop = asyncio.get_running_loop()
+        async with self._query_limit(loop):
+            overlaps = await loop.run_in_executor(
+                None, self._get_overlaps, query_region
+            )
+            if isinstance(dtypes, str):
+                dtypes = [dtypes]
+            filters = normalize_filters(filters)
+
+            if self.manager.get_external("get_data") is not None:
+                data = await self.manager.aget_data(
+                    dtypes, query_region, overlaps, *args, **kwargs
+                )
+                data = await loop.run_in_executor(
+                    None, _filter_to_region, data, query_region
+                )
+                return _select_columns(_filter_rows(data, filters), columns)
+
+            load_columns, post_filters = self._plan_filters(columns, filters)
+            storage = {}
+            requests = self._plan_requests(dtypes, overlaps, query_region)
+            for dtypes_, regions in requests:
+                storage |= await self.manager.aget_from(
+                    dtypes_,
+                    regions,
+                    *args,
+                    columns=load_columns,
+                    filters=filters,
+                    **kwargs,
+                )
+            return await loop.run_in_executor(
+                None, _filter_storage, storage, query_region, columns, post_filters
+            )
+
+    def _get_overlaps(self, query_region: BaseRegion) -> list:
         get_overlaps = self.manager.get_external("get_overlapping_regions")
         if get_overlaps is not None:
             overlaps = get_overlaps(self, query_region)
@@ -156,21 +537,15 @@ class Dataset:
             overlaps = self.footprint.get_overlapping_regions(query_region)
         if len(overlaps) == 0:
             raise ValueError("Region does not fall within the survey footprint")
-            return
-
-        data = {}
-        if isinstance(dtypes, str):
-            dtypes = [dtypes]
-
-        data = self.manager.get_data(dtypes, query_region, overlaps, *args, **kwargs)
-        return_data = {}
-        for dtype, obj_ in data.items():
-            try:
-                return_data.update({dtype: obj_.get_data_from_region(query_region)})
-            except AttributeError:
-                return_data.update({dtype: obj_})
+        return overlaps
 
-        return return_data
+    def _query_limit(self, loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+        # asyncio primitives belong to a single event loop, so we keep one per loop
+        limit = self._query_limits.get(loop)
+        if limit is None:
+            limit = asyncio.Semaphore(heinlein.get_option("ASYNC_MAX_QUERIES"))
+            self._query_limits[loop] = limit
+        return limit
 
     def get_data_from_samples(
         self,
@@ -187,7 +562,8 @@ class Dataset:
         of the survey's subregions. This methord returns a generator that
         yields samples from the survey. It orders them such that it can
         only load a few subregions at a time, then dumps them from the cache when
-        they are done.
+        they are done. If the on-disk cache tier is enabled, dumped regions are
+        moved there so that regions needed again later are cheap to reload.
         """
         if sample_type != "cone":
             raise NotImplementedError("Only cone sampling is currently supported")
@@ -220,7 +596,7 @@ class Dataset:
                         continue
             # Now, we dump the data from those regions
             done.add(reg_key)
-            clear_cache(self.name)
+            clear_cache(self.name, spill=True)
         # Now we go through all the samples that fall in a single survey region
         # that were NOT covered before
         remaining = set(partitions.keys()) - done
@@ -231,7 +607,7 @@ class Dataset:
                     yield (s_, self.get_data_from_region(s_, dtypes))
                 except MissingDataError:
                     continue
-            clear_cache(self.name)
+            clear_cache(self.name, spill=True)
 
     def clear_cache(self):
         """
@@ -240,3 +616,95 @@ class Dataset:
         """
         clear_cache(self.name)
         return
+
+    def cache_stats(self, reset: bool = False) -> dict:
+        """
+        Get a snapshot of the cache statistics for this dataset. This includes
+        hits and misses (in total, per data type and per region), bytes loaded
+        and evicted, number of evictions and the time spent loading data versus
+        serving it from the cache. If reset is True, the counters are reset
+        after the snapshot is taken.
+        """
+        stats = get_cache(self.name).stats
+        snapshot = stats.snapshot()
+        if reset:
+            stats.reset()
+        return snapshot
+
+
+def _box_region(
+    center: tuple | SkyCoord, width: u.Quantity, height: Optional[u.Quantity] = None
+) -> BaseRegion:
+    if isinstance(center, tuple):
+        center = SkyCoord(*center, unit="deg")
+    if height is None:
+        height = width
+    minx = center.ra - width / 2
+    maxx = center.ra + width / 2
+    miny = center.dec - height / 2
+    maxy = center.dec + height / 2
+    return Region.box([minx, miny, maxx, maxy])
+
+
+def _filter_to_region(data: dict[str, Any], query_region: BaseRegion):
+    return_data = {}
+    for dtype, obj_ in data.items():
+        try:
+            return_data.update({dtype: obj_.get_data_from_region(query_region)})
+        except AttributeError:
+            return_data.update({dtype: obj_})
+
+    return return_data
+
+
+def _filter_storage(
+    storage: dict[str, dict],
+    query_region: BaseRegion,
+    columns: list = None,
+    filters: tuple = (),
+):
+    output = {}
+    for dtype, objs in storage.items():
+        # Only catalogs can be narrowed down to a set of columns or rows
+        kwargs = {}
+        if dtype == "catalog" and columns:
+            kwargs["columns"] = columns
+        if dtype == "catalog" and filters:
+            kwargs["filters"] = filters
+        output[dtype] = _filter_objects(list(objs.values()), query_region, **kwargs)
+    return output
+
+
+def _filter_rows(data: dict[str, Any], filters: tuple = ()):
+    """
+    Filter the rows of a catalog that was loaded in full.
+    """
+    if filters and isinstance(data.get("catalog"), Table):
+        data["catalog"] = apply_filters(data["catalog"], filters)
+    return data
+
+
+def _select_columns(data: dict[str, Any], columns: list = None):
+    """
+    Narrow down a catalog that was loaded in full to a set of columns.
+    """
+    if columns is not None and isinstance(data.get("catalog"), Table):
+        data["catalog"] = data["catalog"][get_column_selection(columns)]
+    return data
+
+
+def _filter_objects(objs: list[HeinleinDataObject], query_region: BaseRegion, **kwargs):
+    """
+    Filter each of the objects for a set of survey regions to the query region,
+    and combine the results. Objects that can't be filtered are combined and
+    returned as is.
+    """
+    try:
+        pieces = [obj.get_data_from_region(query_region, **kwargs) for obj in objs]
+    except AttributeError:
+        return objs[0].combine(objs) if len(objs) > 1 else objs[0]
+    if len(pieces) == 1:
+        return pieces[0]
+    if isinstance(pieces[0], Table):
+        return vstack(pieces)
+    return type(pieces[0]).combine(pieces)
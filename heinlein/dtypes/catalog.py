@@ -5,15 +5,23 @@ from functools import reduce
 from operator import add
 
 import astropy.units as u
+import healpy
 import numpy as np
 from astropy.coordinates import SkyCoord
-from astropy.table import Table, vstack
+from astropy.table import Column, MaskedColumn, Table, vstack
 from spherical_geometry.vector import lonlat_to_vector
 
+import heinlein
 from heinlein.dtypes import dobj
+from heinlein.dtypes.filters import filter_mask
 from heinlein.locations import MAIN_CONFIG_DIR
 from heinlein.region import BaseRegion
 
+# Catalogs smaller than this are always filtered with a full scan
+MIN_INDEXED_ROWS = 10000
+# Maximum number of (cone, row) pairs tested at once by query_cones
+CONE_CHUNK_SIZE = 2**22
+
 
 def load_config():
     catalog_config_location = MAIN_CONFIG_DIR / "dtypes" / "catalog.json"
@@ -24,13 +32,32 @@ def load_config():
 
 def get_coordinates(catalog: Table):
     if "coordinates" in catalog.colnames and isinstance(
-        catalog["coordinates"], SkyCoord
+        catalog.columns["coordinates"], SkyCoord
     ):
-        return catalog["coordinates"]
-    coords = SkyCoord(catalog["ra"], catalog["dec"])
+        return catalog.columns["coordinates"]
+    coords = SkyCoord(*get_radec(catalog), unit="deg")
     return coords
 
 
+def get_radec(catalog: Table) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the positions of the objects in a catalog as plain arrays of ra and dec
+    in degrees.
+    """
+    ra = u.Quantity(catalog["ra"], u.deg).value
+    dec = u.Quantity(catalog["dec"], u.deg).value
+    return ra, dec
+
+
+def get_unit_vectors(catalog: Table) -> np.ndarray:
+    """
+    Get the positions of the objects in a catalog as an (N, 3) array of unit
+    vectors, which is what the regions use to filter catalogs.
+    """
+    ra, dec = get_radec(catalog)
+    return np.column_stack(lonlat_to_vector(ra, dec)).astype(np.float64, copy=False)
+
+
 def get_cartesian_points(coordinates: SkyCoord):
     lon = coordinates.ra.to_value("deg")
     lat = coordinates.dec.to_value("deg")
@@ -38,31 +65,78 @@ def get_cartesian_points(coordinates: SkyCoord):
     return cartesian_points
 
 
+def get_coordinate_columns(colnames: list, config: dict = {}) -> tuple[str, str]:
+    """
+    Find the names of the ra and dec columns among the columns of a catalog.
+    They are taken from the dataset config if it has them, otherwise from the
+    list of common names in the default catalog config.
+    """
+    if _config_has_coord_columns(config):
+        return config["columns"]["ra"]["key"], config["columns"]["dec"]["key"]
+    default_config = load_config()
+    columns = set(colnames)
+    ra_col = columns.intersection(default_config["columns"]["ra"])
+    dec_col = columns.intersection(default_config["columns"]["dec"])
+    if len(ra_col) != 1 or len(dec_col) != 1:
+        raise ValueError("Catalog does not have the correct columns for ra and dec")
+    return list(ra_col)[0], list(dec_col)[0]
+
+
+def get_coordinate_column_candidates(config: dict = {}) -> set[str]:
+    """
+    Every name the ra and dec columns of a catalog could have, for when the
+    columns have to be picked before the catalog is read.
+    """
+    if _config_has_coord_columns(config):
+        return set(get_coordinate_columns([], config))
+    default_config = load_config()
+    return set(default_config["columns"]["ra"]) | set(default_config["columns"]["dec"])
+
+
+def get_column_selection(columns: list) -> list[str]:
+    """
+    The columns a catalog query for the given columns returns. The ra and dec
+    columns are always included, and "coordinates" is built from them.
+    """
+    selection = ["ra", "dec"]
+    selection.extend(c for c in columns if c not in ("ra", "dec", "coordinates"))
+    return list(dict.fromkeys(selection))
+
+
+def pixel_region_name(region_name: str, nside: int, pixel: int) -> str:
+    """
+    The name the part of a survey region that falls in a HEALPix pixel (NEST
+    ordering) is loaded and cached under, in the "subregion" cache mode.
+    """
+    return f"{region_name}@{nside}:{pixel}"
+
+
+def split_pixel_region_name(name: str) -> tuple[str, int, int] | None:
+    """
+    Split a name from pixel_region_name into the survey region, nside and
+    pixel. Returns None for the names of whole regions.
+    """
+    region_name, sep, pixel = name.rpartition("@")
+    if not sep:
+        return None
+    nside, _, pixel = pixel.partition(":")
+    return region_name, int(nside), int(pixel)
+
+
+def _config_has_coord_columns(config: dict) -> bool:
+    return bool(config.get("columns", False) and config["columns"].get("ra", False))
+
+
 def label_coordinates(catalog: Table, config: dict = {}):
     """
     Takes a catalog and finds the coordinate columns (ra and dec)
     returns the catalog with the coordinate columns labeled
     """
-
-    config_has_coord_columns = config.get("columns", False) and config["columns"].get(
-        "ra", False
-    )
-    if not config_has_coord_columns:
-        default_config = load_config()
-        columns = set(catalog.colnames)
-        ras = set(default_config["columns"]["ra"])
-        dec = set(default_config["columns"]["dec"])
-        ra_col = columns.intersection(ras)
-        dec_col = columns.intersection(dec)
-        if len(ra_col) != 1 or len(dec_col) != 1:
-            raise ValueError("Catalog does not have the correct columns for ra and dec")
-        ra_name = list(ra_col)[0]
-        dec_name = list(dec_col)[0]
+    ra_name, dec_name = get_coordinate_columns(catalog.colnames, config)
+    if not _config_has_coord_columns(config):
         ra_unit = u.deg
         dec_unit = u.deg
     else:
-        ra_name = config["columns"]["ra"]["key"]
-        dec_name = config["columns"]["dec"]["key"]
         ra_unit_name = config["columns"]["ra"].get("unit", "deg")
         dec_unit_name = config["columns"]["dec"].get("unit", "deg")
         ra_unit = getattr(u, ra_unit_name)
@@ -82,42 +156,400 @@ def label_coordinates(catalog: Table, config: dict = {}):
     return catalog
 
 
-def Catalog(data: Table = None, config: dict = {}, *args, **kwargs):
+class CatalogTable(Table):
+    """
+    The table type returned for catalog queries. Positions are stored as plain
+    ra and dec columns, and the "coordinates" column is built as a SkyCoord
+    only when it is read, so filtering and stacking tables never has to
+    carry a SkyCoord around.
+    """
+
+    def __getitem__(self, item):
+        if (
+            isinstance(item, str)
+            and item == "coordinates"
+            and item not in self.colnames
+        ):
+            return get_coordinates(self)
+        return super().__getitem__(item)
+
+
+def Catalog(
+    data: Table = None, config: dict = {}, *args, partial: bool = False, **kwargs
+):
     """
     Produces a catalog object from an astropy table. This locates the ra and dec
-    columns, creates SkyCoords, and creates a cartesian representation of the
+    columns, which are used to create a cartesian representation of the
     coordinates for more efficient filtering. Produces a :class:`CatalogObject` which
     is used internally by the DataManager. When a pieces of data is actuall requested
-    this object will produce a :class:`astropy.Table` with the data from the region.
+    this object will produce a :class:`CatalogTable` with the data from the region.
 
+    Handlers that only loaded some of the columns of the catalog should set partial.
     """
     if data is None:
         data = Table()
-    if len(data) == 0:
-        return CatalogObject(data)
+    if len(data) == 0 and not getattr(data, "colnames", None):
+        return CatalogObject(data, partial=partial)
 
     labeled_data = label_coordinates(data, config)
-    catalog_coordinates = get_coordinates(labeled_data)
-    data["coordinates"] = catalog_coordinates
-    return CatalogObject(data)
+    return CatalogObject(labeled_data, partial=partial)
 
 
 class CatalogObject(dobj.HeinleinDataObject):
-    def __init__(self, data: Table):
+    def __init__(
+        self, data: Table, vectors: np.ndarray = None, *, partial: bool = False
+    ):
+        """
+        The positions of the objects are kept as an (N, 3) array of unit
+        vectors, so filtering by region never has to go through SkyCoord.
+        The vectors are computed the first time they are needed.
+
+        A partial catalog only holds some of the columns of the underlying data.
+        """
+        if not isinstance(data, CatalogTable):
+            data = CatalogTable(data, copy=False)
         self._data = data
+        self._vectors = vectors
+        self.partial = partial
+        self._index = None
         self.size = None
 
     def __len__(self):
         return len(self._data)
 
-    def get_data_from_region(self, region: BaseRegion):
-        mask = region.contains(self._data["coordinates"])
-        return self._data[mask]
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            if len(self._data):
+                self._vectors = get_unit_vectors(self._data)
+            else:
+                self._vectors = np.empty((0, 3))
+        return self._vectors
+
+    @property
+    def columns(self) -> list[str]:
+        return self._data.colnames
+
+    def get_data_from_region(
+        self, region: BaseRegion, columns: list = None, filters: tuple = ()
+    ):
+        """
+        Get the objects that fall in a region. If columns are given, only those
+        columns are returned (see get_column_selection). If filters are given,
+        only the objects that pass them are returned (see passes_filters).
+        """
+        data = self.select_columns(columns)
+        rows = self._candidate_rows(region)
+        if rows is None:
+            mask = region.contains_vectors(self.vectors)
+            if filters:
+                mask &= self.passes_filters(filters)
+            return data[mask]
+        rows = rows[region.contains_vectors(self.vectors[rows])]
+        if filters:
+            rows = rows[self.passes_filters(filters, rows)]
+        rows.sort()  # Keep the rows in the same order as a full scan
+        return data[rows]
+
+    def passes_filters(self, filters: tuple, rows: np.ndarray = None) -> np.ndarray:
+        """
+        Check which objects pass a set of normalized filters (see
+        heinlein.dtypes.filters). If rows are given, only those rows are checked.
+        """
+        names = list(dict.fromkeys(f[0] for f in filters))
+        missing = self.missing_columns(names)
+        if missing:
+            raise KeyError(f"Columns {missing} not found in catalog")
+        table = Table([self._data.columns[c] for c in names], copy=False)
+        if rows is not None:
+            table = table[rows]
+        return filter_mask(table, filters)
+
+    def select_columns(self, columns: list = None) -> CatalogTable:
+        """
+        Get a table with a subset of the columns, without copying them.
+        """
+        if columns is None:
+            return self._data
+        selection = get_column_selection(columns)
+        missing = self.missing_columns(selection)
+        if missing:
+            raise KeyError(f"Columns {missing} not found in catalog")
+        return CatalogTable([self._data.columns[c] for c in selection], copy=False)
+
+    def missing_columns(self, columns: list) -> list[str]:
+        """
+        The columns a query for the given columns needs that this object
+        does not have.
+        """
+        return [
+            c for c in get_column_selection(columns) if c not in self._data.colnames
+        ]
+
+    def has_columns(self, columns: list = None) -> bool:
+        """
+        Check if this object can serve a query for the given columns. A query
+        without columns needs all of them.
+        """
+        if columns is None:
+            return not self.partial
+        return not self.missing_columns(columns)
+
+    def add_columns(self, other: CatalogObject) -> CatalogObject:
+        """
+        Combine this object with another one that holds other columns of the
+        same rows. Raises a ValueError if the rows don't line up.
+        """
+        if len(other) != len(self) or not all(
+            np.array_equal(self._data[c], other._data[c]) for c in ("ra", "dec")
+        ):
+            raise ValueError("Catalogs do not contain the same rows")
+        new_columns = [c for c in other.columns if c not in self._data.colnames]
+        data = CatalogTable(
+            [self._data.columns[c] for c in self.columns]
+            + [other._data.columns[c] for c in new_columns],
+            copy=False,
+        )
+        combined = type(self)(
+            data, self._vectors, partial=self.partial and other.partial
+        )
+        combined._index = self._index
+        return combined
+
+    def _candidate_rows(self, region: BaseRegion) -> np.ndarray | None:
+        """
+        Use the spatial index to find the rows that could be in a region.
+        The index sorts the rows by their HEALPix pixel (NEST ordering), so
+        every pixel, and every pixel at a coarser resolution, is a contiguous
+        range of rows. It is built the first time it is needed, and
+        kept for as long as the object lives (usually in the cache). Returns None
+        if the index should not be used for this query.
+        """
+        nside = self._index_nside()
+        if not nside:
+            return None
+        cap = region.bounding_cap()
+        if cap is None:
+            return None
+        center, radius = cap
+
+        order, sorted_pixels = self._get_index(nside)
+
+        # Query at a resolution where the cap covers a handful of pixels,
+        # then map those pixels onto ranges of pixels in the index.
+        query_nside = nside
+        while query_nside > 1 and healpy.nside2resol(query_nside) < radius / 4:
+            query_nside //= 2
+        query_pixels = healpy.query_disc(
+            query_nside, center, radius, inclusive=True, nest=True
+        )
+        shift = 2 * (nside.bit_length() - query_nside.bit_length())
+        starts = np.searchsorted(sorted_pixels, query_pixels << shift)
+        ends = np.searchsorted(sorted_pixels, (query_pixels + 1) << shift)
+        if (ends - starts).sum() > len(self) // 2:
+            return None  # A full scan is just as fast
+        return np.concatenate(
+            [order[start:end] for start, end in zip(starts, ends) if end > start]
+            or [np.empty(0, dtype=order.dtype)]
+        )
+
+    def query_cones(
+        self, ra: np.ndarray, dec: np.ndarray, radius: float | np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the rows that fall in each of many cones at once. ra, dec and radius
+        are in degrees, and radius can be a single value or one per cone.
+
+        Returns the result in CSR form: an array of offsets of length
+        n_cones + 1 and a flat array of row indices, so the rows in cone i are
+        indices[offsets[i]:offsets[i + 1]], in ascending order.
+
+        The pixels each cone touches are found with one small disc query per
+        cone, at a resolution where a cone covers a handful of pixels. Everything
+        after that is vectorized over all the cones, in chunks to keep the
+        memory use bounded. If the spatial index is turned off (or the catalog is
+        too small to need one), every row is checked against every cone instead.
+        """
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), ra.shape)
+        n_cones = len(ra)
+        centers = np.column_stack(lonlat_to_vector(ra, dec))
+        radius = np.radians(radius)
+        cos_radius = np.cos(radius)
+        offsets = np.zeros(n_cones + 1, dtype=np.int64)
+        if n_cones == 0 or len(self) == 0:
+            return offsets, np.empty(0, dtype=np.int64)
+
+        nside = self._index_nside()
+        if not nside:
+            return self._scan_cones(centers, cos_radius)
+        order, sorted_pixels = self._get_index(nside)
+        query_nside = nside
+        while query_nside > 1 and healpy.nside2resol(query_nside) < radius.max() / 2:
+            query_nside //= 2
+        shift = 2 * (nside.bit_length() - query_nside.bit_length())
+
+        # Work through the cones in pixel order too, so neighbouring cones read
+        # neighbouring rows
+        cone_order = np.argsort(healpy.vec2pix(nside, *centers.T, nest=True))
+        centers = centers[cone_order]
+        radius = radius[cone_order]
+        cos_radius = cos_radius[cone_order]
+        cone_pixels = [
+            healpy.query_disc(query_nside, center, r, inclusive=True, nest=True)
+            for center, r in zip(centers, radius)
+        ]
+        pixels = np.concatenate(cone_pixels)
+        starts = np.searchsorted(sorted_pixels, pixels << shift)
+        ends = np.searchsorted(sorted_pixels, (pixels + 1) << shift)
+        lengths = ends - starts
+        # cone_pixels[i] maps to the ranges range_bounds[i]:range_bounds[i + 1]
+        range_bounds = np.cumsum([0] + [len(p) for p in cone_pixels])
+        candidates_per_cone = np.diff(np.append(0, np.cumsum(lengths))[range_bounds])
+
+        all_cones = []
+        all_rows = []
+        chunk_start = 0
+        cumulative = np.cumsum(candidates_per_cone)
+        while chunk_start < n_cones:
+            # Take as many cones as fit in the candidate budget, but at least one
+            budget = cumulative[chunk_start] - candidates_per_cone[chunk_start]
+            chunk_end = np.searchsorted(cumulative, budget + CONE_CHUNK_SIZE, "right")
+            chunk_end = max(chunk_end, chunk_start + 1)
+            first, last = range_bounds[chunk_start], range_bounds[chunk_end]
+            chunk_lengths = lengths[first:last]
+            chunk_starts = starts[first:last]
+            total = chunk_lengths.sum()
+            # Expand each range of the index into the positions it covers
+            range_offsets = np.cumsum(chunk_lengths) - chunk_lengths
+            positions = np.arange(total) + np.repeat(
+                chunk_starts - range_offsets, chunk_lengths
+            )
+            rows = order[positions]
+            cones = np.repeat(
+                np.arange(chunk_start, chunk_end),
+                candidates_per_cone[chunk_start:chunk_end],
+            )
+            inside = (
+                np.einsum("ij,ij->i", self.vectors[rows], centers[cones])
+                >= cos_radius[cones]
+            )
+            all_cones.append(cones[inside])
+            all_rows.append(rows[inside])
+            chunk_start = chunk_end
+
+        cones = cone_order[np.concatenate(all_cones)]
+        # Sorting a single key is much faster than a lexsort on (cones, rows)
+        keys = np.sort(cones * len(self) + np.concatenate(all_rows))
+        offsets[1:] = np.cumsum(np.bincount(cones, minlength=n_cones))
+        return offsets, keys % len(self)
+
+    def _scan_cones(
+        self, centers: np.ndarray, cos_radius: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        query_cones without the spatial index. The cones are checked against all
+        the rows, as many cones at a time as fit in CONE_CHUNK_SIZE checks.
+        """
+        n_cones = len(centers)
+        chunk = max(1, CONE_CHUNK_SIZE // len(self))
+        all_cones = []
+        all_rows = []
+        for start in range(0, n_cones, chunk):
+            inside = self.vectors @ centers[start : start + chunk].T >= (
+                cos_radius[start : start + chunk]
+            )
+            # Going through the transpose gives the rows of each cone in order
+            cones, rows = np.nonzero(inside.T)
+            all_cones.append(cones + start)
+            all_rows.append(rows)
+        cones = np.concatenate(all_cones)
+        offsets = np.zeros(n_cones + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(cones, minlength=n_cones))
+        return offsets, np.concatenate(all_rows).astype(np.int64)
+
+    def _get_index(self, nside: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the permutation that sorts the rows by pixel, and the sorted
+        pixel numbers.
+        """
+        if self._index is None or self._index[0] != nside:
+            pixels = healpy.vec2pix(nside, *self.vectors.T, nest=True)
+            order = np.argsort(pixels, kind="stable")
+            self._index = (nside, order, pixels[order])
+        return self._index[1:]
+
+    def _index_nside(self) -> int:
+        if len(self) < MIN_INDEXED_ROWS:
+            return 0
+        return heinlein.get_option("CATALOG_INDEX_NSIDE")
 
     @classmethod
     def combine(cls, objects: list[CatalogObject]):
-        data = vstack([o._data for o in objects if len(o._data) > 0])
-        return cls(data)
+        if len(objects) == 1:
+            # Nothing to combine, and the data is never modified in place
+            return objects[0]
+        objects = [o for o in objects if len(o._data) > 0]
+        if not objects:
+            return cls(Table())
+        # Objects that hold different columns are combined on the columns they
+        # have in common
+        same_columns = all(o.columns == objects[0].columns for o in objects)
+        data = vstack(
+            [o._data for o in objects], join_type="exact" if same_columns else "inner"
+        )
+        partial = not same_columns or any(o.partial for o in objects)
+        if any(o._vectors is None for o in objects):
+            return cls(data, partial=partial)
+        vectors = np.concatenate([o._vectors for o in objects])
+        return cls(data, vectors, partial=partial)
+
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        """
+        Break the catalog down into one array per column. The coordinates
+        column is not stored, it is rebuilt from ra and dec when the catalog
+        is loaded again.
+        """
+        columns = []
+        arrays = {}
+        for name in self._data.colnames:
+            column = self._data[name]
+            if isinstance(column, SkyCoord):
+                continue
+            values = np.asarray(column)
+            if values.dtype.kind == "O":
+                try:
+                    values = values.astype(str)
+                except (TypeError, ValueError):
+                    raise NotImplementedError(
+                        f"Column {name} contains objects that cannot be stored"
+                    )
+            unit = None if column.unit is None else column.unit.to_string()
+            masked = isinstance(column, MaskedColumn)
+            arrays[name] = values
+            if masked:
+                arrays[f"{name}.mask"] = np.asarray(column.mask)
+            columns.append({"name": name, "unit": unit, "masked": masked})
+        return {"columns": columns, "partial": self.partial}, arrays
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        columns = []
+        for column in meta["columns"]:
+            name = column["name"]
+            if column["masked"]:
+                col = MaskedColumn(
+                    arrays[name],
+                    name=name,
+                    unit=column["unit"],
+                    mask=arrays[f"{name}.mask"],
+                    copy=False,
+                )
+            else:
+                col = Column(arrays[name], name=name, unit=column["unit"], copy=False)
+            columns.append(col)
+        data = CatalogTable(columns, copy=False)
+        return cls(data, partial=meta.get("partial", False))
 
     def estimate_size(self) -> int:
         if self.size is None:
@@ -131,7 +563,15 @@ class CatalogObject(dobj.HeinleinDataObject):
                         for col in self._data.colnames
                     ],
                 )
-                self.size = data_size
+                if self._index is not None:
+                    index_size = self._index[1].nbytes + self._index[2].nbytes
+                elif self._index_nside():
+                    # Reserve space for the spatial index, which is built later
+                    index_size = 16 * len(self)
+                else:
+                    index_size = 0
+                # The unit vectors are three float64 values per row
+                self.size = data_size + 24 * len(self) + index_size
         return self.size
 
 
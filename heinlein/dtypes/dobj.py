@@ -2,6 +2,8 @@ from __future__ import annotations
 
 from abc import ABC, abstractclassmethod, abstractmethod
 
+import numpy as np
+
 from heinlein.region import BaseRegion
 
 
@@ -27,3 +29,22 @@ class HeinleinDataObject(ABC):
         """
         estimate the size of the object in bytes
         """
+
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        """
+        Break the object down into a json-serializable metadata dictionary and a
+        set of plain numpy arrays, so it can be stored outside of the python heap
+        (e.g. on disk). Objects that cannot be represented this way should raise
+        NotImplementedError.
+        """
+        raise NotImplementedError(
+            f"{type(self).__name__} cannot be converted to arrays"
+        )
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        """
+        Rebuild an object from the output of `to_arrays`. The arrays may be
+        memory-mapped, so implementations should avoid copying them.
+        """
+        raise NotImplementedError(f"{cls.__name__} cannot be built from arrays")
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import operator
+
+import numpy as np
+from astropy.table import Table
+
+# Comparison operators that can be used in a filter, and the SQL they become.
+FILTER_OPS = {
+    "==": (operator.eq, "="),
+    "!=": (operator.ne, "!="),
+    "<": (operator.lt, "<"),
+    "<=": (operator.le, "<="),
+    ">": (operator.gt, ">"),
+    ">=": (operator.ge, ">="),
+    "in": (np.isin, "IN"),
+}
+
+
+def normalize_filters(filters) -> tuple:
+    """
+    Check a set of row filters and put them in a canonical order. Filters are
+    given as (column, op, value) triples, for example [("mag_i", "<", 24)]. A row
+    is kept if it passes all of them. The value of an "in" filter is a list of
+    allowed values. Returns an empty tuple if there are no filters.
+    """
+    if not filters:
+        return ()
+    normalized = []
+    for filter_ in filters:
+        try:
+            column, op, value = filter_
+        except (TypeError, ValueError):
+            raise ValueError(
+                f"Filters must be (column, op, value) triples, got {filter_}"
+            )
+        if op not in FILTER_OPS:
+            raise ValueError(
+                f"Unknown filter operator {op}. Options are {list(FILTER_OPS.keys())}"
+            )
+        if op == "in":
+            value = tuple(_plain(v) for v in value)
+        else:
+            value = _plain(value)
+        normalized.append((column, op, value))
+    return tuple(sorted(set(normalized), key=repr))
+
+
+def filter_key(filters: tuple) -> str:
+    """
+    A short fingerprint of a set of normalized filters, used to keep data loaded
+    with different filters apart in the cache.
+    """
+    serialized = json.dumps(filters).encode()
+    return hashlib.sha1(serialized).hexdigest()[:12]
+
+
+def apply_filters(table: Table, filters: tuple, column_names: dict = {}) -> Table:
+    """
+    Apply a set of normalized filters to a table. column_names maps column
+    names to the names of the columns in the table, if they are different.
+    """
+    if not filters:
+        return table
+    return table[filter_mask(table, filters, column_names)]
+
+
+def filter_mask(table: Table, filters: tuple, column_names: dict = {}) -> np.ndarray:
+    """
+    Get a boolean mask of the rows of a table that pass a set of normalized
+    filters. Masked values never pass a filter, the same way NULL values don't
+    pass a WHERE clause.
+    """
+    keep = np.ones(len(table), dtype=bool)
+    for column, op, value in filters:
+        values = table[column_names.get(column, column)]
+        passed = np.asarray(FILTER_OPS[op][0](np.asarray(values), value), dtype=bool)
+        mask = getattr(values, "mask", None)
+        if mask is not None:
+            passed &= ~np.asarray(mask, dtype=bool)
+        keep &= passed
+    return keep
+
+
+def filters_to_sql(filters: tuple, column_names: dict = {}) -> tuple[str, dict]:
+    """
+    Turn a set of normalized filters into a parameterised WHERE clause (without
+    the WHERE) and its parameters. column_names maps column names to the names
+    of the columns in the database, if they are different.
+    """
+    clauses = []
+    params = {}
+    for index, (column, op, value) in enumerate(filters):
+        name = column_names.get(column, column)
+        if op == "in":
+            keys = [f"f{index}_{i}" for i in range(len(value))]
+            params.update(zip(keys, value))
+            placeholders = ", ".join(f":{k}" for k in keys) or "NULL"
+            clauses.append(f'"{name}" IN ({placeholders})')
+        else:
+            params[f"f{index}"] = value
+            clauses.append(f'"{name}" {FILTER_OPS[op][1]} :f{index}')
+    return " AND ".join(clauses), params
+
+
+def _plain(value):
+    # numpy scalars can't be serialized or bound to a query
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
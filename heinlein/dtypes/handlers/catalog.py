@@ -1,12 +1,27 @@
+import sqlite3
+import threading
+from functools import cached_property
 from pathlib import Path
 
-import pandas as pd
+import numpy as np
 from astropy.io import ascii
 from astropy.table import Table
-from sqlalchemy import create_engine, text
 
-from heinlein.dtypes.catalog import Catalog
-from heinlein.dtypes.handlers import handler
+import heinlein
+from heinlein.dtypes.catalog import (
+    Catalog,
+    get_column_selection,
+    get_coordinate_column_candidates,
+    get_coordinate_columns,
+    split_pixel_region_name,
+)
+from heinlein.dtypes.filters import apply_filters, filters_to_sql, normalize_filters
+from heinlein.dtypes.handlers import handler, sidecar, sqlite
+
+# Name of the HEALPix pixel column (NEST ordering) added to catalog databases
+# by "heinlein prep", and of the table holding its nside.
+HPIX_COLUMN = "hpix"
+META_TABLE = "heinlein_meta"
 
 
 class heinleinIoException(Exception):
@@ -30,15 +45,30 @@ def get_catalog_handler(config: dict, dconfig: dict):
 
 
 class CsvCatalogHandler(handler.Handler):
+    supports_columns = True
+    supports_filters = True
+
     def __init__(self, path: Path, config: dict, *args, **kwargs):
         super().__init__(path, config, "catalog")
         self.known_files = [f for f in self._path.glob("*") if f.is_file()]
 
-    def get_data(self, region_names: list, *args, **kwargs):
+    def get_data(
+        self,
+        region_names: list,
+        *args,
+        columns: list = None,
+        filters: tuple = (),
+        **kwargs,
+    ):
         """
         Default handler for a catalog.
         Loads a single catalog, assuming the region name can be found in the file name.
+        If columns are given, only those columns (and the coordinates) are read.
+        If filters are given, they are applied to each file after it is read.
+        Files are read from their binary sidecar if they have one (see
+        heinlein.dtypes.handlers.sidecar).
         """
+        filters = normalize_filters(filters)
         storage = {}
         files = {}
         for name in region_names:
@@ -62,12 +92,54 @@ class CsvCatalogHandler(handler.Handler):
                     "in an external storage device that isn't attached."
                 )
                 return None
-            data = ascii.read(path)
-            storage.update({name: Catalog(data, self._config)})
+            if columns is None:
+                data = self._read(path)
+            else:
+                filter_columns = [f[0] for f in filters]
+                data = self._read_columns(path, list(columns) + filter_columns)
+            if filters:
+                ra, dec = get_coordinate_columns(data.colnames, self._config)
+                data = apply_filters(data, filters, {"ra": ra, "dec": dec})
+            partial = columns is not None
+            storage.update({name: Catalog(data, self._config, partial=partial)})
         return storage
 
+    def _read_columns(self, path: Path, columns: list) -> Table:
+        # We don't know what the coordinate columns are called until the file
+        # is read, so every name they could have is included.
+        wanted = [c for c in get_column_selection(columns) if c not in ("ra", "dec")]
+        include = set(wanted) | get_coordinate_column_candidates(self._config)
+        data = self._read(path, list(include))
+        missing = [c for c in wanted if c not in data.colnames]
+        if missing:
+            raise heinleinIoException(f"Columns {missing} not found in {path.name}")
+        return data
+
+    def _read(self, path: Path, include: list = None) -> Table:
+        if not heinlein.get_option("CATALOG_SIDECARS"):
+            return ascii.read(path, include_names=include)
+        data = sidecar.read_sidecar(path, include)
+        if data is None:
+            # The whole file is parsed once so the sidecar has every column
+            data = ascii.read(path)
+            sidecar.write_sidecar(path, data)
+            if include is not None:
+                data = data[[c for c in data.colnames if c in include]]
+        return data
+
 
 class SQLiteCatalogHandler(handler.Handler):
+    """
+    Loads catalogs from an SQLite database, with one table per survey region
+    or a single table with a region column. Databases prepared by "heinlein
+    prep" have an indexed HEALPix pixel column, which lets the handler load
+    just the part of a region that falls in a set of pixels. The names of
+    those parts are built with pixel_region_name.
+    """
+
+    supports_columns = True
+    supports_filters = True
+
     def __init__(self, path: Path, config: dict, *args, **kwargs):
         super().__init__(path, config, "catalog")
         if not path.exists():
@@ -75,106 +147,425 @@ class SQLiteCatalogHandler(handler.Handler):
         elif path.suffix != ".db":
             raise heinleinIoException(f"Path {path} is not a .db file!")
 
-        self._create_engine()
+        # Connections are opened the first time each thread needs one
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Get this thread's connection to the database. Each thread gets its own
+        read-only connection, so queries from the loader threads never wait
+        on each other.
+        """
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            con = self._local.connection = sqlite.connect(self._path)
+            with self._connections_lock:
+                self._connections.append(con)
+        return con
+
+    def close(self):
+        """
+        Close all of the connections to the database. New ones are opened if
+        the handler is used again.
+        """
+        with self._connections_lock:
+            for con in self._connections:
+                con.close()
+            self._connections = []
+            self._local = threading.local()
+
+    @cached_property
+    def _schema(self) -> dict:
+        con = self._connection()
+        sql = "SELECT name FROM sqlite_master WHERE type='table'"
+        tnames = [t for (t,) in con.execute(sql) if t != META_TABLE]
+        types = {tname: sqlite.column_types(con, tname) for tname in tnames}
+        return {
+            "tnames": tnames,
+            "types": types,
+            "columns": {tname: list(t.keys()) for tname, t in types.items()},
+        }
 
-    def _create_engine(self, *args, **kwargs):
-        self._engine = create_engine(f"sqlite:///{self._path}")
-        self._con = self._engine.connect()
-        sql = "SELECT * FROM sqlite_master where type='table'"
-        cur = self._con.execute(text(sql))
-        self._tnames = [t[1] for t in cur.fetchall()]
+    @property
+    def _tnames(self) -> list[str]:
+        return self._schema["tnames"]
+
+    @property
+    def _ttypes(self) -> dict[str, dict]:
+        return self._schema["types"]
+
+    @property
+    def _tcolumns(self) -> dict[str, list]:
+        return self._schema["columns"]
+
+    @cached_property
+    def pixel_nside(self) -> int | None:
+        """
+        The nside of the pixel column, if every table has one. Datasets with
+        subregions are always loaded a subregion at a time.
+        """
+        if self._config.get("subregion", None) is not None:
+            return None
+        if not all(HPIX_COLUMN in c for c in self._tcolumns.values()):
+            return None
+        sql = f"SELECT value FROM \"{META_TABLE}\" WHERE key = 'hpix_nside'"
+        try:
+            row = self._connection().execute(sql).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return None if row is None else int(row[0])
+
+    def partition_regions(self, region_names: list) -> list[list]:
+        # The pixels of a survey region are loaded with one query
+        groups = {}
+        regions = []
+        for region_name in region_names:
+            split = split_pixel_region_name(region_name)
+            if split is not None:
+                groups.setdefault(split[0], []).append(region_name)
+            else:
+                regions.append(region_name)
+
+        subregion_key = self._config.get("subregion", None)
+        parents = {r.split(".")[0] if subregion_key else r for r in regions}
+        if regions and len(self._tnames) == 1 and not parents & set(self._tnames):
+            # Regions that share a single table are loaded with one query
+            groups[None] = regions
+        elif subregion_key is not None:
+            # Subregions are loaded with one query per parent region
+            for region_name in regions:
+                groups.setdefault(region_name.split(".")[0], []).append(region_name)
+        else:
+            return list(groups.values()) + super().partition_regions(regions)
+        return list(groups.values())
+
+    def get_data(
+        self,
+        region_names: list,
+        *args,
+        columns: list = None,
+        filters: tuple = (),
+        **kwargs,
+    ):
+        """
+        Load the catalogs for a set of regions. If columns are given, only those
+        columns (and the coordinates) are selected from the database. If filters
+        are given, only the rows that pass them are selected.
+        """
+        filters = normalize_filters(filters)
+        # Parts of regions in HEALPix pixels are loaded separately
+        pixels = {}
+        whole_regions = []
+        for name in region_names:
+            split = split_pixel_region_name(name)
+            if split is None:
+                whole_regions.append(name)
+            else:
+                pixels.setdefault(split[:2], {})[split[2]] = name
+        region_names = whole_regions
 
-    def get_data(self, region_names: list, *args, **kwargs):
         subregion_key = self._config.get("subregion", None)
-        if subregion_key is not None:
-            splits = [rname.split(".") for rname in region_names]
+        if not region_names:
+            storage = {}
+        elif subregion_key is not None:
             regions_to_get = {}
-            for split in splits:
+            for name in region_names:
+                split = name.split(".")
                 if len(split) == 2:
-                    if split[0] in regions_to_get.keys():
-                        regions_to_get[split[0]].append(split[1])
-                    else:
-                        regions_to_get.update({split[0]: [split[1]]})
-                elif len(split) == 2 and split[0] not in regions_to_get.keys():
-                    regions_to_get.update({split[0]: []})
-
-            storage = self.get_with_subregions(regions_to_get)
+                    regions_to_get.setdefault(split[0], []).append(split[1])
+            storage = self.get_with_subregions(regions_to_get, columns, filters)
         else:
-            storage = self._get(region_names)
+            storage = self._get(region_names, columns, filters)
+
+        for (region, nside), names in pixels.items():
+            tables = self.get_pixels(region, nside, list(names), columns, filters)
+            storage.update({names[p]: table for p, table in tables.items()})
 
-        return {k: Catalog(table, self._config) for k, table in storage.items()}
+        partial = columns is not None
+        return {
+            k: Catalog(table, self._config, partial=partial)
+            for k, table in storage.items()
+        }
 
-    def get_with_subregions(self, regions: dict):
+    def get_with_subregions(
+        self, regions: dict, columns: list = None, filters: tuple = ()
+    ):
+        """
+        Load the subregions of a set of regions. Each region's table is read
+        with a single query, or all of them with one query if every region is
+        in the same table, and split into subregions in one pass.
+        """
         subregion_key = self._config.get("subregion", None)
         region_key = self._config.get("region", None)
         storage = {}
+        shared = {}
         for region, subregions in regions.items():
-            region_names = [".".join([region, sr]) for sr in subregions]
-            if str(region) in self._tnames:
-                table = self.get_where(region, {subregion_key: subregions})
-                if len(table) != 0:
-                    for index, sr in enumerate(subregions):
-                        mask = (table[region_key].astype(str) == region) & (
-                            table[subregion_key].astype(str) == sr
-                        )
-                        storage.update({region_names[index]: table[mask]})
-                    # This needs to be fixed
-            elif len(self._tnames) == 1:
-                region_names = [".".join([region, sr]) for sr in subregions]
-
-                table = self.get_where(
-                    self._tnames[0],
-                    {region_key: region.name, subregion_key: subregions},
-                )
-                for index, sr in enumerate(subregions):
-                    mask = table[subregion_key] == sr
-                    storage.update({region_names[index]: table[mask]})
+            if str(region) not in self._tnames:
+                shared[region] = subregions
+                continue
+            table = self.get_where(
+                region, {subregion_key: subregions}, columns, filters, parse=False
+            )
+            keys = [k for k in (region_key, subregion_key) if k in table.colnames]
+            groups = _split_rows(table, [table[k] for k in keys])
+            if region_key not in keys:
+                groups = {(region, *k): group for k, group in groups.items()}
+            names = [f"{region}.{sr}" for sr in subregions]
+            storage.update(_pick_groups(table, groups, names))
+
+        if shared and len(self._tnames) == 1:
+            conditions = [
+                {region_key: region, subregion_key: subregions}
+                for region, subregions in shared.items()
+            ]
+            table = self.get_where(
+                self._tnames[0], conditions, columns, filters, parse=False
+            )
+            groups = _split_rows(table, [table[region_key], table[subregion_key]])
+            names = [
+                f"{r}.{sr}" for r, subregions in shared.items() for sr in subregions
+            ]
+            storage.update(_pick_groups(table, groups, names))
         return storage
 
-    def _get(self, region_names: list):
+    def _get(self, region_names: list, columns: list = None, filters: tuple = ()):
         storage = {}
+        shared = []
         for region in region_names:
             if region in self._tnames:
-                table = self.get_all(region)
-
+                table = self.get_all(region, columns, filters)
                 storage.update({region: table})
+            else:
+                shared.append(region)
 
-            elif len(self._tnames) == 1:
-                region_key = self._config.get("region", None)
-                table = self.get_where(self._tnames[0], {region_key: region.name})
-                storage.update({region: table})
+        if shared and len(self._tnames) == 1:
+            # Every region is in the same table, so they are loaded together
+            region_key = self._config.get("region", None)
+            table = self.get_where(
+                self._tnames[0], {region_key: shared}, columns, filters, parse=False
+            )
+            groups = _split_rows(table, [table[region_key]])
+            storage.update(_pick_groups(table, groups, shared))
         return storage
 
-    def get_where(self, tname: str, conditions: dict):
-        base_query = f'SELECT * FROM "{tname}" WHERE '
-        base_condition = '{} = "{}"'
-        multiple_base_conditions = "{} IN ({})"
-        output_conditions = []
-        for k, vs in conditions.items():
-            if isinstance(vs, list):
-                c = '","'.join([str(v) for v in vs])
-                c = '"' + c + '"'
-                output_conditions.append(multiple_base_conditions.format(k, c))
-            else:
-                output_conditions.append(base_condition.format(k, vs))
-        query = base_query + " AND ".join(output_conditions)
-        table = self.execute_query(query)
-        return self._parse_return(table)
+    def get_where(
+        self,
+        tname: str,
+        conditions: dict | list[dict],
+        columns: list = None,
+        filters: tuple = (),
+        parse: bool = True,
+    ):
+        """
+        Select the rows of a table that match a set of conditions, given as
+        {column: value} or {column: [values]}. If a list of conditions is
+        given, rows that match any of them are selected. Values are passed
+        to the database as parameters.
+        """
+        select = self._select_list(tname, columns)
+        if isinstance(conditions, dict):
+            conditions = [conditions]
+        params = {}
+        alternatives = []
+        for condition in conditions:
+            clauses = []
+            for column, values in condition.items():
+                if isinstance(values, list):
+                    keys = [f"c{len(params) + i}" for i in range(len(values))]
+                    params.update(zip(keys, values))
+                    placeholders = ", ".join(f":{k}" for k in keys) or "NULL"
+                    clauses.append(f'"{column}" IN ({placeholders})')
+                else:
+                    key = f"c{len(params)}"
+                    params[key] = values
+                    clauses.append(f'"{column}" = :{key}')
+            alternatives.append(" AND ".join(clauses))
+        where = " OR ".join(f"({a})" for a in alternatives)
 
-    def get_all(self, tname):
-        query = f'SELECT * FROM "{tname}"'
-        table = self.execute_query(query)
+        filter_clause, filter_params = self._filter_clause(tname, filters)
+        if filter_clause:
+            where = f"({where}) AND {filter_clause}"
+            params.update(filter_params)
+        query = f'SELECT {select} FROM "{tname}" WHERE {where}'
+        table = self.execute_query(query, params, tname)
+        return self._parse_return(table) if parse else table
+
+    def get_all(self, tname, columns: list = None, filters: tuple = ()):
+        query, params = self._table_query(tname, columns, filters)
+        table = self.execute_query(query, params, tname)
         return self._parse_return(table)
 
-    def execute_query(self, query):
-        q = text(query)
-        data = pd.read_sql(q, self._con)
-        return data
+    def iter_region(
+        self,
+        region_name: str,
+        columns: list = None,
+        filters: tuple = (),
+        batch_size: int = sqlite.BATCH_SIZE,
+    ):
+        """
+        Read the catalog for a region as a series of tables of at most
+        batch_size rows, for regions too large to load at once. The tables are
+        not turned into catalog objects and are not cached.
+        """
+        if region_name not in self._tnames:
+            raise heinleinIoException(f"No table found for region {region_name}")
+        query, params = self._table_query(
+            region_name, columns, normalize_filters(filters)
+        )
+        types = self._ttypes[region_name]
+        con = self._connection()
+        yield from sqlite.iter_tables(con, query, params, types, batch_size)
+
+    def _table_query(
+        self, tname: str, columns: list = None, filters: tuple = ()
+    ) -> tuple[str, dict]:
+        select = self._select_list(tname, columns)
+        query = f'SELECT {select} FROM "{tname}"'
+        filter_clause, params = self._filter_clause(tname, filters)
+        if filter_clause:
+            query += f" WHERE {filter_clause}"
+        return query, params
+
+    def get_pixels(
+        self,
+        region: str,
+        nside: int,
+        pixels: list,
+        columns: list = None,
+        filters: tuple = (),
+    ) -> dict:
+        """
+        Load the rows of a region that fall in a set of HEALPix pixels (NEST
+        ordering). The nside can't be finer than that of the pixel column.
+        Each pixel covers a contiguous range of the finer pixels, so contiguous
+        pixels are fetched with a single range on the index. Returns a table
+        for each pixel, which is empty if there are no rows in it.
+        """
+        if self.pixel_nside is None or nside > self.pixel_nside:
+            raise heinleinIoException(
+                f"Catalog at {self._path} can't be loaded in pixels at nside {nside}"
+            )
+        params = {}
+        conditions = []
+        if region in self._tnames:
+            tname = region
+        elif len(self._tnames) == 1:
+            tname = self._tnames[0]
+            conditions.append(f'"{self._config.get("region")}" = :region')
+            params["region"] = region
+        else:
+            return {}
+
+        pixels = np.unique(pixels)
+        factor = (self.pixel_nside // nside) ** 2
+        breaks = np.flatnonzero(np.diff(pixels) != 1) + 1
+        starts = pixels[np.r_[0, breaks]] * factor
+        ends = (pixels[np.r_[breaks - 1, len(pixels) - 1]] + 1) * factor - 1
+        ranges = []
+        for index, (start, end) in enumerate(zip(starts, ends)):
+            ranges.append(f'"{HPIX_COLUMN}" BETWEEN :lo{index} AND :hi{index}')
+            params.update({f"lo{index}": int(start), f"hi{index}": int(end)})
+        conditions.append("(" + " OR ".join(ranges) + ")")
+        filter_clause, filter_params = self._filter_clause(tname, filters)
+        if filter_clause:
+            conditions.append(filter_clause)
+            params.update(filter_params)
+
+        select = self._select_list(tname, columns, [HPIX_COLUMN])
+        query = f'SELECT {select} FROM "{tname}" WHERE ' + " AND ".join(conditions)
+        table = self.execute_query(query, params, tname)
+
+        groups = _split_rows(table, [np.asarray(table[HPIX_COLUMN]) // factor])
+        return {int(p): groups.get((p,), table[:0]) for p in pixels}
+
+    def _filter_clause(self, tname: str, filters: tuple = ()) -> tuple[str, dict]:
+        if not filters:
+            return "", {}
+        available = self._tcolumns[tname]
+        ra, dec = get_coordinate_columns(available, self._config)
+        column_names = {"ra": ra, "dec": dec}
+        missing = [
+            f[0] for f in filters if column_names.get(f[0], f[0]) not in available
+        ]
+        if missing:
+            raise heinleinIoException(f"Columns {missing} not found in table {tname}")
+        return filters_to_sql(filters, column_names)
+
+    def _select_list(self, tname: str, columns: list = None, extra: list = ()) -> str:
+        """
+        Build the list of columns to select from a table. The coordinate
+        columns and the region keys are always selected, since they are
+        needed to build and split up the catalogs, as are any extra columns.
+        """
+        if columns is None:
+            return "*"
+        available = self._tcolumns[tname]
+        wanted = list(get_coordinate_columns(available, self._config))
+        wanted.extend(
+            c for c in get_column_selection(columns) if c not in ("ra", "dec")
+        )
+        missing = [c for c in wanted if c not in available]
+        if missing:
+            raise heinleinIoException(f"Columns {missing} not found in table {tname}")
+        for key in ("region", "subregion"):
+            key_column = self._config.get(key, None)
+            if key_column in available:
+                wanted.append(key_column)
+        wanted.extend(extra)
+        return ", ".join(f'"{c}"' for c in dict.fromkeys(wanted))
+
+    def execute_query(self, query, params: dict = None, tname: str = None) -> Table:
+        """
+        Run a query and read the result into a Table. The column types are
+        taken from the table the query reads from, if it is given.
+        """
+        types = self._ttypes.get(tname, {})
+        return sqlite.read_table(self._connection(), query, params, types)
 
     def _parse_return(self, data, *args, **kwargs):
         if len(data) == 0:
             return {}
-
-        # replace all None with np.nan
-        data = Table.from_pandas(data)
         return data
+
+
+def _split_rows(table: Table, keys: list[np.ndarray]) -> dict[tuple, Table]:
+    """
+    Split a table into groups of rows that have the same values for a set of
+    keys. The table is sorted once, and each group is a slice of the sorted
+    table, so no data is copied per group. Rows in a group keep their order.
+    Groups are labeled by a tuple with the value of each key.
+    """
+    codes = np.zeros(len(table), dtype=np.int64)
+    labels = []
+    for key in keys:
+        values, inverse = np.unique(np.asarray(key), return_inverse=True)
+        codes = codes * len(values) + inverse.ravel()
+        labels.append(values)
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    table = table[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else []
+    ends = np.r_[starts[1:], len(codes)] if len(codes) else []
+
+    groups = {}
+    for start, end in zip(starts, ends):
+        code = codes[start]
+        label = []
+        for values in reversed(labels):
+            code, index = divmod(code, len(values))
+            label.append(values[index])
+        groups[tuple(reversed(label))] = table[start:end]
+    return groups
+
+
+def _pick_groups(table: Table, groups: dict[tuple, Table], names: list[str]) -> dict:
+    """
+    Match groups from _split_rows to region names, built by joining the
+    labels of each group with ".". Regions with no rows get an empty table.
+    """
+    by_name = {
+        ".".join(str(v) for v in label): group for label, group in groups.items()
+    }
+    return {name: by_name.get(name, table[:0]) for name in names}
@@ -5,6 +5,16 @@ from heinlein import dtypes
 
 
 class Handler(ABC):
+    # Handlers that can load a subset of the columns of their data set this,
+    # and accept a "columns" argument in get_data.
+    supports_columns = False
+    # Handlers that can filter rows as they load them set this, and accept a
+    # "filters" argument in get_data (see heinlein.dtypes.filters).
+    supports_filters = False
+    # Handlers that can load the part of a region that falls in a set of
+    # HEALPix pixels set this to the finest nside they can do it at.
+    pixel_nside = None
+
     def __init__(self, path: Path, dconfig: dict, type: str, *args, **kwargs):
         self._path = path
         self._type = type
@@ -14,5 +24,15 @@ class Handler(ABC):
     def get_data(self, regions: list, *args, **kwargs):
         pass
 
+    def partition_regions(self, region_names: list) -> list[list]:
+        """
+        Split a list of regions into groups that can be loaded independently.
+        Each group is passed to get_data separately, possibly in parallel
+        with the other groups. By default every region is its own group.
+        Handlers that load several regions at once more efficiently than one
+        at a time should group them here.
+        """
+        return [[region_name] for region_name in region_names]
+
     def get_data_object(self, data, *args, **kwargs):
         return dtypes.get_data_object(self._type, data)
@@ -4,7 +4,8 @@ from pathlib import Path
 import numpy as np
 from astropy.io import fits
 
-from heinlein.dtypes import mask
+import heinlein
+from heinlein.dtypes import mask, packed
 
 from .handler import Handler
 
@@ -26,15 +27,25 @@ class FitsMaskHandler(Handler):
         super().__init__(path, config, "mask")
 
     def get_data(self, regions, *args, **kwargs):
+        """
+        Loads the mask plane for each region. Planes prepared by "heinlein prep
+        -d mask" are used instead of the FITS files they were made from.
+        """
         files = [f for f in self._path.glob("*.fits") if not f.name.startswith(".")]
+        stores = [d for d in self._path.glob(f"*{packed.STORE_SUFFIX}") if d.is_dir()]
         output = {}
         for name in regions:
-            matches = list(filter(lambda x: name in x.name, files))
+            matches = list(filter(lambda x: name in x.name, stores))
+            if not matches:
+                matches = list(filter(lambda x: name in x.name, files))
             if len(matches) > 1:
                 logging.error(f"Error: Found more than one mask for region {name}")
                 continue
 
-            data = fits.open(matches[0])
+            if matches[0].suffix == packed.STORE_SUFFIX:
+                data = matches[0]
+            else:
+                data = fits.open(matches[0])
             out = np.empty(1, dtype="object")
             out[0] = data
             output.update({name: out})
@@ -45,4 +56,10 @@ class FitsMaskHandler(Handler):
         storage = np.empty(len(data), dtype=object)
         for index, value in enumerate(data.values()):
             storage[index] = value[0]
-        return mask.Mask(storage, **self._config)
+        output = mask.Mask(storage, **self._config)
+        if heinlein.get_option("MASK_LAZY_FITS"):
+            # Lazy masks open the files themselves
+            for hdul in storage:
+                if isinstance(hdul, fits.HDUList):
+                    hdul.close()
+        return output
@@ -0,0 +1,158 @@
+"""
+Binary copies ("sidecars") of CSV catalog files. Parsing a large CSV file is
+slow, so the first time a file is read its columns are written out as .npy
+files, which later reads memory map instead of parsing the file again. A
+sidecar is only used while the size and modification time of its CSV file
+match the ones it was built from.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from astropy.io import ascii
+from astropy.table import Column, MaskedColumn, Table
+
+import heinlein
+
+META_FILE = "meta.json"
+# Bumped when the layout of sidecars changes, so old ones are rebuilt
+VERSION = 1
+
+
+def sidecar_path(path: Path) -> Path:
+    """
+    Get the directory the sidecar of a CSV file is kept in. By default this
+    is a ".heinlein" directory next to the file. If CATALOG_SIDECAR_DIR is
+    set, sidecars are kept there, under a name that includes a hash of the
+    full path of the file.
+    """
+    path = Path(path).resolve()
+    root = heinlein.get_option("CATALOG_SIDECAR_DIR")
+    if root is None:
+        return path.parent / ".heinlein" / path.name
+    digest = hashlib.sha1(str(path).encode()).hexdigest()[:12]
+    return Path(root) / f"{path.name}-{digest}"
+
+
+def read_sidecar(path: Path, columns: list = None) -> Table | None:
+    """
+    Read a CSV file from its sidecar, if it has an up-to-date one. Columns
+    are memory mapped, so only the parts of them that are used are read
+    from disk. If columns are given, only those are included (the ones that
+    exist). Returns None if there is no usable sidecar.
+    """
+    sidecar = sidecar_path(path)
+    try:
+        with open(sidecar / META_FILE) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != VERSION or meta.get("source") != _fingerprint(path):
+        return None
+
+    entries = meta["columns"]
+    if columns is not None:
+        entries = [e for e in entries if e["name"] in columns]
+    output = []
+    try:
+        for entry in entries:
+            values = np.load(sidecar / entry["file"], mmap_mode="r")
+            if entry["mask"] is not None:
+                mask = np.load(sidecar / entry["mask"], mmap_mode="r")
+                column = MaskedColumn(
+                    values,
+                    name=entry["name"],
+                    mask=mask,
+                    unit=entry["unit"],
+                    copy=False,
+                )
+            else:
+                column = Column(
+                    values, name=entry["name"], unit=entry["unit"], copy=False
+                )
+            output.append(column)
+    except (OSError, ValueError):
+        return None
+    return Table(output, copy=False)
+
+
+def write_sidecar(path: Path, table: Table) -> bool:
+    """
+    Write a sidecar for a CSV file from a table read from it. The sidecar is
+    written to a temporary directory and moved into place, so readers never
+    see a partial one. Returns False if the table can't be stored this way
+    (it has columns of Python objects) or the sidecar can't be written.
+    """
+    if any(table[name].dtype == object for name in table.colnames):
+        return False
+    sidecar = sidecar_path(path)
+    source = _fingerprint(path)
+    entries = []
+    try:
+        sidecar.parent.mkdir(parents=True, exist_ok=True)
+        staging = Path(tempfile.mkdtemp(dir=sidecar.parent, prefix=".tmp-"))
+    except OSError:
+        return False
+    try:
+        for index, name in enumerate(table.colnames):
+            column = table[name]
+            entry = {
+                "name": name,
+                "file": f"c{index}.npy",
+                "mask": None,
+                "unit": None if column.unit is None else column.unit.to_string(),
+            }
+            np.save(staging / entry["file"], np.asarray(column))
+            mask = getattr(column, "mask", None)
+            if mask is not None and np.any(mask):
+                entry["mask"] = f"c{index}.mask.npy"
+                np.save(staging / entry["mask"], np.asarray(mask, dtype=bool))
+            entries.append(entry)
+        meta = {"version": VERSION, "source": source, "columns": entries}
+        with open(staging / META_FILE, "w") as f:
+            json.dump(meta, f)
+        if sidecar.exists():
+            shutil.rmtree(sidecar, ignore_errors=True)
+        os.replace(staging, sidecar)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)
+        return False
+    return True
+
+
+def build_sidecar(path: Path, force: bool = False) -> bool:
+    """
+    Parse a CSV file and write its sidecar, unless it already has an
+    up-to-date one. Returns True if a sidecar was written.
+    """
+    if not force and read_sidecar(path, columns=[]) is not None:
+        return False
+    return write_sidecar(path, ascii.read(path))
+
+
+def build_sidecars(
+    directory: Path, workers: int = None, force: bool = False
+) -> dict[Path, bool]:
+    """
+    Build sidecars for all the CSV files in a directory, parsing several of
+    them at once in separate processes. Returns whether a sidecar was
+    written for each file.
+    """
+    files = sorted(f for f in Path(directory).glob("*.csv") if f.is_file())
+    if workers == 1 or len(files) < 2:
+        return {f: build_sidecar(f, force) for f in files}
+    with ProcessPoolExecutor(workers) as pool:
+        results = pool.map(build_sidecar, files, [force] * len(files))
+        return dict(zip(files, results))
+
+
+def _fingerprint(path: Path) -> dict:
+    stat = Path(path).stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
@@ -0,0 +1,205 @@
+"""
+Reads the results of SQLite queries straight into numpy arrays. Rows are
+fetched in large batches and written into preallocated column arrays, so
+the only per-row Python objects are the ones the sqlite3 module creates.
+Databases are opened read only, with settings tuned for reading.
+"""
+from __future__ import annotations
+
+import sqlite3
+from collections.abc import Iterator
+from pathlib import Path
+from urllib.request import pathname2url
+
+import numpy as np
+from astropy.table import MaskedColumn, Table
+
+import heinlein
+
+# Number of rows fetched from the database at once
+BATCH_SIZE = 65536
+TEMP_STORE = {"default": 0, "file": 1, "memory": 2}
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    """
+    Open a read-only connection to a database, set up for reading (see the
+    SQLITE_* options). Connections can be closed from any thread, but should
+    only be used by one thread at a time.
+    """
+    uri = f"file:{pathname2url(str(Path(path).resolve()))}?mode=ro"
+    if heinlein.get_option("SQLITE_IMMUTABLE"):
+        uri += "&immutable=1"
+    con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    con.execute(f"PRAGMA mmap_size = {int(heinlein.get_option('SQLITE_MMAP_SIZE'))}")
+    # A negative cache size is in KiB rather than pages
+    cache_size = int(heinlein.get_option("SQLITE_CACHE_SIZE")) // 1024
+    con.execute(f"PRAGMA cache_size = {-cache_size}")
+    temp_store = TEMP_STORE[heinlein.get_option("SQLITE_TEMP_STORE")]
+    con.execute(f"PRAGMA temp_store = {temp_store}")
+    return con
+
+
+def column_types(con: sqlite3.Connection, tname: str) -> dict[str, np.dtype]:
+    """
+    Get the numpy type of each column of a table, from the declared column
+    types. The rules are the same as SQLite's type affinity rules. Columns
+    without a numeric affinity are read as objects, and converted once the
+    values are known.
+    """
+    types = {}
+    for column in con.execute(f'PRAGMA table_info("{tname}")'):
+        types[column[1]] = _declared_type(column[2])
+    return types
+
+
+def read_table(
+    con: sqlite3.Connection,
+    query: str,
+    params: dict = None,
+    types: dict = {},
+    batch_size: int = BATCH_SIZE,
+) -> Table:
+    """
+    Run a query and return the result as a Table. types gives the numpy type
+    of the columns of the result (see column_types). Columns not in it are
+    read as objects and converted once the values are known.
+    """
+    cursor = con.execute(query, params or {})
+    names = [d[0] for d in cursor.description]
+    columns = _Columns(names, types, batch_size)
+    for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+        columns.append(rows)
+    return columns.to_table()
+
+
+def iter_tables(
+    con: sqlite3.Connection,
+    query: str,
+    params: dict = None,
+    types: dict = {},
+    batch_size: int = BATCH_SIZE,
+) -> Iterator[Table]:
+    """
+    Run a query and yield the result as a series of Tables of at most
+    batch_size rows, for results that are too large to hold in memory at once.
+    """
+    cursor = con.execute(query, params or {})
+    names = [d[0] for d in cursor.description]
+    for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+        columns = _Columns(names, types, len(rows))
+        columns.append(rows)
+        yield columns.to_table()
+
+
+class _Columns:
+    """
+    Column arrays that rows are written into a batch at a time. The arrays
+    double in size when they fill up.
+    """
+
+    def __init__(self, names: list[str], types: dict, capacity: int):
+        self.names = names
+        self.types = [np.dtype(types.get(name, object)) for name in names]
+        self.arrays = [np.empty(capacity, dtype=t) for t in self.types]
+        self.masks = [None] * len(names)
+        self.size = 0
+        # Batches are converted in one go with a structured array. Values
+        # are written to the columns by position, so the field names are
+        # just placeholders.
+        self._record = np.dtype([(f"f{i}", t) for i, t in enumerate(self.types)])
+
+    def append(self, rows: list[tuple]):
+        start, end = self.size, self.size + len(rows)
+        if end > len(self.arrays[0]):
+            self._grow(end)
+        try:
+            records = np.array(rows, dtype=self._record)
+            batch = [records[f"f{i}"] for i in range(len(self.names))]
+        except (TypeError, ValueError, OverflowError):
+            # There are NULLs (or values of the wrong type) in a column
+            # that can't hold them
+            batch = [np.array(c, dtype=object) for c in zip(*rows)]
+        for index, values in enumerate(batch):
+            self._write(index, values, start, end)
+        self.size = end
+
+    def _write(self, index: int, values: np.ndarray, start: int, end: int):
+        array = self.arrays[index]
+        if values.dtype == object and array.dtype != object:
+            missing = _is_null(values)
+            if missing.any():
+                self._mask(index)[start:end] = missing
+                values = np.where(missing, 0, values)
+            try:
+                array[start:end] = values
+                return
+            except (TypeError, ValueError, OverflowError):
+                # Fall back to objects for this column
+                array = self.arrays[index] = array.astype(object)
+        array[start:end] = values
+
+    def _mask(self, index: int) -> np.ndarray:
+        if self.masks[index] is None:
+            self.masks[index] = np.zeros(len(self.arrays[index]), dtype=bool)
+        return self.masks[index]
+
+    def _grow(self, size: int):
+        capacity = max(size, 2 * len(self.arrays[0]))
+        for index, array in enumerate(self.arrays):
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[: self.size] = array[: self.size]
+            self.arrays[index] = grown
+            mask = self.masks[index]
+            if mask is not None:
+                self.masks[index] = np.zeros(capacity, dtype=bool)
+                self.masks[index][: self.size] = mask[: self.size]
+
+    def to_table(self) -> Table:
+        columns = []
+        for name, array, mask in zip(self.names, self.arrays, self.masks):
+            values = array[: self.size]
+            if values.dtype == object:
+                values, mask = _convert_objects(values)
+            elif mask is not None:
+                mask = mask[: self.size]
+            if mask is not None and mask.any():
+                columns.append(MaskedColumn(values, name=name, mask=mask))
+            else:
+                columns.append(values)
+        return Table(columns, names=self.names, copy=False)
+
+
+def _declared_type(declared: str) -> np.dtype:
+    declared = (declared or "").upper()
+    if "INT" in declared:
+        return np.dtype(np.int64)
+    if any(t in declared for t in ("CHAR", "CLOB", "TEXT", "BLOB")):
+        return np.dtype(object)
+    if any(t in declared for t in ("REAL", "FLOA", "DOUB")):
+        return np.dtype(np.float64)
+    if "BOOL" in declared:
+        return np.dtype(bool)
+    return np.dtype(object)
+
+
+def _is_null(values: np.ndarray) -> np.ndarray:
+    return np.frompyfunc(lambda v: v is None, 1, 1)(values).astype(bool)
+
+
+def _convert_objects(values: np.ndarray) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Convert a column of Python objects to the narrowest array type that holds
+    them, the same way numpy would. NULLs are masked.
+    """
+    missing = _is_null(values)
+    present = values[~missing]
+    if len(present) == 0:
+        converted = np.zeros(len(values), dtype=np.float64)
+        return converted, missing if missing.any() else None
+    dtype = np.array(present.tolist()).dtype
+    if dtype.kind == "O":
+        return values, missing if missing.any() else None
+    fill = "" if dtype.kind == "U" else 0
+    converted = np.array(np.where(missing, fill, values).tolist(), dtype=dtype)
+    return converted, missing if missing.any() else None
@@ -2,34 +2,51 @@ import warnings
 from abc import ABC, abstractmethod
 from functools import singledispatchmethod
 from gettext import Catalog
+from pathlib import Path
 from typing import Iterable
 
 import astropy.units as u
+import healpy
 import numpy as np
+import shapely
 from astropy.coordinates import SkyCoord
-from astropy.io.fits import HDUList
+from astropy.io import fits
+from astropy.io.fits import HDUList, Header
 from astropy.nddata import Cutout2D
 from astropy.nddata.utils import NoOverlapError
 from astropy.utils.exceptions import AstropyWarning
-from astropy.wcs import WCS, utils
-from shapely import get_num_geometries
-from shapely.geometry import MultiPoint
+from astropy.wcs import WCS, WCSSUB_LATITUDE, WCSSUB_LONGITUDE, utils
 from shapely.geometry.base import BaseGeometry
 from shapely.strtree import STRtree
-from spherical_geometry.vector import lonlat_to_vector
+from spherical_geometry import great_circle_arc
+from spherical_geometry.vector import lonlat_to_vector, vector_to_lonlat
 
+import heinlein
+from heinlein.dtypes import moc, packed
+from heinlein.dtypes.catalog import get_coordinates, get_radec
 from heinlein.dtypes.dobj import HeinleinDataObject
-from heinlein.region import BaseRegion
+from heinlein.region import BaseRegion, BoxRegion, CircularRegion
+from heinlein.region.footprint import get_healpix_pixels
 
 warnings.simplefilter("ignore", category=AstropyWarning)
 
+# Most pixels FITS masks look up at once when working out the unmasked
+# fraction of regions
+FRACTION_BATCH = 2**24
+# Rows and columns in the tiles lazy FITS masks read their plane in
+LAZY_TILE_SIZE = 1024
+
 
 def get_mask_objects(input_list, *args, **kwargs):
     output_data = np.empty(len(input_list), dtype="object")
     if all(isinstance(obj, BaseGeometry) for obj in input_list):
         return [_regionMask(input_list)]
     for index, obj in enumerate(input_list):
-        if type(obj) == HDUList:
+        if isinstance(obj, Path) and obj.suffix == packed.STORE_SUFFIX:
+            output_data[index] = _packedMask(obj)
+        elif isinstance(obj, HDUList) and _mocMask.is_moc(obj):
+            output_data[index] = _mocMask.from_hdu(obj)
+        elif type(obj) == HDUList:
             # if kwargs.get("pixarray", False):
             #    output_data[index] = _pixelArrayMask(obj, *args, **kwargs)
             # else:
@@ -41,6 +58,69 @@ def get_mask_objects(input_list, *args, **kwargs):
     return output_data
 
 
+def _get_radec(coords) -> tuple[np.ndarray, np.ndarray]:
+    # Positions as ra and dec arrays in degrees (ICRS)
+    if isinstance(coords, SkyCoord):
+        if coords.frame.name != "icrs":
+            coords = coords.icrs
+        return coords.ra.to_value("deg"), coords.dec.to_value("deg")
+    if isinstance(coords, tuple):
+        return np.asarray(coords[0], float), np.asarray(coords[1], float)
+    return get_radec(coords)
+
+
+def _region_cells(region: BaseRegion, order: int) -> np.ndarray:
+    """
+    The HEALPix cells (NEST) at an order whose centers are in a region. If the
+    region is too small to hold any cell centers, the cells around it are used.
+    """
+    nside = 1 << order
+    cells = get_healpix_pixels(region, nside)
+    inside = region.contains_vectors(
+        np.column_stack(healpy.pix2vec(nside, cells, nest=True))
+    )
+    return cells[inside] if inside.any() else cells
+
+
+def _region_outline(region: BaseRegion, steps: int = 64) -> shapely.Polygon:
+    """
+    A region as a flat polygon in ra/dec (degrees), the way region masks are
+    defined. Circles are traced with many points, and the great circle arcs
+    between the vertices of polygons are filled in.
+    """
+    if isinstance(region, BoxRegion):
+        return shapely.box(*region.bounds)
+    if isinstance(region, CircularRegion):
+        # The points at the radius from the center, in 4 * steps directions
+        ra, dec = np.radians(region._center)
+        radius = np.radians(region._radius)
+        angle = np.linspace(0, 2 * np.pi, 4 * steps, endpoint=False)
+        lat = np.arcsin(
+            np.sin(dec) * np.cos(radius) + np.cos(dec) * np.sin(radius) * np.cos(angle)
+        )
+        lon = ra + np.arctan2(
+            np.sin(angle) * np.sin(radius) * np.cos(dec),
+            np.cos(radius) - np.sin(dec) * np.sin(lat),
+        )
+        ra, dec = np.degrees(lon), np.degrees(lat)
+    else:
+        points = region.spherical_geometry.points
+        arcs = [
+            great_circle_arc.interpolate(a, b, steps)[:-1]
+            for a, b in zip(points[:-1], points[1:])
+        ]
+        ra, dec = vector_to_lonlat(*np.concatenate(arcs).T)
+    # Keep the outline in one piece if it crosses ra = 0
+    ra = np.degrees(np.unwrap(np.radians(ra)))
+    return shapely.Polygon(np.column_stack([ra, dec]))
+
+
+def _group_sums(values: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # Sums of consecutive groups of values, with the given group sizes
+    owners = np.repeat(np.arange(len(counts)), counts)
+    return np.bincount(owners, weights=values, minlength=len(counts))
+
+
 class Mask(HeinleinDataObject):
     def __init__(self, masks=[], *args, **kwargs):
         """
@@ -70,12 +150,112 @@ class Mask(HeinleinDataObject):
     def estimate_size(self) -> int:
         return sum([mask.estimate_size() for mask in self._masks])
 
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        """
+        Only masks whose components can all be represented as plain arrays
+        can be converted. For now, this means fits planes.
+        """
+        meta = {"masks": []}
+        arrays = {}
+        for index, mask in enumerate(self._masks):
+            mask_meta, mask_arrays = mask.to_arrays()
+            meta["masks"].append(mask_meta)
+            arrays.update({f"{index}.{k}": v for k, v in mask_arrays.items()})
+        return meta, arrays
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        masks = np.empty(len(meta["masks"]), dtype=object)
+        for index, mask_meta in enumerate(meta["masks"]):
+            prefix = f"{index}."
+            mask_arrays = {
+                k[len(prefix) :]: v for k, v in arrays.items() if k.startswith(prefix)
+            }
+            mask_type = ARRAY_MASK_TYPES[mask_meta["type"]]
+            masks[index] = mask_type.from_arrays(mask_meta, mask_arrays)
+        return cls.from_masks(masks)
+
     def mask(self, catalog: Catalog, *args, **kwargs):
+        """
+        Remove the masked objects from a catalog (or SkyCoord). All the layers
+        of the mask are evaluated first, so the catalog is only copied once.
+        """
+        return catalog[self.evaluate(catalog)]
+
+    def evaluate(self, coords) -> np.ndarray:
+        """
+        Check which positions are not masked, without copying anything. The
+        positions can be given as a catalog, a SkyCoord or a tuple of ra and
+        dec arrays in degrees. Returns a boolean array that is True for the
+        positions that are not masked by any layer of the mask.
+
+        Each layer only checks the positions that the layers before it
+        did not mask.
+        """
+        ra, dec = _get_radec(coords)
+        keep = np.ones(len(ra), dtype=bool)
         for mask in self._masks:
-            catalog = mask.mask(catalog)
-            if len(catalog) == 0:
-                return catalog
-        return catalog
+            rows = np.flatnonzero(keep)
+            if len(rows) == 0:
+                break
+            elif len(rows) == len(keep):
+                keep = np.asarray(mask.evaluate(ra, dec), dtype=bool)
+            else:
+                keep[rows] = mask.evaluate(ra[rows], dec[rows])
+        return keep
+
+    def unmasked_fraction(self, region: BaseRegion, order: int = None) -> float:
+        """
+        The fraction of a region that is not masked (see unmasked_fractions).
+        """
+        return float(self.unmasked_fractions([region], order)[0])
+
+    def unmasked_fractions(
+        self, regions: Iterable[BaseRegion], order: int = None
+    ) -> np.ndarray:
+        """
+        Work out the fraction of each of a set of regions that is not masked.
+        If the mask has a single layer, the layer works this out itself where it
+        can: FITS masks count the pixels in each region, region masks intersect
+        the regions with their shapes and MOCs count the cells they cover.
+        Otherwise, the mask is evaluated once at the centers of the HEALPix
+        cells at an order (MASK_FRACTION_ORDER by default) that are in the
+        regions, so the result is exact up to the size of the cells.
+        """
+        regions = list(regions)
+        if order is None:
+            order = heinlein.get_option("MASK_FRACTION_ORDER")
+        if len(self._masks) == 1:
+            fractions = self._masks[0].unmasked_fractions(regions, order)
+            if fractions is not None:
+                return fractions
+        if not regions:
+            return np.zeros(0)
+        cells = [_region_cells(region, order) for region in regions]
+        counts = np.array([len(c) for c in cells])
+        ra, dec = healpy.pix2ang(
+            1 << order, np.concatenate(cells), nest=True, lonlat=True
+        )
+        return _group_sums(self.evaluate((ra, dec)), counts) / counts
+
+    def to_moc(self, order: int, bounds: tuple = None) -> "Mask":
+        """
+        Convert the mask into a single multi-order coverage map (MOC) at an order
+        (see heinlein.dtypes.moc). A HEALPix cell is masked if its center is
+        masked by any layer. The cells checked for each layer are the ones in its
+        bounds, or the bounds given here as (ra1, dec1, ra2, dec2) in degrees.
+        Bounds must be given for mangle masks, whose bounds aren't known.
+        """
+        starts = []
+        ends = []
+        for mask in self._masks:
+            layer = mask.to_moc(order, bounds)
+            starts.append(layer._starts)
+            ends.append(layer._ends)
+        if not starts:
+            starts = ends = [np.zeros(0, np.int64)]
+        merged = moc.merge_ranges(np.concatenate(starts), np.concatenate(ends))
+        return Mask.from_masks(np.array([_mocMask(*merged, order)], dtype=object))
 
     def append(self, other):
         if len(other) == 0:
@@ -121,6 +301,14 @@ class _mask(ABC):
         """
         pass
 
+    @abstractmethod
+    def evaluate(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        """
+        Check a set of positions given as ra and dec in degrees (ICRS). Returns
+        a boolean array that is True for the positions that are not masked.
+        """
+        pass
+
     @abstractmethod
     def estimate_size(self) -> int:
         """
@@ -128,6 +316,43 @@ class _mask(ABC):
         """
         pass
 
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        raise NotImplementedError(
+            f"{type(self).__name__} cannot be converted to arrays"
+        )
+
+    def coverage_bounds(self) -> tuple | None:
+        """
+        The box (ra1, dec1, ra2, dec2, in degrees) the mask covers, if known.
+        """
+        return None
+
+    def unmasked_fractions(
+        self, regions: list[BaseRegion], order: int
+    ) -> np.ndarray | None:
+        """
+        The fraction of each of a set of regions that is not masked, if the mask
+        can work it out directly. Returns None if it can't, in which case
+        Mask.unmasked_fractions checks a grid of HEALPix cells instead.
+        """
+        return None
+
+    def to_moc(self, order: int, bounds: tuple = None) -> "_mocMask":
+        """
+        Convert the mask to a MOC at an order, by checking the center of every
+        HEALPix cell in its bounds (see Mask.to_moc).
+        """
+        if bounds is None:
+            bounds = self.coverage_bounds()
+        if bounds is None:
+            raise ValueError(
+                f"Bounds must be given to convert a {type(self).__name__} to a MOC"
+            )
+        cells = moc.cells_in_bounds(bounds, order)
+        ra, dec = healpy.pix2ang(1 << order, cells, nest=True, lonlat=True)
+        masked = cells[~self.evaluate(ra, dec)]
+        return _mocMask(*moc.pixels_to_ranges(masked, order, order), order)
+
 
 class _mangleMask(_mask):
     def __init__(self, mask, *args, **kwargs):
@@ -138,8 +363,7 @@ class _mangleMask(_mask):
 
     @singledispatchmethod
     def mask(self, catalog: Catalog, *args, **kwargs):
-        coords = catalog["coordinates"]
-        contains = self._check(coords)
+        contains = self._mask.contains(*get_radec(catalog))
         return catalog[~contains]
 
     @mask.register
@@ -153,6 +377,9 @@ class _mangleMask(_mask):
         contains = self._mask.contains(ra, dec)
         return contains
 
+    def evaluate(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        return ~self._mask.contains(ra, dec)
+
     def estimate_size(self) -> int:
         return 0
 
@@ -192,10 +419,12 @@ class _pixelArrayMask(_mask):
     def estimate_size(self) -> int:
         return self._mask.nbytes
 
+    def evaluate(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        return self._check(SkyCoord(ra, dec, unit="deg"))
+
     @singledispatchmethod
     def mask(self, catalog: Catalog, *args, **kwargs):
-        coords = catalog["coordinates"]
-        mask = self._check(coords)
+        mask = self._check(get_coordinates(catalog))
         return catalog[mask]
 
     @mask.register
@@ -209,6 +438,7 @@ class _fitsMask(_mask):
         super().__init__(mask)
         self._wcs = wcs
         self._mask = mask_data
+        self._icrs_wcs = None
 
     @classmethod
     def from_hdu(cls, mask, mask_key, pixarray=False, *args, **kwargs):
@@ -220,7 +450,9 @@ class _fitsMask(_mask):
         """
 
         wcs = WCS(mask[0].header)
-        mask_key = mask_key
+        path = mask.filename()
+        if path is not None and heinlein.get_option("MASK_LAZY_FITS"):
+            return _lazyFitsMask(path, mask_key, wcs)
         mask_plane = mask[mask_key].data
         return cls(mask, wcs, mask_plane)
 
@@ -231,10 +463,72 @@ class _fitsMask(_mask):
         return cls(cutout, wcs, data)
 
     def estimate_size(self) -> int:
+        """
+        The bytes of the plane, which is held in memory (or memory mapped).
+        Masks that read their plane from disk as they need it are charged
+        less, see _lazyFitsMask.
+        """
         return self._mask.nbytes
 
+    def coverage_bounds(self) -> tuple:
+        rows, columns = self._shape
+        corners = self._wcs.celestial.calc_footprint(axes=(columns, rows))
+        return (*corners.min(axis=0), *corners.max(axis=0))
+
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        meta = {"type": "fits", "header": self._wcs.to_header_string()}
+        return meta, {"plane": np.asarray(self._mask)}
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        wcs = WCS(Header.fromstring(meta["header"]))
+        return cls(None, wcs, arrays["plane"])
+
     def _check(self, coords):
         y, x = utils.skycoord_to_pixel(coords, self._wcs)
+        return self._check_pixels(x, y)
+
+    def evaluate(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        return self._check_radec(ra, dec)
+
+    def _check_radec(self, ra: np.ndarray, dec: np.ndarray):
+        """
+        Check positions given as ra and dec in degrees (ICRS).
+        """
+        return self._check_pixels(*self._radec_to_pixels(ra, dec))
+
+    def _radec_to_pixels(self, ra: np.ndarray, dec: np.ndarray):
+        """
+        Convert ra and dec in degrees (ICRS) to (fractional) rows and columns
+        of the plane. If the mask's WCS is also in ICRS and degrees, the
+        positions go straight to the WCS without building a SkyCoord.
+        """
+        if self._celestial_wcs() is False:
+            y, x = utils.skycoord_to_pixel(SkyCoord(ra, dec, unit="deg"), self._wcs)
+        else:
+            y, x = self._icrs_wcs.all_world2pix(ra, dec, 0)
+        return x, y
+
+    def _pixels_to_radec(self, x: np.ndarray, y: np.ndarray):
+        # The inverse of _radec_to_pixels
+        if self._celestial_wcs() is False:
+            coords = utils.pixel_to_skycoord(y, x, self._wcs).icrs
+            return coords.ra.to_value("deg"), coords.dec.to_value("deg")
+        return self._icrs_wcs.all_pix2world(y, x, 0)
+
+    def _celestial_wcs(self) -> WCS | bool:
+        # The celestial part of the WCS if it is in ICRS and degrees
+        if self._icrs_wcs is None:
+            wcs = self._wcs.sub([WCSSUB_LONGITUDE, WCSSUB_LATITUDE])
+            is_icrs = (
+                wcs.naxis == 2
+                and utils.wcs_to_celestial_frame(wcs).name == "icrs"
+                and all(u.Unit(unit) == u.deg for unit in wcs.wcs.cunit)
+            )
+            self._icrs_wcs = wcs if is_icrs else False
+        return self._icrs_wcs
+
+    def _check_pixels(self, x: np.ndarray, y: np.ndarray):
         # The order of numpy axes is the opposite of the order
         # in fits images. All the data is being stored in
         # arrays, so we have to flip things here.
@@ -242,8 +536,7 @@ class _fitsMask(_mask):
         y = np.round(y, 0).astype(int)
         masked = np.ones(len(x), dtype=bool)
 
-        x_limit = self._mask.shape[0]
-        y_limit = self._mask.shape[1]
+        x_limit, y_limit = self._shape
 
         negative_check = (x < 0) | (y < 0)
         # Note: We already inverted indices above
@@ -252,14 +545,92 @@ class _fitsMask(_mask):
         to_skip = negative_check | x_limit_check | y_limit_check
 
         masked[to_skip] = False
-        pixel_values = self._mask[x[~to_skip], y[~to_skip]]
+        pixel_values = self._read_pixels(x[~to_skip], y[~to_skip])
         masked[~to_skip] = pixel_values > 0
         return ~masked
 
+    @property
+    def _shape(self) -> tuple[int, int]:
+        return self._mask.shape
+
+    def _read_pixels(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return self._mask[x, y]
+
+    def unmasked_fractions(
+        self, regions: list[BaseRegion], order: int
+    ) -> np.ndarray | None:
+        """
+        Count the pixels whose centers are in each region, and how many of them
+        are masked. Pixels off the edge of the plane count as unmasked, as they
+        do in evaluate. The pixels of many regions are looked up together, in
+        batches of up to FRACTION_BATCH pixels.
+        """
+        totals = np.zeros(len(regions))
+        masked = np.zeros(len(regions))
+        batch = []
+        size = 0
+        for index, region in enumerate(regions):
+            pixels = self._region_pixels(region)
+            if pixels is None:
+                return None
+            totals[index] = len(pixels[0])
+            batch.append((index, *pixels))
+            size += len(pixels[0])
+            if size >= FRACTION_BATCH:
+                self._count_masked(batch, masked)
+                batch = []
+                size = 0
+        self._count_masked(batch, masked)
+        return 1 - masked / np.maximum(totals, 1)
+
+    def _region_pixels(self, region: BaseRegion):
+        """
+        The pixels (as rows and columns, which may be off the plane) whose
+        centers are in a region. If the region is too small to hold any pixel
+        centers, the pixels around it are used. Returns None for regions
+        without a bounding cap, or that reach a pole.
+        """
+        cap = region.bounding_cap()
+        if cap is None:
+            return None
+        center, radius = cap
+        ra, dec = vector_to_lonlat(*center)
+        radius = np.degrees(radius)
+        if abs(dec) + radius >= 90:
+            return None
+        width = np.degrees(
+            np.arcsin(np.sin(np.radians(radius)) / np.cos(np.radians(dec)))
+        )
+        # The edges of the box around the cap, which isn't a box on the plane
+        t = np.linspace(-1, 1, 16)
+        edge_ra = ra + width * np.concatenate([t, t, -np.ones(16), np.ones(16)])
+        edge_dec = dec + radius * np.concatenate([-np.ones(16), np.ones(16), t, t])
+        x, y = self._radec_to_pixels(edge_ra, edge_dec)
+        x, y = np.mgrid[
+            int(np.floor(x.min())) - 1 : int(np.ceil(x.max())) + 2,
+            int(np.floor(y.min())) - 1 : int(np.ceil(y.max())) + 2,
+        ].reshape(2, -1)
+        ra, dec = self._pixels_to_radec(x, y)
+        inside = region.contains_vectors(np.column_stack(lonlat_to_vector(ra, dec)))
+        if not inside.any():
+            return x, y
+        return x[inside], y[inside]
+
+    def _count_masked(self, batch: list[tuple], masked: np.ndarray):
+        # Add up the masked pixels of a batch of regions, reading them all at once
+        if not batch:
+            return
+        owners = np.concatenate([np.full(len(x), i) for i, x, _ in batch])
+        x = np.concatenate([x for _, x, _ in batch])
+        y = np.concatenate([y for _, _, y in batch])
+        x_limit, y_limit = self._shape
+        on_plane = (x >= 0) & (y >= 0) & (x < x_limit) & (y < y_limit)
+        values = self._read_pixels(x[on_plane], y[on_plane]) > 0
+        masked += np.bincount(owners[on_plane], weights=values, minlength=len(masked))
+
     @singledispatchmethod
     def mask(self, catalog: Catalog, *args, **kwargs):
-        coords = catalog["coordinates"]
-        mask = self._check(coords)
+        mask = self._check_radec(*get_radec(catalog))
         return catalog[mask]
 
     def get_data_from_region(self, region: BaseRegion):
@@ -280,6 +651,139 @@ class _fitsMask(_mask):
         return coords[mask]
 
 
+class _lazyFitsMask(_fitsMask):
+    def __init__(self, path: Path, mask_key, wcs: WCS = None):
+        """
+        A fits mask plane that stays on disk. Positions are checked by reading
+        the tiles of the plane (LAZY_TILE_SIZE pixels on a side) that hold
+        them, one at a time, and the file is only open while it is being read,
+        so any number of these masks can be kept around.
+        """
+        self._path = Path(path)
+        self._mask_key = mask_key
+        with self._open() as hdul:
+            if wcs is None:
+                wcs = WCS(hdul[0].header)
+            header = hdul[mask_key].header
+            self._plane_shape = tuple(hdul[mask_key].shape)
+            self._pixel_nbytes = abs(header["BITPIX"]) // 8
+            self._header_nbytes = len(hdul[0].header.tostring())
+            if mask_key != 0:
+                self._header_nbytes += len(header.tostring())
+        super().__init__(None, wcs, None)
+
+    def _open(self) -> HDUList:
+        return fits.open(self._path, memmap=True, lazy_load_hdus=True)
+
+    @property
+    def _shape(self) -> tuple[int, int]:
+        return self._plane_shape
+
+    def _read_window(self, rows: slice, columns: slice) -> np.ndarray:
+        # Sections read just the requested pixels, for compressed images too
+        with self._open() as hdul:
+            return np.array(hdul[self._mask_key].section[rows, columns])
+
+    def _read_pixels(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        values = np.zeros(len(x), dtype=bool)
+        if len(x) == 0:
+            return values
+        # Group the pixels by tile, and read the part of each tile that holds them
+        tiles = (x // LAZY_TILE_SIZE) * (self._shape[1] // LAZY_TILE_SIZE + 1) + (
+            y // LAZY_TILE_SIZE
+        )
+        order = np.argsort(tiles, kind="stable")
+        starts = np.flatnonzero(np.diff(tiles[order])) + 1
+        with self._open() as hdul:
+            section = hdul[self._mask_key].section
+            for group in np.split(order, starts):
+                tx, ty = x[group], y[group]
+                x0, y0 = tx.min(), ty.min()
+                window = section[x0 : tx.max() + 1, y0 : ty.max() + 1]
+                values[group] = np.asarray(window)[tx - x0, ty - y0] > 0
+        return values
+
+    def estimate_size(self) -> int:
+        """
+        The headers, and the largest window of the plane read at once (one
+        tile). The rest of the plane is never held in memory.
+        """
+        rows, columns = self._shape
+        tile = min(rows, LAZY_TILE_SIZE) * min(columns, LAZY_TILE_SIZE)
+        return self._header_nbytes + tile * self._pixel_nbytes
+
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        # The plane is read back from the file, so no arrays are needed
+        meta = {
+            "type": "fits_file",
+            "path": str(self._path),
+            "mask_key": self._mask_key,
+            "header": self._wcs.to_header_string(),
+        }
+        return meta, {}
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        wcs = WCS(Header.fromstring(meta["header"]))
+        return cls(meta["path"], meta["mask_key"], wcs)
+
+    def get_data_from_region(self, region: BaseRegion):
+        """
+        Read the window of the plane that covers a region into memory.
+        """
+        bounds = [b * u.deg for b in region.bounds]
+        center = SkyCoord((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2)
+        size = (bounds[2] - bounds[0], bounds[3] - bounds[1])
+        # The cutout is only used to find the window, so it is made from a
+        # placeholder array that takes up no memory
+        placeholder = np.broadcast_to(np.zeros(1, dtype=bool), self._shape)
+        try:
+            cutout = Cutout2D(placeholder, center, size, wcs=self._wcs, copy=False)
+        except NoOverlapError:
+            return None
+        window = self._read_window(*cutout.slices_original)
+        return _fitsMask(None, cutout.wcs, window)
+
+
+class _packedMask(_fitsMask):
+    def __init__(self, path: Path):
+        """
+        A fits mask plane prepared by "heinlein prep -d mask" (see
+        heinlein.dtypes.packed). The plane is stored as tiles of packed bits and
+        read through a memory map, so looking up a set of positions only reads
+        the bytes that hold them.
+        """
+        meta, index, tiles = packed.open_store(path)
+        super().__init__(None, WCS(Header.fromstring(meta["header"])), None)
+        self._path = Path(path)
+        self._index = index
+        self._tiles = tiles
+        self._plane_shape = tuple(meta["shape"])
+
+    @property
+    def _shape(self) -> tuple[int, int]:
+        return self._plane_shape
+
+    def _read_pixels(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return packed.read_pixels(self._index, self._tiles, x, y)
+
+    def estimate_size(self) -> int:
+        # The packed plane is the tile index and the (memory mapped) tiles
+        return self._index.nbytes + self._tiles.nbytes
+
+    def get_data_from_region(self, region: BaseRegion):
+        # Packed planes are small enough to use whole
+        return self
+
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        # The plane is read back from the store, so no arrays are needed
+        return {"type": "packed", "path": str(self._path)}, {}
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        return cls(meta["path"])
+
+
 class _regionMask(_mask):
     def __init__(self, mask: Iterable[BaseRegion], *args, **kwargs):
         """
@@ -294,7 +798,7 @@ class _regionMask(_mask):
 
     @singledispatchmethod
     def mask(self, catalog: Catalog):
-        cmask = self.generate_mask(catalog["coordinates"])
+        cmask = self._generate_mask(*get_radec(catalog))
         return catalog[cmask]
 
     @mask.register
@@ -305,19 +809,161 @@ class _regionMask(_mask):
     def estimate_size(self) -> int:
         return self._geo_list.nbytes
 
+    def coverage_bounds(self) -> tuple:
+        return tuple(shapely.total_bounds(self._geo_list))
+
     def generate_mask(self, coords: SkyCoord):
         ra = coords.ra.to_value("deg")
         dec = coords.dec.to_value("deg")
-        points = MultiPoint(np.dstack(lonlat_to_vector(ra, dec))[0])
-        mask = self._check(points)
-        return mask
+        return self._generate_mask(ra, dec)
+
+    def evaluate(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        return self._generate_mask(ra, dec)
+
+    def _generate_mask(self, ra: np.ndarray, dec: np.ndarray):
+        # The regions are flat shapes in ra/dec (in degrees)
+        points = shapely.points(np.asarray(ra, float), np.asarray(dec, float))
+        return self._check(points)
 
-    def _check(self, points):
-        mask = np.ones(get_num_geometries(points), dtype=bool)
-        for index, p in enumerate(points.geoms):
-            a = self._geo_tree.query(p)
-            for geo in a:
-                if self._geo_list[geo].contains(p):
-                    mask[index] = False
-                    break
+    def _check(self, points: np.ndarray) -> np.ndarray:
+        """
+        Find the points that are not inside any of the regions, with a single
+        bulk query of the tree.
+        """
+        mask = np.ones(len(points), dtype=bool)
+        inside, _ = self._geo_tree.query(points, predicate="within")
+        mask[inside] = False
         return mask
+
+    def unmasked_fractions(self, regions: list[BaseRegion], order: int) -> np.ndarray:
+        """
+        Intersect the outline of each region with the shapes that overlap it.
+        Like the shapes, the outlines are flat in ra/dec, and areas are taken
+        in that plane.
+        """
+        outlines = np.array([_region_outline(r) for r in regions], dtype=object)
+        fractions = np.ones(len(regions))
+        if len(outlines) == 0:
+            return fractions
+        hits, shapes = self._geo_tree.query(outlines, predicate="intersects")
+        groups = np.split(shapes, np.flatnonzero(np.diff(hits)) + 1)
+        for index, group in zip(np.unique(hits), groups):
+            outline = outlines[index]
+            masked = shapely.intersection(
+                shapely.union_all(self._geo_list[group]), outline
+            )
+            fractions[index] -= masked.area / outline.area
+        return fractions
+
+
+class _mocMask(_mask):
+    def __init__(self, starts: np.ndarray, ends: np.ndarray, depth: int):
+        """
+        Implementation for masks stored as multi-order coverage maps (see
+        heinlein.dtypes.moc). Positions inside the coverage are masked. The
+        coverage is kept as sorted ranges of pixels at the deepest order.
+        """
+        super().__init__(None)
+        self._starts, self._ends = moc.merge_ranges(starts, ends)
+        self._depth = depth
+
+    @classmethod
+    def from_uniq(cls, uniq: np.ndarray, depth: int = None):
+        if depth is None:
+            depth = int(moc.uniq_orders(uniq).max()) if len(uniq) else 0
+        return cls(*moc.uniq_to_ranges(uniq, depth), depth)
+
+    @staticmethod
+    def is_moc(hdul: HDUList) -> bool:
+        return any(
+            isinstance(hdu, fits.BinTableHDU) and "UNIQ" in hdu.columns.names
+            for hdu in hdul
+        )
+
+    @classmethod
+    def from_hdu(cls, hdul: HDUList, *args, **kwargs):
+        """
+        Read a MOC from a FITS file in the standard (IVOA) format, a table
+        with a UNIQ column.
+        """
+        hdu = next(
+            h
+            for h in hdul
+            if isinstance(h, fits.BinTableHDU) and "UNIQ" in h.columns.names
+        )
+        return cls.from_uniq(hdu.data["UNIQ"], hdu.header.get("MOCORDER"))
+
+    def to_hdu(self) -> HDUList:
+        table = fits.BinTableHDU.from_columns(
+            [fits.Column(name="UNIQ", format="K", array=self.uniq)]
+        )
+        table.header["PIXTYPE"] = "HEALPIX"
+        table.header["ORDERING"] = "NUNIQ"
+        table.header["COORDSYS"] = "C"
+        table.header["MOCORDER"] = self._depth
+        return HDUList([fits.PrimaryHDU(), table])
+
+    @property
+    def uniq(self) -> np.ndarray:
+        return moc.ranges_to_uniq(self._starts, self._ends, self._depth)
+
+    def area(self) -> float:
+        """
+        The masked area, in square degrees.
+        """
+        return moc.area(self._starts, self._ends, self._depth)
+
+    def evaluate(self, ra: np.ndarray, dec: np.ndarray) -> np.ndarray:
+        return ~moc.contains(self._starts, self._ends, self._depth, ra, dec)
+
+    def unmasked_fractions(self, regions: list[BaseRegion], order: int) -> np.ndarray:
+        """
+        Cut each region into cells at an order (or the depth of the MOC, if that
+        is lower), and count exactly how much of each cell the MOC covers.
+        """
+        order = min(order, self._depth)
+        if not regions:
+            return np.zeros(0)
+        cells = [_region_cells(region, order) for region in regions]
+        counts = np.array([len(c) for c in cells])
+        covered = moc.covered_pixels(
+            self._starts, self._ends, self._depth, np.concatenate(cells), order
+        )
+        masked = _group_sums(covered, counts) / (counts * 4.0 ** (self._depth - order))
+        return 1 - masked
+
+    def to_moc(self, order: int, bounds: tuple = None) -> "_mocMask":
+        # Going to a lower order masks every cell that is partly masked
+        shift = 2 * abs(order - self._depth)
+        if order >= self._depth:
+            return _mocMask(self._starts << shift, self._ends << shift, order)
+        ends = -(-self._ends >> shift)
+        return _mocMask(self._starts >> shift, ends, order)
+
+    def estimate_size(self) -> int:
+        return self._starts.nbytes + self._ends.nbytes
+
+    def to_arrays(self) -> tuple[dict, dict[str, np.ndarray]]:
+        meta = {"type": "moc", "depth": self._depth}
+        return meta, {"starts": self._starts, "ends": self._ends}
+
+    @classmethod
+    def from_arrays(cls, meta: dict, arrays: dict[str, np.ndarray]):
+        return cls(arrays["starts"], arrays["ends"], meta["depth"])
+
+    @singledispatchmethod
+    def mask(self, catalog: Catalog, *args, **kwargs):
+        return catalog[self.evaluate(*get_radec(catalog))]
+
+    @mask.register
+    def _(self, coords: SkyCoord):
+        return coords[self.evaluate(*_get_radec(coords))]
+
+
+# Mask types that can be rebuilt by Mask.from_arrays
+ARRAY_MASK_TYPES = {
+    "fits": _fitsMask,
+    "fits_file": _lazyFitsMask,
+    "moc": _mocMask,
+    "packed": _packedMask,
+}
@@ -0,0 +1,169 @@
+"""
+Multi-order coverage maps (MOCs). A MOC is a set of HEALPix cells (NEST
+ordering) of different orders. Cells are identified by their NUNIQ number,
+4 * 4**order + pixel. Internally, a MOC is a sorted list of non-overlapping
+ranges of pixels at a single (deep) order, so checking a point is one
+ang2pix and one binary search.
+"""
+from __future__ import annotations
+
+import healpy
+import numpy as np
+
+# Deepest order a MOC can have. Pixels at order 29 still fit in an int64.
+MAX_ORDER = 29
+
+
+def merge_ranges(starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sort a set of half-open ranges [start, end), and merge the ones that
+    overlap or touch.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+    if len(starts) == 0:
+        return starts, ends
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], np.maximum.accumulate(ends[order])
+    # A new range begins wherever there is a gap after the ranges before it
+    new = np.r_[True, starts[1:] > ends[:-1]]
+    last = np.r_[np.flatnonzero(new)[1:] - 1, len(starts) - 1]
+    return starts[new], ends[last]
+
+
+def pixels_to_ranges(
+    pixels: np.ndarray, order: int, depth: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the ranges of pixels at a depth covered by a set of pixels at a
+    (lower) order.
+    """
+    shift = 2 * (depth - order)
+    pixels = np.asarray(pixels, dtype=np.int64)
+    return merge_ranges(pixels << shift, (pixels + 1) << shift)
+
+
+def uniq_orders(uniq: np.ndarray) -> np.ndarray:
+    """
+    Get the order of each of a set of NUNIQ cells.
+    """
+    uniq = np.asarray(uniq, dtype=np.int64)
+    orders = np.full(len(uniq), -1, dtype=np.int64)
+    for order in range(MAX_ORDER + 1):
+        orders[(uniq >= 4 << (2 * order)) & (uniq < 16 << (2 * order))] = order
+    if (orders < 0).any():
+        raise ValueError("Invalid NUNIQ values")
+    return orders
+
+
+def uniq_to_ranges(uniq: np.ndarray, depth: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert a set of NUNIQ cells into ranges of pixels at a depth. The depth
+    must be at least the order of the deepest cell.
+    """
+    uniq = np.asarray(uniq, dtype=np.int64)
+    orders = uniq_orders(uniq)
+    if len(uniq) and orders.max() > depth:
+        raise ValueError(f"MOC has cells at order {orders.max()}, deeper than {depth}")
+    starts = []
+    ends = []
+    for order in np.unique(orders):
+        pixels = uniq[orders == order] - (4 << (2 * int(order)))
+        shift = 2 * (depth - int(order))
+        starts.append(pixels << shift)
+        ends.append((pixels + 1) << shift)
+    if not starts:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return merge_ranges(np.concatenate(starts), np.concatenate(ends))
+
+
+def ranges_to_uniq(starts: np.ndarray, ends: np.ndarray, depth: int) -> np.ndarray:
+    """
+    Convert ranges of pixels at a depth into the smallest set of NUNIQ cells
+    that covers them exactly, using the largest cells possible.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    cells = []
+    for order in range(depth + 1):
+        size = np.int64(1) << (2 * (depth - order))
+        # Cells of this order that fit in each range. The parts of the ranges
+        # outside of them are left for the deeper orders.
+        first = -((-starts) // size)
+        last = ends // size
+        fits = first < last
+        for a, b in zip(first[fits], last[fits]):
+            cells.append(np.arange(a, b, dtype=np.int64) + (4 << (2 * order)))
+        inner_starts, inner_ends = first[fits] * size, last[fits] * size
+        starts, ends = (
+            np.concatenate([starts[~fits], starts[fits], inner_ends]),
+            np.concatenate([ends[~fits], inner_starts, ends[fits]]),
+        )
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+    if not cells:
+        return np.zeros(0, np.int64)
+    return np.sort(np.concatenate(cells))
+
+
+def contains(
+    starts: np.ndarray, ends: np.ndarray, depth: int, ra: np.ndarray, dec: np.ndarray
+) -> np.ndarray:
+    """
+    Check which positions (ra and dec in degrees) fall in a set of ranges.
+    """
+    pixels = healpy.ang2pix(1 << depth, ra, dec, nest=True, lonlat=True)
+    index = np.searchsorted(starts, pixels, side="right") - 1
+    inside = index >= 0
+    inside[inside] = pixels[inside] < ends[index[inside]]
+    return inside
+
+
+def covered_pixels(
+    starts: np.ndarray, ends: np.ndarray, depth: int, cells: np.ndarray, order: int
+) -> np.ndarray:
+    """
+    Count the pixels at a depth that a set of ranges covers in each of a set of
+    cells at a (lower) order.
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    if len(starts) == 0:
+        return np.zeros(len(cells), dtype=np.int64)
+    shift = 2 * (depth - order)
+    # Number of covered pixels below each pixel
+    total = np.r_[0, np.cumsum(ends - starts)]
+
+    def below(pixels):
+        index = np.searchsorted(starts, pixels, side="right")
+        over = np.maximum(ends[np.maximum(index - 1, 0)] - pixels, 0)
+        return total[index] - np.where(index > 0, over, 0)
+
+    return below((cells + 1) << shift) - below(cells << shift)
+
+
+def area(starts: np.ndarray, ends: np.ndarray, depth: int) -> float:
+    """
+    The area covered by a set of ranges, in square degrees.
+    """
+    n_pixels = int(np.sum(ends - starts))
+    return n_pixels * healpy.nside2pixarea(1 << depth, degrees=True)
+
+
+def cells_in_bounds(bounds: tuple, order: int) -> np.ndarray:
+    """
+    Get the pixels at an order that overlap a box (ra1, dec1, ra2, dec2, in
+    degrees). The box is padded a little, so it may include a few extra cells.
+    """
+    ra1, dec1, ra2, dec2 = bounds
+    nside = 1 << order
+    # The sides of the query polygon are great circles rather than lines of
+    # constant dec, so the box is padded by a cell and a bit
+    pad = np.degrees(healpy.nside2resol(nside)) + 0.01 * max(ra2 - ra1, dec2 - dec1)
+    ra1, ra2 = ra1 - pad, ra2 + pad
+    dec1, dec2 = max(dec1 - pad, -89.999), min(dec2 + pad, 89.999)
+    vertices = healpy.ang2vec(
+        np.array([ra1, ra2, ra2, ra1]), np.array([dec1, dec1, dec2, dec2]), lonlat=True
+    )
+    return healpy.query_polygon(nside, vertices, inclusive=True, nest=True)
@@ -0,0 +1,154 @@
+"""
+Bit-packed mask planes. A plane is thresholded to booleans (masked if the
+pixel is > 0), split into square tiles and packed 8 pixels per byte. Tiles
+that are entirely masked or entirely unmasked are only recorded in the tile
+index. A store is a directory (reached through a symbolic link, see
+write_store) with the packed tiles, the index and the WCS of the plane, and
+is read through memory maps, so checking a set of pixels only
+reads the bytes that hold them.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+# Suffix of the directories packed planes are stored in
+STORE_SUFFIX = ".hmask"
+# Bumped when the layout of stores changes
+VERSION = 1
+# Side of the tiles, in pixels. Must be a multiple of 8.
+TILE_SIZE = 256
+# Tile index values for tiles that aren't stored
+EMPTY_TILE = -1
+FULL_TILE = -2
+
+
+def pack_plane(plane: np.ndarray, tile_size: int = TILE_SIZE):
+    """
+    Pack a mask plane into tiles. Returns the tile index, with the position
+    of each tile in the packed tiles (or EMPTY_TILE/FULL_TILE), and the
+    packed tiles as a (n, tile_size, tile_size / 8) array of bytes.
+    """
+    if tile_size % 8:
+        raise ValueError("The tile size must be a multiple of 8")
+    rows, columns = plane.shape
+    n_rows, n_columns = -(-rows // tile_size), -(-columns // tile_size)
+    index = np.full((n_rows, n_columns), EMPTY_TILE, dtype=np.int32)
+    tiles = []
+    for tile_row in range(n_rows):
+        # One band of tiles is thresholded at a time, to keep memory down
+        band = np.zeros((tile_size, n_columns * tile_size), dtype=bool)
+        r0 = tile_row * tile_size
+        data = plane[r0 : r0 + tile_size]
+        band[: data.shape[0], :columns] = np.asarray(data) > 0
+        band = band.reshape(tile_size, n_columns, tile_size).swapaxes(0, 1)
+        counts = band.sum(axis=(1, 2))
+        index[tile_row, counts == tile_size**2] = FULL_TILE
+        for tile_column in np.flatnonzero((counts > 0) & (counts < tile_size**2)):
+            index[tile_row, tile_column] = len(tiles)
+            tiles.append(np.packbits(band[tile_column], axis=1))
+    if tiles:
+        tiles = np.stack(tiles)
+    else:
+        tiles = np.zeros((0, tile_size, tile_size // 8), dtype=np.uint8)
+    return index, tiles
+
+
+def read_pixels(
+    index: np.ndarray, tiles: np.ndarray, rows: np.ndarray, columns: np.ndarray
+) -> np.ndarray:
+    """
+    Look up a set of pixels (all inside the plane) in a packed plane. Returns
+    True for the masked pixels.
+    """
+    tile_size = tiles.shape[1]
+    tile = index[rows // tile_size, columns // tile_size]
+    values = tile == FULL_TILE
+    stored = tile >= 0
+    r = rows[stored] % tile_size
+    c = columns[stored] % tile_size
+    # Bits are packed with the first pixel in the highest bit
+    byte = tiles[tile[stored], r, c // 8]
+    values[stored] = (byte >> (7 - c % 8)) & 1
+    return values
+
+
+def write_store(
+    path: Path, plane: np.ndarray, header: str, tile_size: int = TILE_SIZE
+) -> Path:
+    """
+    Pack a plane and write it to a store directory. header is the WCS of the
+    plane, as a FITS header string. The store is written to a hidden directory
+    next to path, and path is a symbolic link to it. Rewriting a store replaces
+    the link in one step, so readers never see a partial (or missing) store.
+    """
+    path = Path(path)
+    index, tiles = pack_plane(plane, tile_size)
+    staging = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{path.name}-"))
+    try:
+        np.save(staging / "index.npy", index)
+        np.save(staging / "tiles.npy", tiles)
+        meta = {
+            "version": VERSION,
+            "shape": list(plane.shape),
+            "tile_size": tile_size,
+            "header": header,
+        }
+        with open(staging / "meta.json", "w") as f:
+            json.dump(meta, f)
+        _link_store(path, staging)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return path
+
+
+def _link_store(path: Path, target: Path):
+    # Point path at a new store directory, and remove the one it replaces
+    old = path.resolve() if path.is_symlink() else None
+    link = target.with_name(target.name + ".link")
+    os.symlink(target.name, link, target_is_directory=True)
+    try:
+        if path.is_dir() and not path.is_symlink():
+            # A store written in place, which can't be swapped in one step
+            old = path.with_name(target.name + ".old")
+            os.replace(path, old)
+        os.replace(link, path)
+    except BaseException:
+        link.unlink(missing_ok=True)
+        raise
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def open_store(path: Path) -> tuple[dict, np.ndarray, np.ndarray]:
+    """
+    Open a store. Returns its metadata, its tile index and its (memory mapped)
+    packed tiles. If the store is rewritten while it is being opened, the new
+    one is opened instead.
+    """
+    path = Path(path)
+    while True:
+        # Everything is read from the directory the link points at now, so
+        # the parts of a store always come from the same write
+        target = path.resolve()
+        try:
+            return _open_directory(target)
+        except FileNotFoundError:
+            if path.resolve() == target:
+                raise
+
+
+def _open_directory(path: Path) -> tuple[dict, np.ndarray, np.ndarray]:
+    with open(path / "meta.json") as f:
+        meta = json.load(f)
+    if meta.get("version") != VERSION:
+        raise ValueError(f"Mask store {path} was written by a different version")
+    index = np.load(path / "index.npy")
+    tiles = np.load(path / "tiles.npy", mmap_mode="r")
+    return meta, index, tiles
@@ -12,6 +12,7 @@ cli.add_command(cmds.add)
 cli.add_command(cmds.remove)
 cli.add_command(cmds.get)
 cli.add_command(cmds.prep)
+cli.add_command(cmds.sidecar)
 
 if __name__ == "__main__":
     cli()
@@ -1,25 +1,85 @@
-from collections import OrderedDict
+import threading
+import time
 from collections.abc import Iterable
-from copy import copy
-from functools import singledispatchmethod
+from contextlib import contextmanager
+from functools import singledispatchmethod, wraps
 
 import heinlein
+from heinlein.manager.policy import get_policy
+from heinlein.manager.spill import SpillCache, get_spill_location
+from heinlein.manager.stats import CacheStats
 
 CURRENT_CACHES = {}
+_CACHES_LOCK = threading.Lock()
 
 
-def get_cache(dataset: str):
+def get_cache(dataset: str, backend: str = None):
+    """
+    Get the cache for a given dataset. The backend can be "local", for a cache
+    that lives in this process, or "shared", for a cache that shares data with
+    other processes working on the same dataset. If no backend is given, the
+    CACHE_BACKEND option is used.
+    """
     max_size = heinlein.get_option("CACHE_SIZE")
-    if dataset not in CURRENT_CACHES:
-        CURRENT_CACHES[dataset] = Cache(max_size)
-    else:
-        CURRENT_CACHES[dataset].change_max_size(max_size)
-    return CURRENT_CACHES[dataset]
+    policy = heinlein.get_option("CACHE_POLICY")
+    if backend is None:
+        backend = heinlein.get_option("CACHE_BACKEND")
+    with _CACHES_LOCK:
+        if dataset not in CURRENT_CACHES or CURRENT_CACHES[dataset].backend != backend:
+            CURRENT_CACHES[dataset] = make_cache(dataset, backend, max_size, policy)
+        else:
+            cache = CURRENT_CACHES[dataset]
+            cache.change_max_size(max_size)
+            if cache.policy.name != policy:
+                cache.set_policy(policy)
+            spill_size = heinlein.get_option("CACHE_SPILL_SIZE")
+            if cache.spill is not None and spill_size:
+                cache.spill.change_max_size(spill_size)
+            else:
+                cache.spill = get_spill_cache(dataset)
+        return CURRENT_CACHES[dataset]
+
+
+def make_cache(dataset: str, backend: str, max_size: float, policy: str = "lru"):
+    spill = get_spill_cache(dataset)
+    if backend == "local":
+        return Cache(max_size, spill=spill, policy=policy)
+    elif backend == "shared":
+        from heinlein.manager.shared import SharedMemoryCache
+
+        return SharedMemoryCache(dataset, max_size, spill=spill, policy=policy)
+    raise ValueError(f"Unknown cache backend {backend}")
+
+
+def get_spill_cache(dataset: str):
+    spill_size = heinlein.get_option("CACHE_SPILL_SIZE")
+    if not spill_size:
+        return None
+    location = heinlein.get_option("CACHE_SPILL_DIR") or get_spill_location()
+    return SpillCache(location / dataset, spill_size)
 
 
-def clear_cache(dataset: str):
+def synchronized(method):
+    """
+    Run a Cache method while holding the cache's lock.
+    """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def clear_cache(dataset: str, spill: bool = False):
+    """
+    Clear the cache for a given dataset. If spill is True, the data held
+    in memory is moved to the on-disk tier (if it is enabled) rather than
+    being discarded. Otherwise both tiers are emptied.
+    """
     if dataset in CURRENT_CACHES:
-        CURRENT_CACHES[dataset].empty()
+        CURRENT_CACHES[dataset].empty(spill)
     else:
         raise ValueError(f"No cache for dataset {dataset} found in memory")
 
@@ -33,59 +93,132 @@ class Cache:
 
     The cache thinks in terms of survey regions. A single survey region may
     have multiple objects associated with it. When the cache evicts objects,
-    it evicts all objects associated with a given survey region with a LRU
-    policy.
+    it evicts all objects associated with a given survey region. Which region
+    is evicted is decided by an eviction policy (see heinlein.manager.policy).
+    Regions can be pinned, in which case they will never be evicted.
 
     The cache assumes immutability of the underlying data. This means that if
     it recieves a request to add a piece of data that is already in the cache,
     it will raise an error.
+
+    If a spill cache is provided, evicted regions are written to disk instead
+    of being discarded, and are served from there when they are requested again.
+
+    All public methods are safe to call from multiple threads.
     """
 
-    def __init__(self, max_size: float = 4e9):
+    backend = "local"
+
+    def __init__(
+        self, max_size: float = 4e9, spill: SpillCache = None, policy: str = "lru"
+    ):
         self.max_size = max_size  # default to 4 GB
-        self.cache = OrderedDict()
+        self.cache = {}
         self.sizes = {}
+        self.costs = {}
         self.size = 0
         self.ref_counts = {}
+        self.spill = spill
+        self.policy = get_policy(policy)
+        self.pinned = set()
+        self.stats = CacheStats()
+        self._lock = threading.RLock()
 
-    def add(self, data):
+    @synchronized
+    def add(self, data, costs: dict = None):
         """
         Add objects to the cache. If the cache is full, evict objects until the
-        object can be added.
+        object can be added. Costs can optionally be provided as a dictionary
+        of region name -> time (in seconds) it took to load the region. These
+        are used by cost-aware eviction policies.
         """
+        costs = costs or {}
         data_to_cache = switch_major_key(data)
-        total_size = 0
-        to_update = {}
-        new_refs = copy(self.ref_counts)
-        objects_to_store = set()
+        new_objects = {}
+        new_refs = {}
         for region_name, region_data in data_to_cache.items():
-            to_update[region_name] = {}
             for dtype, data in region_data.items():
                 if self.has_data(region_name, dtype):
                     raise ValueError(
                         "Cannot add data to the cache that is already in the cache"
                     )
-                if id(data) not in objects_to_store:
-                    objects_to_store.add(id(data))
+                new_objects[id(data)] = data
+                new_refs[id(data)] = new_refs.get(id(data), 0) + 1
 
-                nrefs = new_refs.get(id(data), 0)
-                if nrefs == 0:
-                    total_size += data.estimate_size()
-                new_refs[id(data)] = nrefs + 1
-                to_update[region_name][dtype] = data
-        self.make_space(total_size)
+        def size_of_new_objects():
+            return sum(
+                data.estimate_size()
+                for did, data in new_objects.items()
+                if did not in self.ref_counts
+            )
 
-        for region_name, region_data in to_update.items():
-            try:
-                self.cache[region_name].update(region_data)
-            except KeyError:
-                self.cache[region_name] = region_data
+        self.make_space(size_of_new_objects())
+        # Making space may have evicted objects that are being added again
+        total_size = size_of_new_objects()
+
+        for region_name, region_data in data_to_cache.items():
+            is_new = region_name not in self.cache
+            self.cache.setdefault(region_name, {}).update(region_data)
             self.sizes[region_name] = sum(
-                [data.estimate_size() for data in region_data.values()]
+                [data.estimate_size() for data in self.cache[region_name].values()]
+            )
+            self.costs[region_name] = self.costs.get(region_name, 0) + costs.get(
+                region_name, 0
             )
+            if region_name in self.pinned:
+                continue
+            region_args = (self.sizes[region_name], self._cost(region_name))
+            if is_new:
+                self.policy.insert(region_name, *region_args)
+            else:
+                self.policy.update(region_name, *region_args)
+
+        for did, nrefs in new_refs.items():
+            self.ref_counts[did] = self.ref_counts.get(did, 0) + nrefs
         self.size += total_size
-        self.ref_counts = new_refs
 
+    @synchronized
+    def replace(self, data, costs: dict = None):
+        """
+        Add objects to the cache, replacing any objects that are already cached
+        for the same region and data type. This is used when a cached object is
+        superseded by a more complete one (e.g. one with more columns).
+        """
+        for dtype, region_data in data.items():
+            for region_name in region_data:
+                self._discard(region_name, dtype)
+        self.add(data, costs)
+
+    def _discard(self, region_name: str, dtype: str):
+        if self.spill is not None:
+            self.spill.discard(region_name, dtype)
+        if not self.has_data(region_name, dtype):
+            return
+        data = self.cache[region_name].pop(dtype)
+        self._release(region_name, {dtype: data})
+        self.ref_counts[id(data)] -= 1
+        if self.ref_counts[id(data)] == 0:
+            del self.ref_counts[id(data)]
+            self.size -= data.estimate_size()
+        if self.cache[region_name]:
+            self.sizes[region_name] = sum(
+                [data.estimate_size() for data in self.cache[region_name].values()]
+            )
+        else:
+            # The load cost is kept, it still applies to the replacement
+            del self.cache[region_name]
+            self.sizes.pop(region_name)
+            self.policy.remove(region_name)
+
+    @synchronized
+    def peek(self, region_name: str, dtype: str):
+        """
+        Get an object from memory without counting it as a hit or a use, or
+        None if it isn't there.
+        """
+        return self.cache.get(region_name, {}).get(dtype)
+
+    @synchronized
     def change_max_size(self, new_size: float):
         if new_size > self.size:
             self.max_size = new_size
@@ -96,6 +229,16 @@ class Cache:
                 f". Requested: {new_size}, Current size: {self.size}/{self.max_size}"
             )
 
+    @synchronized
+    def set_policy(self, policy: str):
+        self.policy = get_policy(policy)
+        for region_name in self.cache:
+            if region_name not in self.pinned:
+                self.policy.insert(
+                    region_name, self.sizes[region_name], self._cost(region_name)
+                )
+
+    @synchronized
     def make_space(self, needed_space: int):
         if needed_space > self.max_size:
             raise MemoryError(
@@ -103,62 +246,165 @@ class Cache:
                 f". Requested: {needed_space}, Cache size: {self.max_size}"
             )
 
-        current_space = self.max_size - self.size
-        if needed_space < current_space:
-            return True  # we have enough space
-
-        space_to_free = needed_space - current_space
-        while space_to_free > 0:
-            region_name, region_data = self.cache.popitem()
-            region_space = self.sizes.pop(region_name)
-            data_ids = [id(data) for data in region_data.values()]
-            for did in data_ids:
-                self.ref_counts[did] -= 1
-                if self.ref_counts[did] == 0:
-                    space_to_free -= region_space
-                    self.size -= region_space
-                    del region_data
+        while self.size + needed_space > self.max_size:
+            try:
+                region_name = self.policy.evict()
+            except KeyError:
+                raise MemoryError(
+                    "Unable to make space in the cache, all remaining regions "
+                    f"are pinned. Requested: {needed_space}, Current size: "
+                    f"{self.size}/{self.max_size}"
+                )
+            size_before = self.size
+            region_data = self._remove_region(region_name)
+            self.stats.record_eviction(size_before - self.size)
+            self._spill_region(region_name, region_data)
+            self._release(region_name, region_data)
         return True
 
-    def empty(self):
-        self.cache = OrderedDict()
+    def _remove_region(self, region_name: str) -> dict:
+        region_data = self.cache.pop(region_name)
+        self.sizes.pop(region_name)
+        self.costs.pop(region_name, None)
+        self.policy.remove(region_name)
+        for data in region_data.values():
+            self.ref_counts[id(data)] -= 1
+            if self.ref_counts[id(data)] == 0:
+                del self.ref_counts[id(data)]
+                self.size -= data.estimate_size()
+        return region_data
+
+    def _cost(self, region_name: str) -> float:
+        # Regions added without a known cost are treated as costing 1 second
+        return self.costs.get(region_name) or 1.0
+
+    def _spill_region(self, region_name: str, region_data: dict):
+        if self.spill is None:
+            return
+        for dtype, data in region_data.items():
+            self.spill.put(region_name, dtype, data)
+
+    def _release(self, region_name: str, region_data: dict):
+        """
+        Called whenever a region leaves the in-memory cache. Backends that hold
+        resources outside of the objects themselves can free them here.
+        """
+        pass
+
+    @synchronized
+    def pin(self, region_names: Iterable[str]):
+        """
+        Pin regions in the cache. Pinned regions are never evicted, until they
+        are unpinned. Regions that are not in the cache yet can also be pinned,
+        and will be pinned as soon as they are added.
+        """
+        for region_name in region_names:
+            self.pinned.add(region_name)
+            self.policy.remove(region_name)
+
+    @synchronized
+    def unpin(self, region_names: Iterable[str]):
+        for region_name in region_names:
+            if region_name not in self.pinned:
+                continue
+            self.pinned.remove(region_name)
+            if region_name in self.cache:
+                self.policy.insert(
+                    region_name, self.sizes[region_name], self._cost(region_name)
+                )
+
+    @contextmanager
+    def pinning(self, region_names: Iterable[str]):
+        """
+        Pin regions for the duration of a with block
+        """
+        region_names = set(region_names) - self.pinned
+        self.pin(region_names)
+        try:
+            yield self
+        finally:
+            self.unpin(region_names)
+
+    @synchronized
+    def empty(self, spill: bool = False):
+        for region_name, region_data in self.cache.items():
+            if spill:
+                self._spill_region(region_name, region_data)
+            self._release(region_name, region_data)
+        if not spill and self.spill is not None:
+            self.spill.empty()
+        self.cache = {}
         self.sizes = {}
+        self.costs = {}
         self.size = 0
+        self.ref_counts = {}
+        self.policy = get_policy(self.policy.name)
 
+    @synchronized
     def drop(self, region_names):
         for region_name in region_names:
             if region_name in self.cache:
-                region_space = self.sizes.pop(region_name)
-                self.size -= region_space
-                del self.cache[region_name]
+                self._release(region_name, self._remove_region(region_name))
+        if self.spill is not None:
+            self.spill.drop(region_names)
 
     @singledispatchmethod
+    @synchronized
     def get(self, region_name: str, dtypes: Iterable):
-        if region_name not in self.cache:
-            raise KeyError("Region not in cache")
+        start = time.perf_counter()
         if isinstance(dtypes, str):
             dtypes = {dtypes}
         elif not isinstance(dtypes, set):
             dtypes = set(dtypes)
+        self._restore(region_name, dtypes)
+        if region_name not in self.cache:
+            for dtype in dtypes:
+                self.stats.record_miss(region_name, dtype)
+            raise KeyError("Region not in cache")
 
         dtypes_in_cache = set(self.cache[region_name].keys())
         dtypes_to_get = dtypes.intersection(dtypes_in_cache)
+        for dtype in dtypes - dtypes_to_get:
+            self.stats.record_miss(region_name, dtype)
         if not dtypes_to_get:
             raise ValueError("None of the requested objects are in the cache")
 
-        self.cache.move_to_end(region_name, last=False)
-        return {dtype: self.cache[region_name][dtype] for dtype in dtypes_to_get}
+        for dtype in dtypes_to_get:
+            self.stats.record_hit(region_name, dtype)
+        if region_name not in self.pinned:
+            self.policy.access(region_name)
+        output = {dtype: self.cache[region_name][dtype] for dtype in dtypes_to_get}
+        self.stats.record_serve(time.perf_counter() - start)
+        return output
+
+    def _restore(self, region_name: str, dtypes: set):
+        """
+        Move any of the requested data that is only found in the spill cache
+        back into memory.
+        """
+        if self.spill is None:
+            return
+        restored = {}
+        for dtype in dtypes:
+            if self.spill.has_data(region_name, dtype) and not self.has_data(
+                region_name, dtype
+            ):
+                restored[dtype] = {region_name: self.spill.get(region_name, dtype)}
+        if restored:
+            self.add(restored)
 
     @get.register
+    @synchronized
     def _(self, regions: set, dtypes: Iterable):
         output = {}
         for region in regions:
             try:
                 output[region] = self.get(region, dtypes)
-            except KeyError:
+            except (KeyError, ValueError):
                 continue
         return switch_major_key(output)
 
+    @synchronized
     def has_data(self, region_name, dtype):
         return region_name in self.cache and dtype in self.cache[region_name]
 
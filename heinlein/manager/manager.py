@@ -1,9 +1,13 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
-import multiprocessing as mp
-from functools import cache
+import threading
+import time
+from collections.abc import Iterable
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+from functools import cache, partial
 from importlib import import_module
 from inspect import getmembers, isclass, isfunction
 from pathlib import Path
@@ -12,8 +16,10 @@ from typing import Any, Callable, Optional
 
 import appdirs
 
+import heinlein
+from heinlein.dtypes.filters import filter_key, normalize_filters
 from heinlein.errors import HeinleinError
-from heinlein.manager.cache import get_cache
+from heinlein.manager.cache import Cache, get_cache
 from heinlein.region.base import BaseRegion
 from heinlein.utilities import warning_prompt
 
@@ -25,6 +31,8 @@ class MissingDataError(HeinleinError):
 logger = logging.getLogger("manager")
 known_datasets = ["des", "cfht", "hsc", "ms"]
 active_managers = {}
+_loader_pool = None
+_loader_pool_lock = threading.Lock()
 
 
 def get_manager(name: str) -> DataManager:
@@ -37,6 +45,25 @@ def get_manager(name: str) -> DataManager:
         return mgr
 
 
+def get_loader_pool() -> Optional[ThreadPoolExecutor]:
+    """
+    Get the thread pool used to load regions in parallel, or None if
+    loading should be done serially (LOADER_THREADS = 1). The pool is shared
+    by all datasets, and is recreated if the number of threads changes.
+    """
+    global _loader_pool
+    n_threads = heinlein.get_option("LOADER_THREADS")
+    with _loader_pool_lock:
+        if _loader_pool is not None and _loader_pool._max_workers != n_threads:
+            _loader_pool.shutdown(wait=False)
+            _loader_pool = None
+        if n_threads > 1 and _loader_pool is None:
+            _loader_pool = ThreadPoolExecutor(
+                n_threads, thread_name_prefix="heinlein-loader"
+            )
+        return _loader_pool
+
+
 @cache
 def get_config_location() -> Path:
     return Path(appdirs.user_config_dir("heinlein"))
@@ -130,7 +157,9 @@ class DataManager:
         """
         self.name = name
         self._setup()
-        self._cache_lock = mp.Lock()
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._handler_lock = threading.Lock()
 
     def _setup(self, *args, **kwargs) -> None:
         """
@@ -188,12 +217,29 @@ class DataManager:
     def load_handlers(self, *args, **kwargs):
         from heinlein.dtypes import handlers
 
-        if not hasattr(self, "_handlers"):
-            data = self.config.get("data", {})
-            known_dtypes = list(data.keys())
-            self._handlers = handlers.get_file_handlers(
-                known_dtypes, self.config, self._external_definitions
-            )
+        with self._handler_lock:
+            if not hasattr(self, "_handlers"):
+                data = self.config.get("data", {})
+                known_dtypes = list(data.keys())
+                self._handlers = handlers.get_file_handlers(
+                    known_dtypes, self.config, self._external_definitions
+                )
+
+    def supports_filters(self, dtype: str) -> bool:
+        """
+        Check if the handler for a data type can filter rows as it loads them.
+        """
+        self.load_handlers()
+        return getattr(self._handlers.get(dtype), "supports_filters", False)
+
+    def pixel_nside(self, dtype: str) -> Optional[int]:
+        """
+        The finest HEALPix nside the handler for a data type can load parts of
+        regions at (see pixel_region_name), or None if it only loads whole
+        regions.
+        """
+        self.load_handlers()
+        return getattr(self._handlers.get(dtype), "pixel_nside", None)
 
     @staticmethod
     def exists(name: str) -> bool:
@@ -264,10 +310,99 @@ class DataManager:
 
     @check_overload
     def get_from(
-        self, dtypes: list, region_overlaps: list, *args, **kwargs
+        self,
+        dtypes: list,
+        region_overlaps: list,
+        *args,
+        columns: list = None,
+        filters: tuple = (),
+        **kwargs,
     ) -> dict[str, Any]:
-        return_types = []
-        new_data = {}
+        """
+        Get the data objects of the given types for a set of regions, from the
+        cache if possible. If columns are given, data types whose handlers can
+        load a subset of their columns only load (and cache) those columns.
+        Cached objects that already hold the columns are used as they are, and
+        ones that hold some of them only have the others loaded.
+
+        If filters are given, data types whose handlers can filter rows only
+        load the rows that pass them. Filtered data is cached separately for
+        each set of filters. Other data types are loaded in full.
+        """
+        filters = normalize_filters(filters)
+        keys = self._cache_keys(dtypes, filters)
+        regnames, cache, cached_data, regions_to_load = self._find_missing(
+            list(keys.values()), region_overlaps, columns
+        )
+        new_data = self._load(
+            cache, regions_to_load, *args, columns=columns, filters=filters, **kwargs
+        )
+        return self._merge(keys, regnames, cached_data, new_data)
+
+    async def aget_from(
+        self,
+        dtypes: list,
+        region_overlaps: list,
+        *args,
+        columns: list = None,
+        filters: tuple = (),
+        **kwargs,
+    ) -> dict[str, Any]:
+        """
+        Async version of get_from. Region loads run on the loader pool, so the
+        event loop is never blocked. If the task is cancelled, loads that have
+        not started yet are dropped.
+        """
+        loop = asyncio.get_running_loop()
+        if self.get_external("get_from") is not None:
+            get_from = partial(
+                self.get_from,
+                dtypes,
+                region_overlaps,
+                *args,
+                columns=columns,
+                filters=filters,
+                **kwargs,
+            )
+            return await loop.run_in_executor(None, get_from)
+
+        filters = normalize_filters(filters)
+        keys = self._cache_keys(dtypes, filters)
+        regnames, cache, cached_data, regions_to_load = await loop.run_in_executor(
+            None, self._find_missing, list(keys.values()), region_overlaps, columns
+        )
+        new_data = await self._aload(
+            cache, regions_to_load, *args, columns=columns, filters=filters, **kwargs
+        )
+        return self._merge(keys, regnames, cached_data, new_data)
+
+    def _cache_keys(self, dtypes: list, filters: tuple = ()) -> dict:
+        """
+        The key each data type is cached under. Data that was filtered as it
+        was loaded is kept apart from the full data, under the data type and
+        a fingerprint of the filters (e.g. "catalog|3f2a9c0d1b7e").
+        """
+        self.load_handlers()
+        keys = {}
+        for dtype in dtypes:
+            if filters and self.supports_filters(dtype):
+                keys[dtype] = f"{dtype}|{filter_key(filters)}"
+            else:
+                keys[dtype] = dtype
+        return keys
+
+    def _handler(self, key: str):
+        return self._handlers[key.partition("|")[0]]
+
+    def _find_missing(
+        self, dtypes: list, region_overlaps: list, columns: list = None
+    ) -> tuple:
+        """
+        Check the cache for the requested data, and figure out which
+        regions still need to be loaded for each data type. Cached objects
+        that don't have the requested columns count as missing. Data types
+        are given by their cache keys (see _cache_keys).
+        """
         if not isinstance(region_overlaps[0], str):
             regnames = set([r.name for r in region_overlaps])
         else:
@@ -276,33 +411,38 @@ class DataManager:
         self.load_handlers()
         data = self.config.get("data", {})
         for dtype in dtypes:
-            try:
-                _ = data[dtype]
-                return_types.append(dtype)
-            except KeyError:
+            if dtype.partition("|")[0] not in data:
                 raise MissingDataError(
                     f"Data of type {dtype} not found for dataset {self.name}!"
                 )
 
         cache = get_cache(self.name)
         cached_data = cache.get(regnames, dtypes)
+        for dtype, objs in cached_data.items():
+            for region_name, obj in list(objs.items()):
+                if self._lacks_columns(dtype, obj, columns):
+                    del objs[region_name]
 
-        for dtype in return_types:
+        regions_to_load = {}
+        for dtype in dtypes:
             if dtype in cached_data:
-                regions_to_get = [r for r in regnames if r not in cached_data[dtype]]
+                regions_to_get = [
+                    r for r in sorted(regnames) if r not in cached_data[dtype]
+                ]
             else:
-                regions_to_get = regnames
+                regions_to_get = sorted(regnames)
 
             if len(regions_to_get) != 0:
-                data_ = self._handlers[dtype].get_data(regions_to_get, *args, **kwargs)
-                new_data.update({dtype: data_})
+                regions_to_load[dtype] = regions_to_get
+        return regnames, cache, cached_data, regions_to_load
 
-        if len(new_data) != 0:
-            cache.add(new_data)
+    def _merge(
+        self, keys: dict, regnames: set, cached_data: dict, new_data: dict
+    ) -> dict:
         storage = {}
-        for dtype in return_types:
-            cached_data_of_dtype = cached_data.get(dtype, {})
-            new_data_of_dtype = new_data.get(dtype, {})
+        for dtype, key in keys.items():
+            cached_data_of_dtype = cached_data.get(key, {})
+            new_data_of_dtype = new_data.get(key, {})
             found_regions = set(cached_data_of_dtype.keys()) | set(
                 new_data_of_dtype.keys()
             )
@@ -313,10 +453,305 @@ class DataManager:
                     "The region is in the survey footprint, but the data are missing."
                 )
 
-            storage.update({dtype: {**cached_data_of_dtype, **new_data_of_dtype}})
+            # Regions are always returned in the same order, no matter which
+            # of them were cached or which load finished first.
+            all_data_of_dtype = {**cached_data_of_dtype, **new_data_of_dtype}
+            storage.update(
+                {dtype: {name: all_data_of_dtype[name] for name in sorted(regnames)}}
+            )
 
         return storage
 
+    def _load(
+        self, cache: Cache, regions_to_load: dict, *args, columns=None, **kwargs
+    ) -> dict:
+        """
+        Load data that was not found in the cache, and add it to the cache.
+        Loading is single-flight: if another thread is already loading a given
+        region and data type, we wait for it to finish and use its result rather
+        than loading the same data again. Loads of different regions do not
+        block each other.
+
+        The regions we do need to load are split up by the handlers (see
+        Handler.partition_regions) and loaded in parallel on the loader pool.
+        """
+        claimed, owned, waiting, new_data = self._claim(cache, regions_to_load, columns)
+        try:
+            tasks = self._plan_loads(claimed)
+            loads = self._run_loads(cache, tasks, *args, columns=columns, **kwargs)
+            for dtype, data_ in loads:
+                new_data.setdefault(dtype, {}).update(data_)
+        except BaseException as e:
+            # Make sure nobody is left waiting on a region we never loaded
+            self._abandon(owned, owned.keys(), e)
+            raise
+
+        retry = {}
+        for (region_name, dtype), future in waiting.items():
+            try:
+                obj = future.result()
+            except CancelledError:
+                retry.setdefault(dtype, []).append(region_name)
+                continue
+            if self._lacks_columns(dtype, obj, columns):
+                retry.setdefault(dtype, []).append(region_name)
+            elif obj is not None:
+                new_data.setdefault(dtype, {})[region_name] = obj
+
+        if retry:
+            # Whoever was loading these gave up on them (or loaded different
+            # columns), so we load them ourselves
+            retried = self._load(cache, retry, *args, columns=columns, **kwargs)
+            for dtype, data_ in retried.items():
+                new_data.setdefault(dtype, {}).update(data_)
+        return new_data
+
+    async def _aload(
+        self, cache: Cache, regions_to_load: dict, *args, columns=None, **kwargs
+    ) -> dict:
+        """
+        Async version of _load. If we are cancelled, loads that haven't started
+        yet are dropped and anyone waiting on them will load the regions
+        themselves. Loads that have already started finish in the background
+        and their data is added to the cache.
+        """
+        loop = asyncio.get_running_loop()
+        claimed, owned, waiting, new_data = self._claim(cache, regions_to_load, columns)
+        try:
+            tasks = self._plan_loads(claimed)
+        except BaseException as e:
+            self._abandon(owned, owned.keys(), e)
+            raise
+        kwargs["columns"] = columns
+
+        pool = get_loader_pool()
+        if pool is None:
+            # Serial loading, one task at a time so cancellation can stop
+            # the ones that haven't started.
+            for index, (dtype, group) in enumerate(tasks):
+                load = partial(self._load_claimed, cache, dtype, group, *args, **kwargs)
+                try:
+                    data_ = await loop.run_in_executor(None, load)
+                except asyncio.CancelledError:
+                    pending = [
+                        (region_name, dtype_)
+                        for dtype_, group_ in tasks[index + 1 :]
+                        for region_name in group_
+                    ]
+                    self._abandon(owned, pending)
+                    raise
+                new_data.setdefault(dtype, {}).update(data_)
+        else:
+            futures = [
+                pool.submit(self._load_claimed, cache, dtype, group, *args, **kwargs)
+                for dtype, group in tasks
+            ]
+            try:
+                results = await asyncio.gather(*map(asyncio.wrap_future, futures))
+            except asyncio.CancelledError:
+                # Futures that had not started have been cancelled by gather
+                pending = [
+                    (region_name, dtype)
+                    for (dtype, group), future in zip(tasks, futures)
+                    if future.cancelled()
+                    for region_name in group
+                ]
+                self._abandon(owned, pending)
+                raise
+            for (dtype, _), data_ in zip(tasks, results):
+                new_data.setdefault(dtype, {}).update(data_)
+
+        retry = {}
+        for (region_name, dtype), future in waiting.items():
+            try:
+                # Shielded, so cancelling this query doesn't cancel someone
+                # else's load.
+                obj = await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                retry.setdefault(dtype, []).append(region_name)
+                continue
+            if self._lacks_columns(dtype, obj, columns):
+                retry.setdefault(dtype, []).append(region_name)
+            elif obj is not None:
+                new_data.setdefault(dtype, {})[region_name] = obj
+
+        if retry:
+            retried = await self._aload(cache, retry, *args, **kwargs)
+            for dtype, data_ in retried.items():
+                new_data.setdefault(dtype, {}).update(data_)
+        return new_data
+
+    def _claim(self, cache: Cache, regions_to_load: dict, columns=None) -> tuple:
+        """
+        Claim the regions we are going to load ourselves. Returns the regions
+        we claimed (per data type), the futures we created for them, the futures
+        of regions someone else is already loading, and any data that showed up in
+        the cache since we last checked.
+        """
+        claimed = {}
+        owned = {}
+        waiting = {}
+        new_data = {}
+        with self._inflight_lock:
+            for dtype, region_names in regions_to_load.items():
+                for region_name in region_names:
+                    key = (region_name, dtype)
+                    if key in self._inflight:
+                        waiting[key] = self._inflight[key]
+                        continue
+                    obj = cache.peek(region_name, dtype)
+                    if obj is not None and not self._lacks_columns(dtype, obj, columns):
+                        # Loaded by another thread since we checked the cache
+                        new_data.setdefault(dtype, {})[region_name] = obj
+                    else:
+                        owned[key] = self._inflight[key] = Future()
+                        claimed.setdefault(dtype, []).append(region_name)
+        return claimed, owned, waiting, new_data
+
+    def _lacks_columns(self, dtype: str, obj, columns: list = None) -> bool:
+        """
+        Check if an object is missing columns we need. Only applies to data
+        types whose handlers can load a subset of the columns, everything
+        else is always loaded in full.
+        """
+        if obj is None or not getattr(self._handler(dtype), "supports_columns", False):
+            return False
+        return not obj.has_columns(columns)
+
+    def _plan_loads(self, claimed: dict) -> list:
+        return [
+            (dtype, group)
+            for dtype, region_names in claimed.items()
+            for group in self._handler(dtype).partition_regions(region_names)
+        ]
+
+    def _abandon(self, owned: dict, keys: Iterable, exception: BaseException = None):
+        """
+        Give up on regions we claimed but never loaded. Anyone waiting on them
+        gets the exception, or a CancelledError if there isn't one.
+        """
+        with self._inflight_lock:
+            for key in keys:
+                future = owned[key]
+                if self._inflight.get(key) is not future:
+                    continue
+                del self._inflight[key]
+                if exception is None:
+                    future.cancel()
+                else:
+                    future.set_exception(exception)
+
+    def _run_loads(self, cache: Cache, tasks: list, *args, **kwargs) -> list:
+        """
+        Run a list of (dtype, region names) loads, on the loader pool if there
+        is more than one. Results are returned in the order of the tasks. If any
+        of the loads fail, the first error is raised once all of them are done.
+        """
+        pool = get_loader_pool()
+        if pool is None or len(tasks) <= 1:
+            return [
+                (dtype, self._load_claimed(cache, dtype, group, *args, **kwargs))
+                for dtype, group in tasks
+            ]
+
+        futures = [
+            pool.submit(self._load_claimed, cache, dtype, group, *args, **kwargs)
+            for dtype, group in tasks
+        ]
+        wait(futures)
+        return [(dtype, f.result()) for (dtype, _), f in zip(tasks, futures)]
+
+    def _load_claimed(
+        self, cache: Cache, dtype: str, region_names: list, *args, **kwargs
+    ) -> dict:
+        """
+        Load regions this thread has claimed in _load, add them to the cache and
+        hand the results to any threads waiting on them.
+        """
+        handler = self._handler(dtype)
+        if not getattr(handler, "supports_filters", False):
+            kwargs.pop("filters", None)
+        data_ = {}
+        try:
+            start = time.perf_counter()
+            if getattr(handler, "supports_columns", False):
+                loaded, data_ = self._load_columns(
+                    cache, dtype, region_names, *args, **kwargs
+                )
+            else:
+                kwargs.pop("columns", None)
+                loaded = data_ = handler.get_data(region_names, *args, **kwargs) or {}
+            elapsed = time.perf_counter() - start
+            cache.stats.record_load(
+                dtype,
+                len(loaded),
+                elapsed,
+                sum(obj.estimate_size() for obj in loaded.values()),
+            )
+            if data_:
+                costs = {region_name: elapsed / len(data_) for region_name in data_}
+                if loaded is data_:
+                    cache.add({dtype: data_}, costs)
+                else:
+                    cache.replace({dtype: data_}, costs)
+        except BaseException as e:
+            with self._inflight_lock:
+                for region_name in region_names:
+                    self._inflight.pop((region_name, dtype)).set_exception(e)
+            raise
+
+        with self._inflight_lock:
+            for region_name in region_names:
+                future = self._inflight.pop((region_name, dtype))
+                future.set_result(data_.get(region_name))
+        return data_
+
+    def _load_columns(
+        self,
+        cache: Cache,
+        dtype: str,
+        region_names: list,
+        *args,
+        columns: list = None,
+        **kwargs,
+    ) -> tuple[dict, dict]:
+        """
+        Load regions with a handler that can load a subset of the columns. If
+        every region is already cached with some of the columns, only the columns
+        none of them have are loaded, and added to the cached objects. Returns
+        the objects that were loaded, and the complete objects for each region.
+        """
+        handler = self._handler(dtype)
+        cached = {name: cache.peek(name, dtype) for name in region_names}
+        cached = {name: obj for name, obj in cached.items() if obj is not None}
+        if columns is not None and len(cached) == len(region_names):
+            have = set.intersection(*(set(obj.columns) for obj in cached.values()))
+            columns = [c for c in columns if c not in have]
+        loaded = handler.get_data(region_names, *args, columns=columns, **kwargs)
+        loaded = loaded or {}
+
+        data_ = {}
+        for region_name, obj in loaded.items():
+            if region_name not in cached or columns is None:
+                data_[region_name] = obj
+                continue
+            try:
+                data_[region_name] = cached[region_name].add_columns(obj)
+            except ValueError:
+                # The rows came back in a different order, so we load all of the
+                # columns the region needs again. If that comes back empty, the
+                # cached object is the best we have.
+                all_columns = cached[region_name].columns + list(columns)
+                reloaded = handler.get_data(
+                    [region_name], *args, columns=all_columns, **kwargs
+                )
+                data_[region_name] = (reloaded or {}).get(
+                    region_name, cached[region_name]
+                )
+        return loaded, data_
+
     @check_overload
     def get_data(
         self,
@@ -336,6 +771,29 @@ class DataManager:
         storage = self.parse_data(storage, *args, **kwargs)
         return storage
 
+    async def aget_data(
+        self,
+        dtypes: list,
+        query_region: BaseRegion,
+        region_overlaps: list,
+        *args,
+        **kwargs,
+    ) -> dict[str, Any]:
+        """
+        Async version of get_data. Datasets that override get_data are run
+        in a worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        if self.get_external("get_data") is not None:
+            get_data = partial(
+                self.get_data, dtypes, query_region, region_overlaps, *args, **kwargs
+            )
+            return await loop.run_in_executor(None, get_data)
+
+        storage = await self.aget_from(dtypes, region_overlaps, *args, **kwargs)
+        parse_data = partial(self.parse_data, storage, *args, **kwargs)
+        return await loop.run_in_executor(None, parse_data)
+
     def parse_data(self, data, *args, **kwargs) -> dict[str, Any]:
         return_data = {}
         for dtype, values in data.items():
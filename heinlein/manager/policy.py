@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import heapq
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import count
+from typing import Hashable
+
+
+def get_policy(name: str) -> EvictionPolicy:
+    try:
+        return POLICIES[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown cache policy {name}. Options are {list(POLICIES.keys())}"
+        )
+
+
+class EvictionPolicy(ABC):
+    """
+    Decides which region the cache evicts next. The cache tells the policy
+    about every region it stores, every time a region is used and every time
+    a region leaves the cache for some other reason. Regions the cache does
+    not want evicted (e.g. pinned regions) are simply never given to the policy.
+
+    Sizes are in bytes, costs are the time it took to load the region in seconds.
+    """
+
+    name: str
+
+    @abstractmethod
+    def insert(self, key: Hashable, size: int, cost: float = 1.0) -> None:
+        pass
+
+    @abstractmethod
+    def access(self, key: Hashable) -> None:
+        pass
+
+    @abstractmethod
+    def remove(self, key: Hashable) -> None:
+        """
+        Stop tracking a key. Does nothing if the key is not being tracked.
+        """
+        pass
+
+    @abstractmethod
+    def evict(self) -> Hashable:
+        """
+        Remove and return the key that should be evicted next. Raises a KeyError
+        if there is nothing to evict.
+        """
+        pass
+
+    def update(self, key: Hashable, size: int, cost: float = 1.0) -> None:
+        """
+        Called when more data is added to a region that is already being tracked.
+        """
+        self.access(key)
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+
+class LRUPolicy(EvictionPolicy):
+    """
+    Evicts the least recently used region. All operations are O(1).
+    """
+
+    name = "lru"
+
+    def __init__(self):
+        self._order = OrderedDict()
+
+    def insert(self, key, size, cost=1.0):
+        self._order[key] = None
+        self._order.move_to_end(key)
+
+    def access(self, key):
+        self._order.move_to_end(key)
+
+    def remove(self, key):
+        self._order.pop(key, None)
+
+    def evict(self):
+        try:
+            return self._order.popitem(last=False)[0]
+        except KeyError:
+            raise KeyError("No regions to evict")
+
+    def __len__(self):
+        return len(self._order)
+
+
+class _FrequencyNode:
+    __slots__ = ("frequency", "keys", "prev", "next")
+
+    def __init__(self, frequency: int):
+        self.frequency = frequency
+        self.keys = OrderedDict()
+        self.prev = None
+        self.next = None
+
+
+class LFUPolicy(EvictionPolicy):
+    """
+    Evicts the least frequently used region, breaking ties by recency. Keys are
+    kept in buckets of equal frequency, and the buckets form a linked list sorted
+    by frequency. This makes all operations O(1).
+    """
+
+    name = "lfu"
+
+    def __init__(self):
+        self._nodes = {}
+        self._head = None  # The lowest frequency bucket
+
+    def insert(self, key, size, cost=1.0):
+        self.remove(key)
+        if self._head is None or self._head.frequency != 1:
+            node = _FrequencyNode(1)
+            self._link_after(node, None)
+        self._head.keys[key] = None
+        self._nodes[key] = self._head
+
+    def access(self, key):
+        node = self._nodes[key]
+        next_node = node.next
+        if next_node is None or next_node.frequency != node.frequency + 1:
+            next_node = _FrequencyNode(node.frequency + 1)
+            self._link_after(next_node, node)
+        next_node.keys[key] = None
+        self._nodes[key] = next_node
+        del node.keys[key]
+        if not node.keys:
+            self._unlink(node)
+
+    def remove(self, key):
+        node = self._nodes.pop(key, None)
+        if node is None:
+            return
+        del node.keys[key]
+        if not node.keys:
+            self._unlink(node)
+
+    def evict(self):
+        if self._head is None:
+            raise KeyError("No regions to evict")
+        key, _ = self._head.keys.popitem(last=False)
+        del self._nodes[key]
+        if not self._head.keys:
+            self._unlink(self._head)
+        return key
+
+    def _link_after(self, node: _FrequencyNode, prev: _FrequencyNode | None):
+        if prev is None:
+            node.next = self._head
+            if self._head is not None:
+                self._head.prev = node
+            self._head = node
+        else:
+            node.prev = prev
+            node.next = prev.next
+            if prev.next is not None:
+                prev.next.prev = node
+            prev.next = node
+
+    def _unlink(self, node: _FrequencyNode):
+        if node.prev is None:
+            self._head = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is not None:
+            node.next.prev = node.prev
+        node.prev = node.next = None
+
+    def __len__(self):
+        return len(self._nodes)
+
+
+class GreedyDualSizePolicy(EvictionPolicy):
+    """
+    GreedyDual-Size (Cao & Irani, 1997). Each region gets a priority of
+    L + cost / size, where L is the priority of the last evicted region. The region
+    with the lowest priority is evicted first. Regions that were expensive to load
+    or are small stay in the cache longer, and L ages out regions that haven't been
+    used in a while. Priorities are kept in a heap, so operations are O(log n).
+    """
+
+    name = "gds"
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._params = {}
+        self._counter = count()
+        self._inflation = 0.0
+
+    def insert(self, key, size, cost=1.0):
+        self._params[key] = (max(size, 1), cost)
+        self._push(key)
+
+    def update(self, key, size, cost=1.0):
+        self.insert(key, size, cost)
+
+    def access(self, key):
+        self._push(key)
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[-1] = None
+            del self._params[key]
+
+    def evict(self):
+        while self._heap:
+            priority, _, key = heapq.heappop(self._heap)
+            if key is not None:
+                del self._entries[key]
+                del self._params[key]
+                self._inflation = priority
+                return key
+        raise KeyError("No regions to evict")
+
+    def _push(self, key):
+        old_entry = self._entries.get(key)
+        if old_entry is not None:
+            old_entry[-1] = None
+        size, cost = self._params[key]
+        entry = [self._inflation + cost / size, next(self._counter), key]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            # Too many stale entries, rebuild the heap
+            self._heap = list(self._entries.values())
+            heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+POLICIES = {
+    LRUPolicy.name: LRUPolicy,
+    LFUPolicy.name: LFUPolicy,
+    GreedyDualSizePolicy.name: GreedyDualSizePolicy,
+}
@@ -0,0 +1,269 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import weakref
+from importlib import import_module
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from heinlein.dtypes.dobj import HeinleinDataObject
+from heinlein.manager.cache import Cache
+from heinlein.manager.spill import SpillCache
+
+# Segment layout: a 16 byte header holding the offset and length of a json
+# manifest, followed by the arrays and finally the manifest itself. The manifest
+# length is written last, so a segment with a zero length is still being written.
+HEADER_SIZE = 16
+ALIGNMENT = 64
+
+
+class SharedMemoryCache(Cache):
+    """
+    A cache that shares its data between processes working on the same dataset.
+
+    When data is added to the cache, it is broken down into plain arrays (see
+    `HeinleinDataObject.to_arrays`) and published into a named shared memory
+    segment. Any other process with a SharedMemoryCache for the same dataset
+    will attach to the segment instead of loading the data itself. The arrays are
+    never copied out of the segment, so N processes use the memory of one.
+
+    Segments are owned by the process that published them, and are unlinked
+    when that process evicts the region or exits. Processes that have already
+    attached keep their view of the data. Objects that cannot be converted to
+    arrays are cached locally, exactly as they would be by a regular Cache.
+
+    Segments are unlinked by their owner rather than by multiprocessing's
+    resource tracker, so if the owner is killed before it can clean up, its
+    segments are left behind. They are named "heinlein_<hash>", and on Linux
+    live in /dev/shm until the machine restarts. Leftover segments can be
+    removed by hand (rm /dev/shm/heinlein_*) once no heinlein processes are
+    running. While a leftover segment exists, other processes keep using the
+    data in it, and nobody publishes that region again.
+    """
+
+    backend = "shared"
+
+    def __init__(
+        self,
+        dataset: str,
+        max_size: float = 4e9,
+        spill: SpillCache = None,
+        policy: str = "lru",
+    ):
+        super().__init__(max_size, spill, policy)
+        self.dataset = dataset
+        self._owned = {}
+        self._finalizer = weakref.finalize(self, _unlink_all, self._owned)
+
+    def add(self, data, costs: dict = None):
+        published = {}
+        shared_data = {}
+        new_segments = []
+        try:
+            for dtype, region_data in data.items():
+                shared_data[dtype] = {}
+                for region_name, obj in region_data.items():
+                    if id(obj) not in published:
+                        shared = self._publish(region_name, dtype, obj)
+                        if shared is not obj:
+                            new_segments.append(self.segment_name(region_name, dtype))
+                        published[id(obj)] = shared
+                    shared_data[dtype][region_name] = published[id(obj)]
+            super().add(shared_data, costs)
+        except BaseException:
+            # The data never made it into the cache, so nothing would unlink
+            # the segments it was published into
+            for name in new_segments:
+                self._unlink_owned(name)
+            raise
+
+    def _restore(self, region_name: str, dtypes: set):
+        attached = {}
+        for dtype in dtypes:
+            if self.has_data(region_name, dtype):
+                continue
+            obj = self._attach(region_name, dtype)
+            if obj is not None:
+                attached[dtype] = {region_name: obj}
+        if attached:
+            super().add(attached)
+        super()._restore(region_name, dtypes)
+
+    def _release(self, region_name: str, region_data: dict):
+        for dtype in region_data.keys():
+            self._unlink_owned(self.segment_name(region_name, dtype))
+
+    def _unlink_owned(self, name: str):
+        segment = self._owned.pop(name, None)
+        if segment is not None:
+            _unlink_segment(segment)
+
+    def segment_name(self, region_name: str, dtype: str) -> str:
+        key = f"{self.dataset}\0{region_name}\0{dtype}".encode()
+        return "heinlein_" + hashlib.sha1(key).hexdigest()[:20]
+
+    def _publish(
+        self, region_name: str, dtype: str, obj: HeinleinDataObject
+    ) -> HeinleinDataObject:
+        """
+        Write an object into shared memory. Returns an equivalent object backed
+        by the shared segment, or the original object if it could not be
+        published.
+        """
+        try:
+            meta, arrays = obj.to_arrays()
+        except NotImplementedError:
+            return obj
+
+        array_info = []
+        offset = HEADER_SIZE
+        for name, array in arrays.items():
+            offset = _align(offset)
+            array_info.append(
+                {
+                    "name": name,
+                    "dtype": array.dtype.str,
+                    "shape": array.shape,
+                    "offset": offset,
+                }
+            )
+            offset += array.nbytes
+        object_type = type(obj)
+        manifest = {
+            "type": f"{object_type.__module__}:{object_type.__qualname__}",
+            "arrays": array_info,
+            "meta": meta,
+        }
+        manifest_bytes = json.dumps(manifest).encode()
+        manifest_offset = _align(offset)
+        size = manifest_offset + len(manifest_bytes)
+
+        name = self.segment_name(region_name, dtype)
+        try:
+            segment = _open_segment(name, create=True, size=size)
+        except FileExistsError:
+            # Someone else has already published (or is publishing) this data
+            return obj
+
+        buffer = segment.buf
+        for info, array in zip(array_info, arrays.values()):
+            view = np.ndarray(
+                array.shape, dtype=array.dtype, buffer=buffer, offset=info["offset"]
+            )
+            view[...] = array
+        buffer[manifest_offset:size] = manifest_bytes
+        buffer[:8] = np.uint64(manifest_offset).tobytes()
+        buffer[8:HEADER_SIZE] = np.uint64(len(manifest_bytes)).tobytes()
+        self._owned[name] = segment
+        return _load_manifest(manifest, segment)
+
+    def _attach(self, region_name: str, dtype: str) -> HeinleinDataObject | None:
+        name = self.segment_name(region_name, dtype)
+        try:
+            segment = _open_segment(name)
+        except FileNotFoundError:
+            return None
+        header = np.frombuffer(segment.buf[:HEADER_SIZE], dtype=np.uint64).copy()
+        manifest_offset, manifest_length = int(header[0]), int(header[1])
+        if manifest_length == 0:
+            # The segment exists but the owner hasn't finished writing it.
+            _close_segment(segment)
+            return None
+        manifest_bytes = bytes(
+            segment.buf[manifest_offset : manifest_offset + manifest_length]
+        )
+        return _load_manifest(json.loads(manifest_bytes), segment)
+
+
+def _load_manifest(
+    manifest: dict, segment: shared_memory.SharedMemory
+) -> HeinleinDataObject:
+    """
+    Rebuild an object from its arrays in a segment. The segment is closed
+    once the object is gone (see _close_segment).
+    """
+    arrays = {}
+    for info in manifest["arrays"]:
+        shape = tuple(info["shape"])
+        # Arrays from frombuffer hold on to the segment's buffer, so it can't
+        # be unmapped while they (or any views of them) are around
+        array = np.frombuffer(
+            segment.buf,
+            dtype=np.dtype(info["dtype"]),
+            count=int(np.prod(shape)),
+            offset=info["offset"],
+        ).reshape(shape)
+        array.flags.writeable = False
+        arrays[info["name"]] = array
+    module_name, type_name = manifest["type"].split(":")
+    object_type = getattr(import_module(module_name), type_name)
+    obj = object_type.from_arrays(manifest["meta"], arrays)
+    weakref.finalize(obj, _close_segment, segment)
+    return obj
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _open_segment(name: str, create: bool = False, size: int = 0):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+    segment = shared_memory.SharedMemory(name, create=create, size=size)
+    # Segments are shared between unrelated processes, so we handle unlinking
+    # ourselves rather than letting the resource tracker of whichever process
+    # opened them last remove them.
+    if os.name == "posix":
+        resource_tracker.unregister(_tracked_name(segment), "shared_memory")
+    return segment
+
+
+def _tracked_name(segment: shared_memory.SharedMemory) -> str:
+    # The resource tracker knows POSIX segments by their full name, with the
+    # leading slash that SharedMemory.name leaves out
+    return "/" + segment.name
+
+
+def _unlink_segment(segment: shared_memory.SharedMemory):
+    if sys.version_info < (3, 13) and os.name == "posix":
+        # SharedMemory.unlink unregisters the segment, so it must be registered
+        resource_tracker.register(_tracked_name(segment), "shared_memory")
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _unlink_all(segments: dict):
+    for segment in segments.values():
+        _unlink_segment(segment)
+    segments.clear()
+
+
+# Segments whose arrays were still in use when they were due to be closed.
+# Segments are closed from finalizers, which can run in any thread (or in the
+# middle of closing other segments), so the list is only changed under the lock.
+_unclosed = []
+_unclosed_lock = threading.RLock()
+
+
+def _close_segment(segment: shared_memory.SharedMemory):
+    """
+    Close a segment once the object built on it is gone. A segment can't be
+    closed while views of its arrays are still around (for example a column
+    taken out of a catalog), so those segments are kept and closed by a later
+    call, once the views are gone.
+    """
+    with _unclosed_lock:
+        pending = [*_unclosed, segment]
+        _unclosed.clear()
+        for segment in pending:
+            try:
+                segment.close()
+            except BufferError:
+                _unclosed.append(segment)
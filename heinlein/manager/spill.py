@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from importlib import import_module
+from pathlib import Path
+
+import appdirs
+import numpy as np
+
+from heinlein.dtypes.dobj import HeinleinDataObject
+
+
+def get_spill_location() -> Path:
+    return Path(appdirs.user_cache_dir("heinlein")) / "spill"
+
+
+class SpillCache:
+    """
+    A second, on-disk tier for the region cache. When the in-memory cache evicts
+    a region, its data objects are broken down into plain arrays (see
+    `HeinleinDataObject.to_arrays`) and written to disk as raw .npy files. The next
+    time the region is needed, the arrays are memory-mapped rather than re-read
+    from the original source.
+
+    Each spill cache writes into its own temporary directory, which is removed
+    when the cache is garbage collected. The underlying data is assumed to be
+    immutable, so nothing is ever shared between sessions.
+
+    Entries are tracked per (region, dtype) pair, and are evicted with an LRU
+    policy once the total size on disk exceeds max_size.
+    """
+
+    def __init__(self, location: Path, max_size: float):
+        location.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.path = Path(tempfile.mkdtemp(prefix="spill-", dir=location))
+        self.entries = OrderedDict()
+        self.size = 0
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def has_data(self, region_name: str, dtype: str) -> bool:
+        return (region_name, dtype) in self.entries
+
+    def put(self, region_name: str, dtype: str, data: HeinleinDataObject) -> bool:
+        """
+        Write an object to disk. Returns False if the object could not be
+        written, either because it cannot be represented as arrays or because
+        it would not fit in the spill cache.
+        """
+        key = (region_name, dtype)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return True
+        try:
+            meta, arrays = data.to_arrays()
+        except NotImplementedError:
+            return False
+
+        size = sum(array.nbytes for array in arrays.values())
+        if size > self.max_size:
+            return False
+        self.make_space(size)
+
+        entry_path = self.path / _entry_name(region_name, dtype)
+        entry_path.mkdir()
+        names = list(arrays.keys())
+        for index, name in enumerate(names):
+            np.save(entry_path / f"{index}.npy", arrays[name], allow_pickle=False)
+        object_type = type(data)
+        spill_meta = {
+            "type": f"{object_type.__module__}:{object_type.__qualname__}",
+            "arrays": names,
+            "meta": meta,
+        }
+        with open(entry_path / "meta.json", "w") as f:
+            json.dump(spill_meta, f)
+
+        self.entries[key] = (entry_path, size)
+        self.size += size
+        return True
+
+    def get(self, region_name: str, dtype: str) -> HeinleinDataObject:
+        key = (region_name, dtype)
+        if key not in self.entries:
+            raise KeyError("Region not in spill cache")
+        entry_path, _ = self.entries[key]
+        with open(entry_path / "meta.json", "r") as f:
+            spill_meta = json.load(f)
+        arrays = {
+            name: np.load(entry_path / f"{index}.npy", mmap_mode="r")
+            for index, name in enumerate(spill_meta["arrays"])
+        }
+        module_name, type_name = spill_meta["type"].split(":")
+        object_type = getattr(import_module(module_name), type_name)
+        self.entries.move_to_end(key)
+        return object_type.from_arrays(spill_meta["meta"], arrays)
+
+    def make_space(self, needed_space: int):
+        while self.entries and self.size + needed_space > self.max_size:
+            _, (entry_path, size) = self.entries.popitem(last=False)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            self.size -= size
+
+    def change_max_size(self, new_size: float):
+        self.max_size = new_size
+        self.make_space(0)
+
+    def drop(self, region_names):
+        region_names = set(region_names)
+        for key in [k for k in self.entries if k[0] in region_names]:
+            entry_path, size = self.entries.pop(key)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            self.size -= size
+
+    def discard(self, region_name: str, dtype: str):
+        entry = self.entries.pop((region_name, dtype), None)
+        if entry is not None:
+            entry_path, size = entry
+            shutil.rmtree(entry_path, ignore_errors=True)
+            self.size -= size
+
+    def empty(self):
+        for entry_path, _ in self.entries.values():
+            shutil.rmtree(entry_path, ignore_errors=True)
+        self.entries = OrderedDict()
+        self.size = 0
+
+
+def _entry_name(region_name: str, dtype: str) -> str:
+    key = f"{region_name}\0{dtype}".encode()
+    return hashlib.sha1(key).hexdigest()[:16]
@@ -0,0 +1,103 @@
+import threading
+from collections import Counter
+
+
+class CacheStats:
+    """
+    Keeps running counters on how well the cache is doing. Everything here is
+    a plain integer or float increment so it is cheap enough to leave on. Hits
+    and misses are tracked per (region, dtype) pair and aggregated when a
+    snapshot is requested. Counters are updated under a lock, since loads can
+    be recorded from several threads at once.
+
+    Data that was filtered as it was loaded is cached under its data type and
+    a fingerprint of the filters, and counted under the data type here.
+
+    Times are in seconds. "load_time" is the time spent in the handlers loading
+    data the cache did not have, "serve_time" is the time spent serving data
+    the cache did have.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.hits = Counter()
+            self.misses = Counter()
+            self.loads = Counter()
+            self.load_times = Counter()
+            self.bytes_loaded = 0
+            self.bytes_evicted = 0
+            self.evictions = 0
+            self.serve_time = 0.0
+
+    def record_hit(self, region_name: str, dtype: str):
+        with self._lock:
+            self.hits[(region_name, _base_dtype(dtype))] += 1
+
+    def record_miss(self, region_name: str, dtype: str):
+        with self._lock:
+            self.misses[(region_name, _base_dtype(dtype))] += 1
+
+    def record_serve(self, seconds: float):
+        with self._lock:
+            self.serve_time += seconds
+
+    def record_load(self, dtype: str, n_regions: int, seconds: float, nbytes: int):
+        with self._lock:
+            self.loads[_base_dtype(dtype)] += n_regions
+            self.load_times[_base_dtype(dtype)] += seconds
+            self.bytes_loaded += nbytes
+
+    def record_eviction(self, nbytes: int):
+        with self._lock:
+            self.evictions += 1
+            self.bytes_evicted += nbytes
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current state of the counters as a dictionary
+        """
+        # Copy the counters so they can't change while they are aggregated
+        with self._lock:
+            hits = self.hits.copy()
+            misses = self.misses.copy()
+            loads = self.loads.copy()
+            load_times = self.load_times.copy()
+            bytes_loaded = self.bytes_loaded
+            bytes_evicted = self.bytes_evicted
+            evictions = self.evictions
+            serve_time = self.serve_time
+
+        by_dtype = {}
+        by_region = {}
+        for counter, key in ((hits, "hits"), (misses, "misses")):
+            for (region_name, dtype), n in counter.items():
+                for output, output_key in ((by_dtype, dtype), (by_region, region_name)):
+                    entry = output.setdefault(output_key, {"hits": 0, "misses": 0})
+                    entry[key] += n
+        for dtype in loads:
+            entry = by_dtype.setdefault(dtype, {"hits": 0, "misses": 0})
+            entry["regions_loaded"] = loads[dtype]
+            entry["load_time"] = load_times[dtype]
+
+        n_hits = sum(hits.values())
+        n_misses = sum(misses.values())
+        return {
+            "hits": n_hits,
+            "misses": n_misses,
+            "hit_rate": n_hits / (n_hits + n_misses) if n_hits + n_misses else None,
+            "bytes_loaded": bytes_loaded,
+            "bytes_evicted": bytes_evicted,
+            "evictions": evictions,
+            "load_time": sum(load_times.values()),
+            "serve_time": serve_time,
+            "by_dtype": by_dtype,
+            "by_region": by_region,
+        }
+
+
+def _base_dtype(key: str) -> str:
+    return key.partition("|")[0]
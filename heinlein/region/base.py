@@ -5,8 +5,10 @@ import logging
 from abc import ABC, abstractmethod
 from typing import Any
 
+import numpy as np
 from astropy.coordinates import SkyCoord
 from spherical_geometry.polygon import SingleSphericalPolygon
+from spherical_geometry.vector import vector_to_lonlat
 
 from heinlein.locations import MAIN_CONFIG_DIR
 
@@ -110,3 +112,35 @@ class BaseRegion(ABC):
         Check if a point is in the region
         """
         pass
+
+    def contains_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Check which of a set of points are in the region, with the points given
+        as an (N, 3) array of unit vectors. This is much faster than working
+        with SkyCoords, and regions should override it with a vectorized kernel
+        if they can. The default falls back to `contains`.
+        """
+        lon, lat = vector_to_lonlat(vectors[:, 0], vectors[:, 1], vectors[:, 2])
+        return np.asarray(self.contains(SkyCoord(lon, lat, unit="deg")), dtype=bool)
+
+    def bounding_cap(self) -> tuple[np.ndarray, float] | None:
+        """
+        A spherical cap that contains the whole region, as a unit vector for the
+        center and a radius in radians. This is used to find the part of a
+        spatial index a query needs to look at. Returns None if no useful cap
+        exists. The default works for regions whose edges are great circles.
+        """
+        return _cap_around(self.spherical_geometry.points)
+
+
+def _cap_around(points: np.ndarray, margin: float = 0.0) -> tuple | None:
+    center = points.sum(axis=0)
+    norm = np.linalg.norm(center)
+    if norm == 0:
+        return None
+    center /= norm
+    radius = np.arccos(np.clip(points @ center, -1, 1)).max() + margin
+    # Caps larger than a hemisphere don't contain the arcs between their points
+    if radius >= np.pi / 2:
+        return None
+    return center, radius
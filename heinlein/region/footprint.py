@@ -2,9 +2,16 @@ from functools import singledispatchmethod
 
 import astropy.units as u
 import healpy
+import numpy as np
+from spherical_geometry.polygon import SingleSphericalPolygon
+from spherical_geometry.vector import vector_to_lonlat
 
 from .region import BaseRegion
 
+# Bounds used for regions whose bounding box we can't work out (e.g. they contain
+# a pole). They overlap with everything.
+UNBOUNDED = (-360.0, -90.0, 720.0, 90.0)
+
 
 def partition_regions(
     regions: list[BaseRegion], nside: int
@@ -26,6 +33,68 @@ def query_healpix(region: BaseRegion, nside: int):
     return healpy.query_polygon(nside, vecs, inclusive=True)
 
 
+def get_healpix_pixels(region: BaseRegion, nside: int) -> np.ndarray:
+    """
+    Find the HEALPix pixels (NEST ordering) that overlap a region, in sorted
+    order. Some of the pixels may only overlap the region's bounding cap.
+    """
+    cap = region.bounding_cap()
+    if cap is None:
+        pixels = healpy.ring2nest(nside, query_healpix(region, nside))
+    else:
+        center, radius = cap
+        pixels = healpy.query_disc(nside, center, radius, inclusive=True, nest=True)
+    return np.sort(pixels)
+
+
+def get_lonlat_bounds(polygon: SingleSphericalPolygon) -> tuple:
+    """
+    Get the bounding box of a spherical polygon as (lon_min, lat_min, lon_max,
+    lat_max) in degrees. The edges of a spherical polygon are great circle arcs,
+    which bulge towards the poles, so the latitude range can be larger than that of
+    the vertices. If the polygon straddles the 0/360 line, lon_min will be
+    negative. Polygons that contain a pole or span more than 180 degrees in
+    longitude get UNBOUNDED.
+    """
+    points = polygon.points
+    if polygon.contains_point([0, 0, 1]) or polygon.contains_point([0, 0, -1]):
+        return UNBOUNDED
+    lon, lat = vector_to_lonlat(points[:, 0], points[:, 1], points[:, 2])
+    lon = lon % 360
+    if lon.max() - lon.min() > 180:
+        lon = np.where(lon > 180, lon - 360, lon)
+        if lon.max() - lon.min() > 180:
+            return UNBOUNDED
+
+    lat_min, lat_max = lat.min(), lat.max()
+    start, end = points[:-1], points[1:]
+    normals = np.cross(start, end)
+    norms = np.einsum("ij,ij->i", normals, normals)
+    for pole in (1, -1):
+        # The point on each edge's great circle that is closest to the pole
+        # only matters if it falls within the edge itself.
+        coefficients = np.divide(
+            normals[:, 2] * pole, norms, out=np.zeros_like(norms), where=norms > 0
+        )
+        closest = np.array([0, 0, pole]) - coefficients[:, np.newaxis] * normals
+        lengths = np.linalg.norm(closest, axis=1)
+        valid = (norms > 0) & (lengths > 0)
+        closest[valid] /= lengths[valid, np.newaxis]
+        on_edge = (
+            valid
+            & (np.einsum("ij,ij->i", np.cross(start, closest), normals) >= 0)
+            & (np.einsum("ij,ij->i", np.cross(closest, end), normals) >= 0)
+        )
+        if not on_edge.any():
+            continue
+        extreme = np.degrees(np.arcsin(np.clip(closest[on_edge, 2], -1, 1)))
+        if pole == 1:
+            lat_max = max(lat_max, extreme.max())
+        else:
+            lat_min = min(lat_min, extreme.min())
+    return lon.min(), lat_min, lon.max(), lat_max
+
+
 def get_healpix_nside(region: BaseRegion):
     """
     Dynamically decide on the nside for a given footprint based on
@@ -59,6 +128,8 @@ class Footprint:
     def __init__(self, regions: list[BaseRegion], nside=256, *args, **kwargs):
         self._nside = get_healpix_nside(regions[0])
         self._regions = partition_regions(regions, self._nside)
+        self._region_list = list(regions)
+        self._region_bounds = None
 
     @singledispatchmethod
     def get_overlapping_regions(self, query_region: BaseRegion) -> list[BaseRegion]:
@@ -75,7 +146,75 @@ class Footprint:
 
     @get_overlapping_regions.register
     def _(self, region: list) -> list[list[BaseRegion]]:
-        return [self.get_overlapping_regions(r) for r in region]
+        """
+        Find the overlapping regions for many query regions at once. The bounding
+        boxes of all the queries are compared against the bounding boxes of all
+        the regions in the footprint in a single vectorized pass, and the exact
+        (much slower) intersection test is only run on the pairs that pass.
+        """
+        region_bounds = self._get_region_bounds()
+        query_bounds = np.array(
+            [get_lonlat_bounds(r.spherical_geometry) for r in region]
+        ).reshape(-1, 4)
+
+        output = []
+        chunk_size = self._chunk_size()
+        for chunk_start in range(0, len(region), chunk_size):
+            chunk = query_bounds[chunk_start : chunk_start + chunk_size]
+            candidates = _bounds_overlap(chunk, region_bounds)
+            for index in range(len(chunk)):
+                query_region = region[chunk_start + index]
+                overlaps = []
+                for region_index in np.flatnonzero(candidates[index]):
+                    footprint_region = self._region_list[region_index]
+                    if footprint_region.intersects(query_region):
+                        overlaps.append(footprint_region)
+                output.append(overlaps)
+        return output
+
+    def get_cones_near_regions(
+        self, ra: np.ndarray, dec: np.ndarray, radius: np.ndarray
+    ) -> dict[str, np.ndarray]:
+        """
+        Find the regions near each of many cones. All values are in degrees.
+        Returns a dictionary of region name -> indices of the cones whose bounding
+        boxes overlap with that of the region. Regions that aren't near any cone
+        are left out. This is a quick and conservative check, a cone may not
+        actually overlap with every region it is matched to.
+        """
+        region_bounds = self._get_region_bounds()
+        query_bounds = np.array(_cone_bounds(ra, dec, radius)).T.reshape(-1, 4)
+        all_cones = []
+        all_regions = []
+        chunk_size = self._chunk_size()
+        for chunk_start in range(0, len(query_bounds), chunk_size):
+            chunk = query_bounds[chunk_start : chunk_start + chunk_size]
+            cones, regions = np.nonzero(_bounds_overlap(chunk, region_bounds))
+            all_cones.append(cones + chunk_start)
+            all_regions.append(regions)
+        if not all_cones:
+            return {}
+        cones = np.concatenate(all_cones)
+        regions = np.concatenate(all_regions)
+        order = np.argsort(regions, kind="stable")
+        region_indices, starts = np.unique(regions[order], return_index=True)
+        return {
+            self._region_list[region_index].name: cone_indices
+            for region_index, cone_indices in zip(
+                region_indices, np.split(cones[order], starts[1:])
+            )
+        }
+
+    def _get_region_bounds(self) -> np.ndarray:
+        if self._region_bounds is None:
+            self._region_bounds = np.array(
+                [get_lonlat_bounds(r.spherical_geometry) for r in self._region_list]
+            )
+        return self._region_bounds
+
+    def _chunk_size(self) -> int:
+        # Number of queries to compare against all the regions at once
+        return max(1, 2**22 // max(len(self._region_list), 1))
 
     def get_overlapping_region_names(
         self, region: BaseRegion | list[BaseRegion]
@@ -121,3 +260,34 @@ class Footprint:
             except KeyError:
                 partitions[okey] = [sample]
         return partitions
+
+
+def _cone_bounds(ra: np.ndarray, dec: np.ndarray, radius: np.ndarray) -> tuple:
+    """
+    Get the bounding boxes of a set of cones, in the same format as
+    get_lonlat_bounds. Cones that reach a pole get UNBOUNDED.
+    """
+    ra, dec, radius = np.broadcast_arrays(ra, dec, radius)
+    ra = ra % 360
+    reaches_pole = np.abs(dec) + radius >= 90
+    # Half the width of the cone in longitude, at its widest point
+    ratio = np.sin(np.radians(radius)) / np.maximum(np.cos(np.radians(dec)), 1e-12)
+    half_width = np.degrees(np.arcsin(np.clip(ratio, -1, 1)))
+    bounds = [ra - half_width, dec - radius, ra + half_width, dec + radius]
+    return tuple(
+        np.where(reaches_pole, unbounded, b) for b, unbounded in zip(bounds, UNBOUNDED)
+    )
+
+
+def _bounds_overlap(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Check which of the bounding boxes in a overlap with which of the bounding
+    boxes in b, allowing for boxes that wrap around the 0/360 line.
+    """
+    a = a[:, np.newaxis, :]
+    dec_overlap = (a[..., 1] <= b[:, 3]) & (a[..., 3] >= b[:, 1])
+    ra_overlap = np.zeros(dec_overlap.shape, dtype=bool)
+    for shift in (-360, 0, 360):
+        ra_overlap |= (a[..., 0] + shift <= b[:, 2]) & (a[..., 2] + shift >= b[:, 0])
+    return dec_overlap & ra_overlap
+
@@ -1,10 +1,12 @@
 import astropy.units as u
 import numpy as np
 from astropy.coordinates import SkyCoord
+from spherical_geometry import great_circle_arc
 from spherical_geometry.polygon import SingleSphericalPolygon
+from spherical_geometry.vector import lonlat_to_vector
 
 from heinlein.region import sampling
-from heinlein.region.base import BaseRegion, create_bounding_box
+from heinlein.region.base import BaseRegion, _cap_around, create_bounding_box
 from heinlein.utilities.utilities import initialize_grid
 
 
@@ -110,9 +112,24 @@ class PolygonRegion(BaseRegion):
         self._sampler = None
 
     def contains(self, point: SkyCoord) -> bool:
-        return self.spherical_geometry.contains_radec(
-            point.ra.deg, point.dec.deg, degrees=True
-        )
+        vectors = np.column_stack(lonlat_to_vector(point.ra.deg, point.dec.deg))
+        contains = self.contains_vectors(vectors)
+        return contains[0] if point.isscalar else contains
+
+    def contains_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Same test as spherical_geometry uses for a single point: a point is
+        inside the polygon if the arc between it and a point known to be inside
+        crosses the edges an even number of times. Here we loop over the edges
+        (of which there are few) instead of over the points.
+        """
+        polygon = self.spherical_geometry
+        edges = polygon.points
+        inside = polygon.inside
+        crossings = np.zeros(len(vectors), dtype=int)
+        for start, end in zip(edges[:-1], edges[1:]):
+            crossings += great_circle_arc.intersects(inside, vectors, start, end)
+        return crossings % 2 == 0
 
 
 class BoxRegion(BaseRegion):
@@ -161,6 +178,52 @@ class BoxRegion(BaseRegion):
         mask = mask.all(axis=2).any(axis=1)
         return mask
 
+    def contains_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        The same bounds check as `contains`, done on unit vectors. The dec bounds
+        become bounds on z, and the ra bounds become tests against the planes of
+        the meridians at ra_min and ra_max.
+        """
+        ra_min, dec_min, ra_max, dec_max = self.bounds
+        if dec_min > dec_max:
+            # Straddles a pole, fall back to the general case
+            return super().contains_vectors(vectors)
+        ra_min, ra_max = np.radians(ra_min % 360), np.radians(ra_max % 360)
+        x, y, z = vectors[:, 0], vectors[:, 1], vectors[:, 2]
+        mask = (z >= np.sin(np.radians(dec_min))) & (z <= np.sin(np.radians(dec_max)))
+        # Counter-clockwise from ra_min, and clockwise from ra_max
+        after_min = np.cos(ra_min) * y - np.sin(ra_min) * x >= 0
+        before_max = np.sin(ra_max) * x - np.cos(ra_max) * y >= 0
+        if (ra_max - ra_min) % (2 * np.pi) <= np.pi:
+            mask &= after_min & before_max
+        else:
+            mask &= after_min | before_max
+        return mask
+
+    def bounding_cap(self) -> tuple[np.ndarray, float] | None:
+        """
+        The edges of the box are lines of constant ra and dec rather than great
+        circles, so we build the cap around points sampled along the edges. The
+        margin covers how far the edges can stray from the arcs between samples.
+        """
+        ra_min, dec_min, ra_max, dec_max = self.bounds
+        if dec_min > dec_max:
+            return None
+        n_samples = 32
+        width = (ra_max - ra_min) % 360
+        ras = ra_min + np.linspace(0, width, n_samples)
+        decs = np.linspace(dec_min, dec_max, n_samples)
+        # Bottom, top, left and right edges
+        edge_ra = np.concatenate(
+            [ras, ras, np.full(n_samples, ras[0]), np.full(n_samples, ras[-1])]
+        )
+        edge_dec = np.concatenate(
+            [np.full(n_samples, dec_min), np.full(n_samples, dec_max), decs, decs]
+        )
+        points = np.column_stack(lonlat_to_vector(edge_ra, edge_dec))
+        spacing = np.radians(max(width, dec_max - dec_min) / (n_samples - 1))
+        return _cap_around(points, margin=spacing**2)
+
     def generate_circular_tile(self, radius, *args, **kwargs):
         """
         Return a circular tile, drawn randomly from the region.
@@ -224,5 +287,17 @@ class CircularRegion(BaseRegion):
         return self._unitful_radius
 
     def contains(self, points: SkyCoord) -> bool | np.ndarray:
-        distance = self.center.separation(points)
-        return distance <= self.radius
+        vectors = np.column_stack(lonlat_to_vector(points.ra.deg, points.dec.deg))
+        contains = self.contains_vectors(vectors)
+        return contains[0] if points.isscalar else contains
+
+    def contains_vectors(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        A point is in the circle if the dot product of its unit vector with the
+        center's is at least cos(radius).
+        """
+        center = np.array(lonlat_to_vector(*self._center))
+        return vectors @ center >= np.cos(np.radians(self._radius))
+
+    def bounding_cap(self) -> tuple[np.ndarray, float]:
+        return np.array(lonlat_to_vector(*self._center)), np.radians(self._radius)
@@ -1,13 +1,44 @@
+import io
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 
+import astropy.units as u
+import healpy
 import pandas as pd
+from astropy.io import fits
+from astropy.wcs import WCS
 from sqlalchemy import MetaData, create_engine, text
 
-from heinlein.dtypes.catalog import load_config
+import heinlein
+from heinlein.dtypes import packed
+from heinlein.dtypes.catalog import get_coordinate_columns, load_config
+from heinlein.dtypes.handlers.catalog import HPIX_COLUMN, META_TABLE
 from heinlein.manager.manager import get_manager, initialize_dataset
 
+# Size of the pieces CSV files are split into for parsing
+INGEST_CHUNK_BYTES = 64 * 2**20
+# Number of rows written to the database per transaction
+INGEST_COMMIT_ROWS = 2_000_000
 
-def database_from_csvs(dataset_name: str, csvs: list[Path]):
+
+def database_from_csvs(
+    dataset_name: str, csvs: list[Path], nside: int = None, workers: int = None
+):
+    """
+    Build a catalog database from a set of CSV files, with one table per
+    survey region. The files are split into chunks that are parsed by a pool
+    of worker processes (one per CPU by default), and this process writes the
+    rows to the database in large transactions. Rows whose index_key is already
+    in the database are skipped.
+
+    Once everything is loaded, the tables get an indexed HEALPix pixel column
+    (see add_healpix_index) and a unique index on the index_key.
+    """
     try:
         manager = get_manager(dataset_name)
     except FileNotFoundError:
@@ -19,55 +50,322 @@ def database_from_csvs(dataset_name: str, csvs: list[Path]):
         raise KeyError("Catalog configuration not found in dataset configuration")
 
     db_path = csvs[0].parent / f"{dataset_name}.db"
-    engine = create_engine(f"sqlite:///{db_path}").connect()
-
     region_key = catalog_config["region"]
     index_key = catalog_config["index_key"]
+    aliases = {
+        alias: name
+        for name, names in load_config()["columns"].items()
+        for alias in names
+        if alias != name
+    }
+    chunks = [(csv, *byte_range) for csv in csvs for byte_range in _csv_chunks(csv)]
+    parse = partial(
+        _parse_chunk, region_key=region_key, index_key=index_key, aliases=aliases
+    )
 
-    meta = MetaData()
-    column_config = load_config()["columns"]
-    for csv in csvs:
-        data = pd.read_csv(csv)
-        for name, aliases in column_config.items():
-            for alias in aliases:
-                if alias in data.columns:
-                    data = data.rename({alias: name})
-
-        if region_key not in data.columns:
-            raise KeyError(f"Region key {region_key} not found in {csv.name}")
-        if index_key not in data.columns:
-            raise KeyError(f"Index key {index_key} not found in {csv.name}")
-        partitions = data.groupby(region_key)
-        for rname, partition in partitions:
-            meta.reflect(engine)
-            tables_in_db = meta.tables.keys()
-            if rname not in tables_in_db:
-                partition.to_sql(
-                    rname,
-                    engine,
-                    if_exists="fail",
-                )
+    con = sqlite3.connect(db_path)
+    # Nothing is lost if the load is interrupted, so the journal is kept in
+    # memory and writes aren't synced
+    con.execute("PRAGMA journal_mode = MEMORY")
+    con.execute("PRAGMA synchronous = OFF")
+    tables = {}
+    progress = _IngestProgress(len(chunks))
+    pending = 0
+    for parts in _map_chunks(parse, chunks, workers):
+        for tname, part in parts.items():
+            _insert_rows(con, tables, tname, part)
+            pending += len(part)
+        if pending >= INGEST_COMMIT_ROWS:
+            con.commit()
+            pending = 0
+        progress.update(sum(len(p) for p in parts.values()))
+    con.commit()
+    progress.finish()
 
-            else:
-                partition.to_sql(
-                    f"{rname}_temp",
-                    engine,
-                    if_exists="fail",
-                )
+    for tname in tables:
+        _remove_duplicates(con, tname, index_key)
+    con.commit()
+    con.close()
 
-                query = text(
-                    f"""
-                    INSERT INTO '{rname}'
-                    SELECT * FROM '{rname}_temp'
-                    WHERE {index_key} NOT IN (SELECT {index_key} FROM '{rname}')
-                    """
-                )
-                engine.execute(query)
-                engine.execute(text(f"DROP TABLE '{rname}_temp'"))
-                engine.commit()
+    # Indexes are built after the load, so the inserts never have to update them
+    add_healpix_index(db_path, nside, catalog_config)
+    con = sqlite3.connect(db_path)
+    with con:
+        for tname in tables:
+            con.execute(
+                f'CREATE UNIQUE INDEX IF NOT EXISTS "{tname}_{index_key}" '
+                f'ON "{tname}" ("{index_key}")'
+            )
+    con.close()
     return db_path
 
 
+def _csv_chunks(csv: Path) -> list[tuple[int, int]]:
+    """
+    Split the data in a CSV file (after the header) into byte ranges of about
+    INGEST_CHUNK_BYTES. The ranges are moved to line boundaries when they
+    are read, see _read_lines.
+    """
+    with open(csv, "rb") as f:
+        start = len(f.readline())
+    size = csv.stat().st_size
+    bounds = list(range(start, size, INGEST_CHUNK_BYTES)) + [size]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_lines(csv: Path, start: int, end: int) -> bytes:
+    # A chunk holds the lines that start in [start, end). The first line in
+    # the file starts the first chunk, so it is never cut in half.
+    with open(csv, "rb") as f:
+        f.seek(start - 1)
+        f.readline()
+        position = f.tell()
+        if position >= end:
+            return b""
+        data = f.read(end - position)
+        if not data.endswith(b"\n"):
+            data += f.readline()
+    return data
+
+
+def _parse_chunk(
+    csv: Path, start: int, end: int, region_key: str, index_key: str, aliases: dict
+) -> dict[str, pd.DataFrame]:
+    """
+    Parse a chunk of a CSV file, and split the rows by survey region. Runs in
+    the ingest worker processes.
+    """
+    header = pd.read_csv(csv, nrows=0).columns
+    data = _read_lines(csv, start, end)
+    if not data:
+        return {}
+    rows = pd.read_csv(io.BytesIO(data), header=None, names=header)
+    rows = rows.rename(columns=aliases)
+    if region_key not in rows.columns:
+        raise KeyError(f"Region key {region_key} not found in {csv.name}")
+    if index_key not in rows.columns:
+        raise KeyError(f"Index key {index_key} not found in {csv.name}")
+    return {str(rname): part for rname, part in rows.groupby(region_key, sort=False)}
+
+
+def _map_chunks(parse, chunks: list, workers: int = None):
+    """
+    Parse chunks in a pool of worker processes, yielding the results in order.
+    Only a few chunks are parsed ahead of the writer, which bounds how much
+    parsed data is held in memory at once.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from (parse(*chunk) for chunk in chunks)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        ahead = 2 * workers
+        futures = deque()
+        for chunk in chunks:
+            futures.append(pool.submit(parse, *chunk))
+            if len(futures) >= ahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def _insert_rows(con: sqlite3.Connection, tables: dict, tname: str, rows):
+    # tables holds the columns of each table that has been written to
+    if tname not in tables:
+        info = con.execute(f'PRAGMA table_info("{tname}")').fetchall()
+        if not info:
+            definition = ", ".join(
+                f'"{c}" {_sql_type(rows[c].dtype)}' for c in rows.columns
+            )
+            con.execute(f'CREATE TABLE "{tname}" ({definition})')
+            info = con.execute(f'PRAGMA table_info("{tname}")').fetchall()
+        tables[tname] = {c[1] for c in info}
+    missing = [c for c in rows.columns if c not in tables[tname]]
+    if missing:
+        raise KeyError(f"Columns {missing} not found in table {tname}")
+
+    columns = ", ".join(f'"{c}"' for c in rows.columns)
+    placeholders = ", ".join("?" * len(rows.columns))
+    # Rows already in the table are skipped by its unique index, if it has one
+    query = f'INSERT OR IGNORE INTO "{tname}" ({columns}) VALUES ({placeholders})'
+    con.executemany(query, zip(*(rows[c].tolist() for c in rows.columns)))
+
+
+def _remove_duplicates(con: sqlite3.Connection, tname: str, index_key: str):
+    # Keeps the first copy of each row, for tables that were loaded without
+    # their unique index
+    con.execute(
+        f"""
+        DELETE FROM "{tname}" WHERE rowid NOT IN (
+            SELECT MIN(rowid) FROM "{tname}" GROUP BY "{index_key}"
+        )
+        """
+    )
+
+
+def _sql_type(dtype) -> str:
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+class _IngestProgress:
+    """
+    Prints how many rows have been loaded so far, and how fast.
+    """
+
+    def __init__(self, n_chunks: int):
+        self.n_chunks = n_chunks
+        self.chunks = 0
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    def update(self, rows: int):
+        self.chunks += 1
+        self.rows += rows
+        print(f"\r{self._status()}", end="", flush=True)
+
+    def finish(self):
+        print(f"\r{self._status()}")
+
+    def _status(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = self.rows / elapsed if elapsed > 0 else 0
+        return (
+            f"Loaded {self.rows:,} rows from {self.chunks}/{self.n_chunks} chunks "
+            f"({rate:,.0f} rows/s)"
+        )
+
+
+def mask_stores_from_fits(path: Path, mask_key=0, workers: int = None) -> list[Path]:
+    """
+    Convert a directory of FITS mask planes into bit-packed stores (see
+    heinlein.dtypes.packed), written next to the FITS files. The mask plane
+    is read from the HDU given by mask_key, and the WCS from the primary HDU.
+    Files are converted in parallel by a pool of worker processes (one per
+    CPU by default).
+    """
+    files = sorted(f for f in path.glob("*.fits") if not f.name.startswith("."))
+    if not files:
+        raise FileNotFoundError(f"No FITS files found in {path}")
+    convert = partial(_pack_mask, mask_key=mask_key)
+    stores = []
+    for store in _map_chunks(convert, [(f,) for f in files], workers):
+        stores.append(store)
+        print(f"\rPacked {len(stores)}/{len(files)} mask planes", end="", flush=True)
+    print()
+    return stores
+
+
+def _pack_mask(fits_path: Path, mask_key) -> Path:
+    with fits.open(fits_path, memmap=True) as hdul:
+        header = WCS(hdul[0].header).to_header_string()
+        plane = hdul[mask_key].data
+        store = fits_path.with_suffix(packed.STORE_SUFFIX)
+        return packed.write_store(store, plane, header)
+
+
+def add_healpix_index(db_path: Path, nside: int = None, config: dict = {}):
+    """
+    Add a HEALPix pixel column (NEST ordering) to every table in a catalog
+    database, and index it. The catalog handler uses it to load only the rows
+    near a query instead of whole tables (see the "subregion" cache mode).
+    Tables are rewritten in pixel order, so the rows near a query are stored
+    close together on disk.
+
+    Rows added to a table after it was indexed are given a pixel the next
+    time this runs. The nside defaults to CATALOG_HPIX_NSIDE.
+    """
+    if nside is None:
+        nside = heinlein.get_option("CATALOG_HPIX_NSIDE")
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.begin() as con:
+        con.execute(
+            text(
+                f'CREATE TABLE IF NOT EXISTS "{META_TABLE}" '
+                "(key TEXT PRIMARY KEY, value TEXT)"
+            )
+        )
+        current = con.execute(
+            text(f"SELECT value FROM \"{META_TABLE}\" WHERE key = 'hpix_nside'")
+        ).scalar()
+        if current is not None and int(current) != nside:
+            raise ValueError(
+                f"Database {db_path} already has a pixel column at nside {current}"
+            )
+        con.execute(
+            text(f"INSERT OR REPLACE INTO \"{META_TABLE}\" VALUES ('hpix_nside', :n)"),
+            {"n": str(nside)},
+        )
+
+        sql = "SELECT name FROM sqlite_master WHERE type='table'"
+        tables = [t for (t,) in con.execute(text(sql)) if t != META_TABLE]
+        for tname in tables:
+            _add_pixel_column(con, tname, nside, config)
+            con.execute(
+                text(
+                    f'CREATE INDEX IF NOT EXISTS "{tname}_{HPIX_COLUMN}" '
+                    f'ON "{tname}" ("{HPIX_COLUMN}")'
+                )
+            )
+    engine.dispose()
+
+
+def _add_pixel_column(con, tname: str, nside: int, config: dict):
+    columns = [c[1] for c in con.execute(text(f'PRAGMA table_info("{tname}")'))]
+    ra, dec = get_coordinate_columns(columns, config)
+    new_table = HPIX_COLUMN not in columns
+    where = "" if new_table else f' WHERE "{HPIX_COLUMN}" IS NULL'
+    rows = pd.read_sql(
+        text(f'SELECT rowid AS row, "{ra}", "{dec}" FROM "{tname}"{where}'), con
+    )
+    if len(rows) == 0 and not new_table:
+        return
+
+    ra_unit, dec_unit = _coordinate_units(config)
+    pixels = healpy.ang2pix(
+        nside,
+        (rows[ra].to_numpy() * ra_unit).to_value(u.deg),
+        (rows[dec].to_numpy() * dec_unit).to_value(u.deg),
+        nest=True,
+        lonlat=True,
+    )
+    pixel_table = f"{tname}_{HPIX_COLUMN}_temp"
+    pd.DataFrame({"row": rows["row"], HPIX_COLUMN: pixels}).to_sql(
+        pixel_table, con, index=False, if_exists="replace"
+    )
+    if new_table:
+        sorted_table = f"{tname}_sorted_temp"
+        query = f"""
+            CREATE TABLE "{sorted_table}" AS
+            SELECT t.*, p."{HPIX_COLUMN}" FROM "{tname}" AS t
+            JOIN "{pixel_table}" AS p ON t.rowid = p.row
+            ORDER BY p."{HPIX_COLUMN}"
+            """
+        con.execute(text(query))
+        con.execute(text(f'DROP TABLE "{tname}"'))
+        con.execute(text(f'ALTER TABLE "{sorted_table}" RENAME TO "{tname}"'))
+    else:
+        query = f"""
+            UPDATE "{tname}" SET "{HPIX_COLUMN}" = (
+                SELECT p."{HPIX_COLUMN}" FROM "{pixel_table}" AS p
+                WHERE p.row = "{tname}".rowid
+            )
+            WHERE "{HPIX_COLUMN}" IS NULL
+            """
+        con.execute(text(query))
+    con.execute(text(f'DROP TABLE "{pixel_table}"'))
+
+
+def _coordinate_units(config: dict) -> tuple[u.Unit, u.Unit]:
+    columns = config.get("columns", {})
+    ra_unit = columns.get("ra", {}).get("unit", "deg")
+    dec_unit = columns.get("dec", {}).get("unit", "deg")
+    return getattr(u, ra_unit), getattr(u, dec_unit)
+
+
 def regularize_sqlite_databse(database_path: Path):
     engine = create_engine(f"sqlite:///{database_path}").connect()
     column_config = load_config()["columns"]
@@ -0,0 +1,20 @@
+import pytest
+
+from heinlein import get_option, set_option
+
+
+@pytest.fixture
+def option():
+    """
+    Set heinlein options for a single test. The old values are put back when
+    the test finishes, whether it passes or not.
+    """
+    saved = {}
+
+    def set_(name: str, value):
+        saved.setdefault(name, get_option(name))
+        set_option(name, value)
+
+    yield set_
+    for name, value in saved.items():
+        set_option(name, value)
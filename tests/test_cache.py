@@ -1,12 +1,27 @@
+import asyncio
 import gc
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import pytest
 from astropy.io import fits
+from astropy.table import Table
 
 from heinlein import set_option
+from heinlein.dtypes.catalog import Catalog
+from heinlein.dtypes.filters import apply_filters
+from heinlein.dtypes.handlers.handler import Handler
 from heinlein.dtypes.mask import Mask
-from heinlein.manager.cache import clear_cache, get_cache
+from heinlein.manager.cache import Cache, clear_cache, get_cache
+from heinlein.manager.manager import DataManager
+from heinlein.manager.policy import get_policy
+from heinlein.manager.shared import SharedMemoryCache
+from heinlein.manager.spill import SpillCache
 
 DATA_PATH = Path("/home/data")
 DES_MASK_PATH = DATA_PATH / "des" / "mask" / "plane"
@@ -43,8 +58,8 @@ def test_replacement(cache, masks):
     mask2 = {"mask": {keys[1]: masks[keys[1]]}}
     mask3 = {"mask": {keys[2]: masks[keys[2]]}}
     cache.add(mask1)
-    _ = cache.get(keys[0], "mask")
     cache.add(mask2)
+    _ = cache.get(keys[0], "mask")
     cache.add(mask3)
     with pytest.raises(KeyError):
         cache.get(keys[1], "mask")
@@ -65,3 +80,347 @@ def test_clear(cache, masks):
     with pytest.raises(KeyError):
         cache.get(keys[0], "mask")
     assert cache.size == 0 and not cache.sizes and not cache.cache
+
+
+def make_catalog(n=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    data = Table(
+        {
+            "ra": rng.uniform(10, 11, n),
+            "dec": rng.uniform(-1, 1, n),
+            "mag": rng.uniform(18, 26, n),
+        }
+    )
+    return Catalog(data)
+
+
+def test_lru_order():
+    catalogs = {f"region{i}": make_catalog(seed=i) for i in range(3)}
+    size = catalogs["region0"].estimate_size()
+    cache = Cache(2.5 * size)
+    cache.add({"catalog": {"region0": catalogs["region0"]}})
+    cache.add({"catalog": {"region1": catalogs["region1"]}})
+    cache.get("region0", "catalog")
+    cache.add({"catalog": {"region2": catalogs["region2"]}})
+    assert set(cache.cache.keys()) == {"region0", "region2"}
+    assert cache.size == 2 * size
+
+
+def test_pinning():
+    catalogs = {f"region{i}": make_catalog(seed=i) for i in range(3)}
+    size = catalogs["region0"].estimate_size()
+    cache = Cache(2.5 * size)
+    with cache.pinning(["region0", "region1"]):
+        cache.add({"catalog": {"region0": catalogs["region0"]}})
+        cache.add({"catalog": {"region1": catalogs["region1"]}})
+        with pytest.raises(MemoryError):
+            cache.add({"catalog": {"region2": catalogs["region2"]}})
+    cache.add({"catalog": {"region2": catalogs["region2"]}})
+    assert len(cache.cache) == 2 and "region2" in cache.cache
+
+
+@pytest.mark.parametrize("policy", ["lru", "lfu", "gds"])
+def test_policy_evicts_everything(policy):
+    p = get_policy(policy)
+    for i in range(10):
+        p.insert(i, size=i + 1, cost=1.0)
+    for i in range(0, 10, 2):
+        p.access(i)
+    p.remove(3)
+    evicted = [p.evict() for _ in range(len(p))]
+    assert sorted(evicted) == [i for i in range(10) if i != 3]
+    with pytest.raises(KeyError):
+        p.evict()
+
+
+def test_lfu_order():
+    p = get_policy("lfu")
+    for i in range(3):
+        p.insert(i, 1)
+    p.access(0)
+    p.access(0)
+    p.access(2)
+    assert [p.evict() for _ in range(3)] == [1, 2, 0]
+
+
+def test_gds_order():
+    p = get_policy("gds")
+    p.insert("big", size=100, cost=1.0)
+    p.insert("small", size=1, cost=1.0)
+    p.insert("slow", size=100, cost=1000.0)
+    assert [p.evict() for _ in range(3)] == ["big", "small", "slow"]
+
+
+def test_spill(tmp_path):
+    catalogs = {f"region{i}": make_catalog(seed=i) for i in range(3)}
+    size = catalogs["region0"].estimate_size()
+    spill = SpillCache(tmp_path, 1e9)
+    cache = Cache(2.5 * size, spill=spill)
+    for name, catalog in catalogs.items():
+        cache.add({"catalog": {name: catalog}})
+    evicted = [n for n in catalogs if n not in cache.cache]
+    assert len(evicted) == 1
+    assert spill.has_data(evicted[0], "catalog")
+
+    restored = cache.get(evicted[0], "catalog")["catalog"]
+    original = catalogs[evicted[0]]
+    assert np.all(restored._data["mag"] == original._data["mag"])
+    assert restored._data["ra"].unit == original._data["ra"].unit
+    assert not restored._data["mag"].flags.writeable  # memory-mapped
+
+    cache.empty()
+    assert spill.size == 0 and not list(spill.path.iterdir())
+
+
+def test_shared_memory():
+    dataset = f"test_{uuid.uuid4().hex}"
+    catalog = make_catalog()
+    owner = SharedMemoryCache(dataset, 1e9)
+    other = SharedMemoryCache(dataset, 1e9)
+    owner.add({"catalog": {"region0": catalog}})
+
+    shared = other.get("region0", "catalog")["catalog"]
+    assert np.all(shared._data["mag"] == catalog._data["mag"])
+    assert not shared._data["mag"].flags.writeable  # backed by the segment
+
+    column = shared._data["mag"]
+    del shared
+    owner.empty()
+    other.empty()
+    gc.collect()
+    with pytest.raises(KeyError):
+        SharedMemoryCache(dataset, 1e9).get("region0", "catalog")
+    # Views of the data outlive the cache entries and the segment's name
+    assert np.all(column == catalog._data["mag"])
+
+
+def read_shared_column(dataset: str):
+    # Runs in a child process
+    try:
+        shared = SharedMemoryCache(dataset, 1e9).get("region0", "catalog")
+    except KeyError:
+        return None
+    return np.array(shared["catalog"]._data["mag"])
+
+
+def test_shared_memory_processes():
+    dataset = f"test_{uuid.uuid4().hex}"
+    catalog = make_catalog()
+    owner = SharedMemoryCache(dataset, 1e9)
+    owner.add({"catalog": {"region0": catalog}})
+    segment = Path("/dev/shm") / owner.segment_name("region0", "catalog")
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        column = pool.apply(read_shared_column, (dataset,))
+        assert np.all(column == catalog._data["mag"])
+        owner.empty()
+        assert pool.apply(read_shared_column, (dataset,)) is None
+    assert not segment.exists()
+
+
+def test_shared_memory_failed_add():
+    dataset = f"test_{uuid.uuid4().hex}"
+    catalog = make_catalog()
+    cache = SharedMemoryCache(dataset, catalog.estimate_size() / 2)
+    with pytest.raises(MemoryError):
+        cache.add({"catalog": {"region0": catalog}})
+    # The segment the catalog was published into is unlinked again
+    assert not cache._owned
+    with pytest.raises(KeyError):
+        SharedMemoryCache(dataset, 1e9).get("region0", "catalog")
+
+
+def test_stats():
+    catalogs = {f"region{i}": make_catalog(seed=i) for i in range(3)}
+    size = catalogs["region0"].estimate_size()
+    cache = Cache(2.5 * size)
+    for name, catalog in catalogs.items():
+        cache.add({"catalog": {name: catalog}})
+    cache.get({"region1", "region2", "region0"}, ["catalog"])
+    stats = cache.stats.snapshot()
+    assert stats["hits"] == 2 and stats["misses"] == 1
+    assert stats["by_region"]["region0"] == {"hits": 0, "misses": 1}
+    assert stats["evictions"] == 1 and stats["bytes_evicted"] == size
+
+    cache.stats.reset()
+    assert cache.stats.snapshot()["hits"] == 0
+
+    # Snapshots can be taken while other threads record new regions
+    def record(start):
+        for i in range(start, start + 20000):
+            cache.stats.record_miss(f"region{i}", "catalog")
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(record, i * 20000) for i in range(4)]
+        while not all(future.done() for future in futures):
+            cache.stats.snapshot()
+        for future in futures:
+            future.result()
+    assert cache.stats.snapshot()["misses"] == 80000
+
+
+class SlowHandler(Handler):
+    def __init__(self):
+        self.calls = []
+
+    def get_data(self, region_names, *args, **kwargs):
+        self.calls.extend(region_names)
+        time.sleep(0.2)
+        return {name: make_catalog() for name in region_names}
+
+
+class ColumnHandler(Handler):
+    supports_columns = True
+
+    def __init__(self):
+        self.requests = []
+
+    def get_data(self, region_names, *args, columns=None, **kwargs):
+        self.requests.append(columns)
+        rng = np.random.default_rng(0)
+        data = Table({name: rng.uniform(size=100) for name in ["mag", "flux", "size"]})
+        data["ra"] = np.linspace(10, 11, 100)
+        data["dec"] = np.linspace(-1, 1, 100)
+        if columns is not None:
+            data = data[["ra", "dec"] + list(columns)]
+        return {
+            name: Catalog(data.copy(), partial=columns is not None)
+            for name in region_names
+        }
+
+
+class FilterHandler(ColumnHandler):
+    supports_filters = True
+
+    def __init__(self):
+        super().__init__()
+        self.filters = []
+
+    def get_data(self, region_names, *args, filters=(), **kwargs):
+        self.filters.append(filters)
+        data = super().get_data(region_names, *args, **kwargs)
+        return {
+            name: Catalog(apply_filters(obj.select_columns(), filters))
+            for name, obj in data.items()
+        }
+
+
+def make_manager(handler=None):
+    """
+    A DataManager for a made-up dataset whose catalogs take a while to load
+    """
+    manager = DataManager.__new__(DataManager)
+    manager.name = f"test_{uuid.uuid4().hex}"
+    manager.external = None
+    manager._external_definitions = {}
+    manager.config = {"data": {"catalog": {}}}
+    manager._handlers = {"catalog": handler or SlowHandler()}
+    manager._inflight = {}
+    manager._inflight_lock = threading.Lock()
+    manager._handler_lock = threading.Lock()
+    return manager
+
+
+def test_single_flight(option):
+    manager = make_manager()
+    option("LOADER_THREADS", 4)
+    regions = [["region0", "region1"], ["region1", "region2"], ["region0"]]
+    with ThreadPoolExecutor(3) as pool:
+        results = list(pool.map(lambda r: manager.get_from(["catalog"], r), regions))
+
+    assert sorted(manager._handlers["catalog"].calls) == [
+        "region0",
+        "region1",
+        "region2",
+    ]
+    assert results[0]["catalog"]["region1"] is results[1]["catalog"]["region1"]
+    assert list(results[1]["catalog"]) == ["region1", "region2"]
+    assert not manager._inflight
+
+
+def test_async_cancel(option):
+    manager = make_manager()
+    option("LOADER_THREADS", 1)
+
+    async def query():
+        task = asyncio.create_task(
+            manager.aget_from(["catalog"], ["region0", "region1", "region2"])
+        )
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # A second query picks up the region the first one had started loading
+        return await manager.aget_from(["catalog"], ["region0", "region1"])
+
+    result = asyncio.run(query())
+    assert list(result["catalog"]) == ["region0", "region1"]
+    assert manager._handlers["catalog"].calls == ["region0", "region1"]
+    assert not manager._inflight
+
+
+def test_column_pushdown():
+    manager = make_manager(ColumnHandler())
+    handler = manager._handlers["catalog"]
+    catalog = manager.get_from(["catalog"], ["region0"], columns=["mag"])
+    assert catalog["catalog"]["region0"].columns == ["ra", "dec", "mag"]
+
+    # Narrower requests are served from the cache, wider ones only load
+    # the columns that are missing
+    manager.get_from(["catalog"], ["region0"], columns=["mag"])
+    catalog = manager.get_from(["catalog"], ["region0"], columns=["mag", "flux"])
+    obj = catalog["catalog"]["region0"]
+    assert obj.columns == ["ra", "dec", "mag", "flux"] and obj.partial
+    catalog = manager.get_from(["catalog"], ["region0"])
+    assert not catalog["catalog"]["region0"].partial
+    assert handler.requests == [["mag"], ["flux"], None]
+
+
+class ReorderingHandler(ColumnHandler):
+    """
+    Returns the second set of columns it is asked for in a different row order,
+    and nothing after that.
+    """
+
+    def get_data(self, region_names, *args, columns=None, **kwargs):
+        if len(self.requests) == 2:
+            self.requests.append(columns)
+            return {}
+        data = super().get_data(region_names, *args, columns=columns, **kwargs)
+        if len(self.requests) == 2:
+            return {
+                name: Catalog(obj.select_columns()[::-1], partial=True)
+                for name, obj in data.items()
+            }
+        return data
+
+
+def test_column_reload_missing():
+    manager = make_manager(ReorderingHandler())
+    handler = manager._handlers["catalog"]
+    first = manager.get_from(["catalog"], ["region0"], columns=["mag"])
+    catalog = manager.get_from(["catalog"], ["region0"], columns=["mag", "flux"])
+    # The reload of every column came back empty, so the cached object is kept
+    assert catalog["catalog"]["region0"] is first["catalog"]["region0"]
+    assert handler.requests == [["mag"], ["flux"], ["ra", "dec", "mag", "flux"]]
+
+
+def test_filter_pushdown():
+    manager = make_manager(FilterHandler())
+    handler = manager._handlers["catalog"]
+    filters = [("mag", "<", 0.5)]
+    catalog = manager.get_from(["catalog"], ["region0"], filters=filters)
+    obj = catalog["catalog"]["region0"]
+    assert 0 < len(obj) < 100
+    assert np.all(obj.select_columns()["mag"] < 0.5)
+
+    # Filtered data is cached apart from the full data
+    manager.get_from(["catalog"], ["region0"], filters=filters)
+    catalog = manager.get_from(["catalog"], ["region0"])
+    assert len(catalog["catalog"]["region0"]) == 100
+    assert handler.filters == [(("mag", "<", 0.5),), ()]
+
+    # Handlers that can't filter are never passed filters
+    manager = make_manager(ColumnHandler())
+    catalog = manager.get_from(["catalog"], ["region0"], filters=filters)
+    assert len(catalog["catalog"]["region0"]) == 100
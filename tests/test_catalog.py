@@ -0,0 +1,265 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.table import MaskedColumn, Table
+from pydantic import ValidationError
+
+from heinlein import get_option
+from heinlein.dtypes.catalog import Catalog, pixel_region_name
+from heinlein.dtypes.filters import filters_to_sql, normalize_filters
+from heinlein.dtypes.handlers import sidecar
+from heinlein.dtypes.handlers.catalog import CsvCatalogHandler, SQLiteCatalogHandler
+from heinlein.dtypes.handlers.sqlite import column_types, iter_tables, read_table
+from heinlein.region import Region
+from heinlein.region.footprint import get_healpix_pixels
+from heinlein.utilities.prep import add_healpix_index
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    rng = np.random.default_rng(0)
+    n = 50000
+    data = Table(
+        {
+            "ra": rng.uniform(10, 12, n),
+            "dec": rng.uniform(-1, 1, n),
+            "mag": rng.normal(size=n),
+        }
+    )
+    return Catalog(data)
+
+
+@pytest.mark.parametrize(
+    "region",
+    [
+        Region.circle(center=(11, 0), radius=45 * u.arcsec),
+        Region.circle(center=(10.1, 0.9), radius=10 * u.arcmin),
+        Region.box((10.5, -0.2, 10.7, 0.3)),
+        Region.box((9, -2, 13, 2)),
+    ],
+)
+def test_spatial_index(catalog, region, option):
+    option("CATALOG_INDEX_NSIDE", 0)
+    expected = catalog.get_data_from_region(region)
+
+    option("CATALOG_INDEX_NSIDE", 8192)
+    found = catalog.get_data_from_region(region)
+    assert catalog._index is not None
+    assert len(found) == len(expected) > 0
+    assert np.all(found["mag"] == expected["mag"])
+
+
+@pytest.mark.parametrize(
+    "name", ["CATALOG_INDEX_NSIDE", "CATALOG_HPIX_NSIDE", "CATALOG_SUBREGION_NSIDE"]
+)
+def test_nside_options(name, option):
+    option(name, 1024)
+    with pytest.raises(ValidationError):
+        option(name, 5000)
+    assert get_option(name) == 1024
+
+
+def test_index_size(catalog, option):
+    catalog = Catalog(catalog._data)
+    option("CATALOG_INDEX_NSIDE", 8192)
+    with_index = catalog.estimate_size()
+    option("CATALOG_INDEX_NSIDE", 0)
+    catalog.size = None
+    assert with_index - catalog.estimate_size() == 16 * len(catalog)
+
+    # Once the index is built, its arrays are counted whatever the option says
+    catalog._get_index(8192)
+    catalog.size = None
+    assert catalog.estimate_size() == with_index
+
+
+def test_query_cones(catalog, option):
+    rng = np.random.default_rng(1)
+    ra = rng.uniform(9.9, 12.1, 200)
+    dec = rng.uniform(-1.1, 1.1, 200)
+    radius = rng.uniform(10, 120, 200) / 3600
+    offsets, indices = catalog.query_cones(ra, dec, radius)
+    assert len(offsets) == 201 and offsets[-1] == len(indices) > 0
+    coords = SkyCoord(catalog._data["ra"], catalog._data["dec"])
+    for i in range(len(ra)):
+        center = SkyCoord(ra[i], dec[i], unit="deg")
+        expected = np.flatnonzero(coords.separation(center).deg <= radius[i])
+        assert np.array_equal(indices[offsets[i] : offsets[i + 1]], expected)
+
+    # Without the index, every row is checked and no index is built
+    option("CATALOG_INDEX_NSIDE", 0)
+    unindexed = Catalog(catalog._data)
+    scanned = unindexed.query_cones(ra, dec, radius)
+    assert unindexed._index is None
+    assert np.array_equal(scanned[0], offsets)
+    assert np.array_equal(scanned[1], indices)
+
+
+def test_lazy_coordinates(catalog):
+    region = Region.circle(center=(11, 0), radius=5 * u.arcmin)
+    found = catalog.get_data_from_region(region)
+    assert "coordinates" not in found.colnames
+    coords = found["coordinates"]
+    assert isinstance(coords, SkyCoord) and len(coords) == len(found)
+    assert np.all(coords.separation(SkyCoord(11, 0, unit="deg")) <= 5 * u.arcmin)
+
+
+def test_filters(catalog):
+    region = Region.circle(center=(11, 0), radius=20 * u.arcmin)
+    filters = normalize_filters([("mag", "<", np.float64(0.5)), ("mag", ">=", -1)])
+    found = catalog.get_data_from_region(region, filters=filters)
+    everything = catalog.get_data_from_region(region)
+    expected = everything[(everything["mag"] < 0.5) & (everything["mag"] >= -1)]
+    assert np.array_equal(found["mag"], expected["mag"])
+    assert normalize_filters(reversed(filters)) == filters
+
+    clause, params = filters_to_sql(normalize_filters([("flag", "in", [1, 2])]))
+    assert clause == '"flag" IN (:f0_0, :f0_1)' and params == {"f0_0": 1, "f0_1": 2}
+    with pytest.raises(ValueError):
+        normalize_filters([("mag", "~", 1)])
+
+
+def test_pixel_loading(tmp_path):
+    rng = np.random.default_rng(1)
+    n = 20000
+    data = Table(
+        {
+            "id": np.arange(n),
+            "tile": np.full(n, "T0"),
+            "ra": rng.uniform(10, 12, n),
+            "dec": rng.uniform(-1, 1, n),
+        }
+    )
+    path = tmp_path / "catalog.db"
+    with sqlite3.connect(path) as con:
+        data.to_pandas().to_sql("T0", con, index=False)
+    add_healpix_index(path, 1024)
+    handler = SQLiteCatalogHandler(path, {"region": "tile"})
+    assert handler.pixel_nside == 1024
+
+    region = Region.circle(center=(11, 0), radius=10 * u.arcmin)
+    pixels = get_healpix_pixels(region, 512)
+    names = [pixel_region_name("T0", 512, p) for p in pixels]
+    loaded = handler.get_data(names, columns=["id"])
+    assert list(loaded) == names
+    assert sum(len(obj) for obj in loaded.values()) < n / 10
+    found = np.concatenate(
+        [obj.get_data_from_region(region)["id"] for obj in loaded.values()]
+    )
+    expected = Catalog(data).get_data_from_region(region)["id"]
+    assert np.array_equal(np.sort(found), np.sort(expected))
+
+
+def test_sqlite_reader():
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE t (id BIGINT, mag FLOAT, name TEXT, flag INTEGER)")
+    rows = [(i, i / 2, f"obj{i}", None if i % 7 == 0 else i % 2) for i in range(1000)]
+    con.executemany("INSERT INTO t VALUES (?, ?, ?, ?)", rows)
+    types = column_types(con, "t")
+    query = "SELECT * FROM t WHERE id >= :start"
+
+    table = read_table(con, query, {"start": 10}, types, batch_size=64)
+    assert len(table) == 990 and table.colnames == ["id", "mag", "name", "flag"]
+    assert table["id"].dtype == np.int64 and table["name"][0] == "obj10"
+    assert np.array_equal(table["flag"].mask, table["id"] % 7 == 0)
+
+    batches = list(iter_tables(con, query, {"start": 10}, types, batch_size=64))
+    assert [len(b) for b in batches] == [64] * 15 + [30]
+    assert np.array_equal(np.concatenate([b["mag"] for b in batches]), table["mag"])
+
+
+def test_sqlite_connections(tmp_path):
+    path = tmp_path / "catalog.db"
+    with sqlite3.connect(path) as con:
+        con.execute("CREATE TABLE T0 (id INTEGER, ra REAL, dec REAL)")
+        con.executemany("INSERT INTO T0 VALUES (?, ?, ?)", [(1, 10.0, 0.0)])
+    con.close()
+
+    handler = SQLiteCatalogHandler(path, {})
+    assert not handler._connections  # Nothing is opened until it is needed
+    with ThreadPoolExecutor(2) as pool:
+        barrier = threading.Barrier(2)
+
+        def load(_):
+            barrier.wait()
+            return len(handler.get_data(["T0"])["T0"])
+
+        assert list(pool.map(load, range(2))) == [1, 1]
+    assert len(handler._connections) == 2
+    with pytest.raises(sqlite3.OperationalError):
+        handler._connection().execute("DELETE FROM T0")
+    handler.close()
+    assert len(handler.get_data(["T0"])["T0"]) == 1
+
+
+def test_shared_table_split(tmp_path):
+    path = tmp_path / "catalog.db"
+    rows = [(i, f"T{i % 3}", i % 4, 10.0 + i / 100, 0.0) for i in range(120)]
+    with sqlite3.connect(path) as con:
+        con.execute(
+            "CREATE TABLE objects (id INTEGER, tile TEXT, patch INTEGER, ra REAL, dec REAL)"
+        )
+        con.executemany("INSERT INTO objects VALUES (?, ?, ?, ?, ?)", rows)
+    con.close()
+
+    handler = SQLiteCatalogHandler(path, {"region": "tile"})
+    names = ["T0", "T2", "T5"]
+    assert handler.partition_regions(names) == [names]
+    loaded = handler.get_data(names)
+    assert [len(loaded[n]) for n in names] == [40, 40, 0]
+    assert np.array_equal(loaded["T2"].select_columns()["id"], np.arange(2, 120, 3))
+
+    handler = SQLiteCatalogHandler(path, {"region": "tile", "subregion": "patch"})
+    names = ["T0.1", "T1.3", "T3.0", "T2.9"]
+    assert handler.partition_regions(names) == [names]
+    loaded = handler.get_data(names, filters=[("id", "<", 60)])
+    assert [len(loaded[n]) for n in names] == [5, 5, 0, 0]
+    assert np.array_equal(loaded["T1.3"].select_columns()["id"], [7, 19, 31, 43, 55])
+
+
+def memory_mapped(array: np.ndarray) -> bool:
+    while array is not None and not isinstance(array, np.memmap):
+        array = getattr(array, "base", None)
+    return array is not None
+
+
+def test_csv_sidecar(tmp_path, option):
+    catalogs = tmp_path / "catalogs"
+    catalogs.mkdir()
+    n = 500
+    data = Table(
+        {
+            "id": np.arange(n),
+            "ra": np.linspace(10, 11, n),
+            "dec": np.zeros(n),
+            "name": [f"obj{i}" for i in range(n)],
+            "mag": MaskedColumn(np.linspace(20, 25, n), mask=np.arange(n) % 7 == 0),
+        }
+    )
+    data.write(catalogs / "T0.csv")
+    option("CATALOG_SIDECAR_DIR", tmp_path / "sidecars")
+    handler = CsvCatalogHandler(catalogs, {})
+
+    first = handler.get_data(["T0"])["T0"].select_columns()
+    assert sidecar.read_sidecar(catalogs / "T0.csv") is not None
+    second = handler.get_data(["T0"], columns=["name"])["T0"].select_columns()
+    assert not second["name"].flags.writeable  # Memory mapped read only
+    assert second.colnames == ["ra", "dec", "name"]
+    assert np.array_equal(first["name"], second["name"])
+    # Masked columns are memory mapped too
+    mag = sidecar.read_sidecar(catalogs / "T0.csv", ["mag"])["mag"]
+    assert mag.mask.sum() == len(range(0, n, 7))
+    assert memory_mapped(mag.data.data)
+
+    # Sidecars are rebuilt when the file changes
+    data[:10].write(catalogs / "T0.csv", overwrite=True)
+    os.utime(catalogs / "T0.csv", ns=(0, 0))
+    assert sidecar.read_sidecar(catalogs / "T0.csv") is None
+    assert len(handler.get_data(["T0"])["T0"]) == 10
+    assert sidecar.build_sidecars(catalogs, workers=1) == {catalogs / "T0.csv": False}
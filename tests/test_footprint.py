@@ -0,0 +1,57 @@
+import astropy.units as u
+import numpy as np
+
+from heinlein.region import Region
+from heinlein.region.footprint import Footprint, get_lonlat_bounds
+
+
+def make_footprint():
+    # A strip of 1x1 degree tiles crossing the 0/360 line
+    regions = []
+    for ra in range(-5, 5):
+        for dec in range(-2, 2):
+            bounds = (ra % 360, dec, (ra + 1) % 360, dec + 1)
+            regions.append(Region.box(bounds, name=f"{ra}_{dec}"))
+    return Footprint(regions)
+
+
+def test_lonlat_bounds():
+    lon_min, lat_min, lon_max, lat_max = get_lonlat_bounds(
+        Region.box((0, 50, 60, 60)).spherical_geometry
+    )
+    assert np.isclose(lon_min, 0) and np.isclose(lon_max, 60)
+    # The top edge is a great circle, which bulges towards the pole
+    assert lat_min == 50 and lat_max > 63
+
+    lon_min, _, lon_max, _ = get_lonlat_bounds(
+        Region.box((350, -1, 10, 1)).spherical_geometry
+    )
+    assert np.isclose(lon_min, -10) and np.isclose(lon_max, 10)
+
+
+def test_batch_overlaps():
+    footprint = make_footprint()
+    rng = np.random.default_rng(0)
+    centers = zip(rng.uniform(-6, 6, 30) % 360, rng.uniform(-3, 3, 30))
+    queries = [
+        Region.circle(center=(ra, dec), radius=20 * u.arcmin) for ra, dec in centers
+    ]
+    batch = footprint.get_overlapping_region_names(queries)
+    for query, names in zip(queries, batch):
+        expected = {r.name for r in footprint._region_list if r.intersects(query)}
+        assert set(names) == expected
+        assert len(names) == len(expected)
+
+
+def test_cones_near_regions():
+    footprint = make_footprint()
+    rng = np.random.default_rng(1)
+    ra = rng.uniform(-6, 6, 200) % 360
+    dec = rng.uniform(-3, 3, 200)
+    near = footprint.get_cones_near_regions(ra, dec, 1 / 3)
+    for region in footprint._region_list:
+        cones = set(near.get(region.name, []))
+        for index, (ra_, dec_) in enumerate(zip(ra, dec)):
+            cone = Region.circle(center=(ra_, dec_), radius=20 * u.arcmin)
+            if region.intersects(cone):
+                assert index in cones
@@ -0,0 +1,250 @@
+import threading
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from shapely.geometry import Point
+
+from heinlein.dtypes import mask as mask_module
+from heinlein.dtypes import moc, packed
+from heinlein.dtypes.handlers.mask import FitsMaskHandler
+from heinlein.dtypes.mask import Mask, _lazyFitsMask, _mocMask
+from heinlein.region import Region
+from heinlein.utilities.prep import mask_stores_from_fits
+
+
+def make_plane(size=200, scale=0.01):
+    """
+    A FITS mask plane centered on (11, 0), with a masked stripe down the middle.
+    """
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+    wcs.wcs.crval = [11, 0]
+    wcs.wcs.crpix = [size / 2, size / 2]
+    wcs.wcs.cdelt = [-scale, scale]
+    wcs.wcs.cunit = ["deg", "deg"]
+    plane = np.zeros((size, size), dtype=np.int32)
+    plane[:, size // 2 - 20 : size // 2 + 20] = 1
+    return fits.HDUList([fits.PrimaryHDU(header=wcs.to_header()), fits.ImageHDU(plane)])
+
+
+@pytest.fixture
+def mask():
+    rng = np.random.default_rng(2)
+    stars = [
+        Point(ra, dec).buffer(0.05)
+        for ra, dec in rng.uniform(10.2, 11.8, (30, 2)) - (0, 11)
+    ]
+    return Mask([make_plane()], mask_key=1).append([Mask(stars)])
+
+
+@pytest.fixture
+def catalog():
+    rng = np.random.default_rng(3)
+    n = 5000
+    return Table(
+        {"ra": rng.uniform(10, 12, n), "dec": rng.uniform(-1, 1, n), "id": np.arange(n)}
+    )
+
+
+def test_evaluate(mask, catalog):
+    keep = mask.evaluate(catalog)
+    assert keep.dtype == bool and 0 < keep.sum() < len(catalog)
+
+    # Same as applying the layers one at a time
+    layered = catalog
+    for layer in mask._masks:
+        layered = layer.mask(layered)
+    assert np.array_equal(catalog["id"][keep], layered["id"])
+
+    coords = SkyCoord(catalog["ra"], catalog["dec"], unit="deg")
+    assert np.array_equal(mask.evaluate(coords), keep)
+    assert np.array_equal(mask.evaluate((catalog["ra"], catalog["dec"])), keep)
+    assert np.array_equal(mask.mask(catalog)["id"], layered["id"])
+
+
+def test_region_mask():
+    # Region masks are flat shapes in ra/dec degrees
+    stars = Mask([Point(11, 0.5).buffer(0.1), Point(10.5, -0.5).buffer(0.2)])
+    ra = np.array([11, 11.05, 10.5, 11.5, 10.5])
+    dec = np.array([0.5, 0.5, -0.35, 0, -0.75])
+    keep = stars.evaluate((ra, dec))
+    assert np.array_equal(keep, [False, False, False, True, True])
+
+
+def test_region_mask_matches_per_point(mask, catalog):
+    # The bulk tree query gives the same result as checking one point at a time
+    layer = mask._masks[1]
+    expected = np.ones(len(catalog), dtype=bool)
+    for index, (ra, dec) in enumerate(zip(catalog["ra"], catalog["dec"])):
+        point = Point(ra, dec)
+        for candidate in layer._geo_tree.query(point):
+            if layer._geo_list[candidate].contains(point):
+                expected[index] = False
+                break
+    assert 0 < expected.sum() < len(catalog)
+    assert np.array_equal(layer.evaluate(catalog["ra"], catalog["dec"]), expected)
+
+
+def test_lazy_fits(tmp_path, catalog, monkeypatch):
+    path = tmp_path / "mask.fits"
+    make_plane().writeto(path)
+    eager = Mask([make_plane()], mask_key=1)
+    with fits.open(path) as hdul:
+        lazy = Mask([hdul], mask_key=1)
+    assert isinstance(lazy._masks[0], _lazyFitsMask)
+    assert np.array_equal(lazy.evaluate(catalog), eager.evaluate(catalog))
+
+    # The plane is read a tile at a time, and only a tile is charged for it
+    windows = []
+    read = fits.hdu.image.Section.__getitem__
+    with monkeypatch.context() as m:
+        m.setattr(mask_module, "LAZY_TILE_SIZE", 64)
+        m.setattr(
+            fits.hdu.image.Section,
+            "__getitem__",
+            lambda section, key: windows.append(read(section, key)) or windows[-1],
+        )
+        assert 64 * 64 * 4 < lazy.estimate_size() < eager.estimate_size() / 4
+        assert np.array_equal(lazy.evaluate(catalog), eager.evaluate(catalog))
+    assert len(windows) > 1
+    assert max(max(window.shape) for window in windows) <= 64
+
+    region = Region.box((10.7, -0.3, 11.2, 0.2))
+    window = lazy.get_data_from_region(region)
+    assert window.estimate_size() < eager.estimate_size() / 4
+    inside = (
+        (catalog["ra"] > 10.75)
+        & (catalog["ra"] < 11.15)
+        & (catalog["dec"] > -0.25)
+        & (catalog["dec"] < 0.15)
+    )
+    expected = eager.evaluate(catalog[inside])
+    assert not expected.all()
+    assert np.array_equal(window.evaluate(catalog[inside]), expected)
+
+    rebuilt = Mask.from_arrays(*lazy.to_arrays())
+    assert np.array_equal(rebuilt.evaluate(catalog), eager.evaluate(catalog))
+
+    # The file is only open while the masks read from it
+    fds = Path("/proc/self/fd")
+    if fds.exists():
+        open_files = len(list(fds.iterdir()))
+        masks = [Mask.from_arrays(*lazy.to_arrays()) for _ in range(50)]
+        for mask in masks:
+            mask.evaluate(catalog)
+        assert len(list(fds.iterdir())) == open_files
+
+
+def test_moc(tmp_path, mask, catalog):
+    uniq = np.array(
+        [4 * 4**3 + 5, 4 * 4**5 + 100, 4 * 4**5 + 101, 4 * 4**5 + 102]
+    )
+    starts, ends = moc.uniq_to_ranges(uniq, 8)
+    assert np.array_equal(moc.ranges_to_uniq(starts, ends, 8), uniq)
+    assert np.array_equal(_mocMask.from_uniq(uniq).uniq, uniq)
+
+    converted = mask.to_moc(14)
+    assert len(converted) == 1
+    keep = mask.evaluate(catalog)
+    assert np.mean(converted.evaluate(catalog) == keep) > 0.98
+    # The FITS plane masks a 0.4 x 2 degree stripe
+    plane_moc = mask._masks[0].to_moc(14)
+    assert plane_moc.area() == pytest.approx(0.8, rel=0.02)
+
+    path = tmp_path / "mask.moc.fits"
+    converted._masks[0].to_hdu().writeto(path)
+    with fits.open(path) as hdul:
+        loaded = Mask([hdul])
+    assert np.array_equal(loaded.evaluate(catalog), converted.evaluate(catalog))
+    assert np.array_equal(
+        Mask.from_arrays(*converted.to_arrays()).evaluate(catalog),
+        converted.evaluate(catalog),
+    )
+
+
+def test_packed_mask(tmp_path, catalog):
+    rng = np.random.default_rng(4)
+    plane = (rng.uniform(size=(300, 200)) < 0.1).astype(np.int32)
+    plane[:64, :64] = 1
+    plane[128:] = 0
+    index, tiles = packed.pack_plane(plane, tile_size=64)
+    assert index[0, 0] == packed.FULL_TILE and index[3, 0] == packed.EMPTY_TILE
+    rows, columns = np.indices(plane.shape).reshape(2, -1)
+    read = packed.read_pixels(index, tiles, rows, columns)
+    assert np.array_equal(read.reshape(plane.shape), plane > 0)
+
+    make_plane().writeto(tmp_path / "T0.fits")
+    stores = mask_stores_from_fits(tmp_path, mask_key=1, workers=1)
+    assert stores == [tmp_path / f"T0{packed.STORE_SUFFIX}"]
+    handler = FitsMaskHandler(tmp_path, {"mask_key": 1})
+    loaded = handler.get_data_object(handler.get_data(["T0"]))
+    eager = Mask([make_plane()], mask_key=1)
+    assert loaded.estimate_size() * 8 <= eager.estimate_size()
+    assert np.array_equal(loaded.evaluate(catalog), eager.evaluate(catalog))
+    rebuilt = Mask.from_arrays(*loaded.to_arrays())
+    assert np.array_equal(rebuilt.evaluate(catalog), eager.evaluate(catalog))
+
+
+def test_rewrite_store(tmp_path):
+    path = tmp_path / f"T0{packed.STORE_SUFFIX}"
+    planes = [np.zeros((100, 100), dtype=np.int32), np.ones((100, 100), np.int32)]
+    packed.write_store(path, planes[0], "")
+    errors = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            try:
+                meta, index, tiles = packed.open_store(path)
+            except OSError as e:
+                errors.append(e)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    for i in range(50):
+        packed.write_store(path, planes[i % 2], "")
+    done.set()
+    reader.join()
+    assert not errors
+    # The stores that were replaced are removed
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_unmasked_fractions(tmp_path, mask):
+    regions = [
+        Region.circle((11, 0), 0.5 * u.deg),
+        Region.circle((11.6, 0.5), 0.1 * u.deg),
+        Region.circle((11, 0.3), 0.1 * u.deg),
+        Region.box((10.5, -0.2, 11.1, 0.2)),
+    ]
+    # The FITS plane masks ra 10.8 to 11.2
+    strip = 2 * (0.2 * np.sqrt(0.25 - 0.04) + 0.25 * np.arcsin(0.4))
+    expected = [1 - strip / (np.pi * 0.25), 1, 0, 0.5]
+
+    plane = Mask([make_plane()], mask_key=1)
+    fractions = plane.unmasked_fractions(regions)
+    assert fractions == pytest.approx(expected, abs=0.02)
+    assert plane.unmasked_fraction(regions[0]) == fractions[0]
+    path = tmp_path / "mask.fits"
+    make_plane().writeto(path)
+    with fits.open(path) as hdul:
+        lazy = Mask([hdul], mask_key=1)
+    assert np.array_equal(lazy.unmasked_fractions(regions), fractions)
+
+    moc_fractions = plane.to_moc(16).unmasked_fractions(regions)
+    assert moc_fractions == pytest.approx(expected, abs=0.02)
+
+    star = Mask([Point(11.6, 0.5).buffer(0.05, quad_segs=64)])
+    assert star.unmasked_fraction(regions[1]) == pytest.approx(0.75, abs=0.01)
+
+    # Masks with several layers are checked on a grid of cells
+    layered = plane.append([star])
+    assert layered.unmasked_fractions(regions, order=14) == pytest.approx(
+        [expected[0], 0.75, 0, 0.5], abs=0.02
+    )
@@ -0,0 +1,44 @@
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from spherical_geometry.vector import lonlat_to_vector
+
+from heinlein.region import Region
+from heinlein.region.region import CircularRegion, PolygonRegion
+
+
+@pytest.fixture(scope="module")
+def points():
+    rng = np.random.default_rng(0)
+    ra = rng.uniform(0, 360, 20000)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 20000)))
+    return SkyCoord(ra, dec, unit="deg")
+
+
+@pytest.mark.parametrize(
+    "region",
+    [
+        Region.circle(center=(10, 20), radius=5 * u.deg),
+        Region.circle(center=(359, -89), radius=3 * u.deg),
+        Region.box((10, -10, 40, 30)),
+        Region.box((350, -10, 20, 30)),
+        Region.box((100, 10, 300, 20)),
+    ],
+)
+def test_contains_vectors(region, points):
+    vectors = np.column_stack(lonlat_to_vector(points.ra.deg, points.dec.deg))
+    if isinstance(region, CircularRegion):
+        expected = region.center.separation(points) <= region.radius
+    else:
+        expected = region.contains(points)
+    assert np.any(expected)
+    assert np.array_equal(region.contains_vectors(vectors), expected)
+
+
+def test_polygon_contains_vectors(points):
+    region = PolygonRegion([(10, 10), (30, 12), (25, 30), (12, 25)])
+    vectors = np.column_stack(lonlat_to_vector(points.ra.deg, points.dec.deg))
+    expected = [region.spherical_geometry.contains_point(v) for v in vectors]
+    assert np.any(expected)
+    assert np.array_equal(region.contains_vectors(vectors), expected)
@@ -3,6 +3,9 @@ from pathlib import Path
 import pytest
 from sqlalchemy import create_engine, inspect, text
 
+import heinlein
+from heinlein.dtypes.handlers.catalog import META_TABLE
+from heinlein.utilities import prep
 from heinlein.utilities.prep import database_from_csvs
 
 DATA_PATH = Path("/home/data")
@@ -28,14 +31,22 @@ def test_catalog_prep(catalog_path):
     assert path.exists()
     assert compare_databases(DES_ORIGINAL_DB_PATH, catalog_path)
 
+    engine = create_engine(f"sqlite:///{catalog_path}").connect()
+    query = text(f"SELECT value FROM '{META_TABLE}' WHERE key = 'hpix_nside'")
+    nside = engine.execute(query).scalar()
+    assert int(nside) == heinlein.get_option("CATALOG_HPIX_NSIDE")
+
 
 def compare_databases(db1: Path, db2: Path):
     # Connect to the databases
     reference_engine = create_engine(f"sqlite:///{db1}").connect()
     test_engine = create_engine(f"sqlite:///{db2}").connect()
     # Get the table names
-    reference_tables = inspect(reference_engine).get_table_names()
-    test_tables = inspect(test_engine).get_table_names()
+    # The metadata table is added by heinlein, it is not part of the catalog
+    reference_tables = [
+        t for t in inspect(reference_engine).get_table_names() if t != META_TABLE
+    ]
+    test_tables = [t for t in inspect(test_engine).get_table_names() if t != META_TABLE]
     # Compare the table names
     assert set(reference_tables) == set(test_tables)
     # Compare the data in the tables
@@ -45,3 +56,19 @@ def compare_databases(db1: Path, db2: Path):
         test_data = test_engine.execute(query).fetchall()
         assert reference_data == test_data
     return True
+
+
+def test_csv_chunks(tmp_path, monkeypatch):
+    csv = tmp_path / "catalog.csv"
+    lines = [f"{i},T{i % 3},{i / 7}" for i in range(1000)]
+    csv.write_text("\n".join(["id,tile,ra", *lines]) + "\n")
+    monkeypatch.setattr(prep, "INGEST_CHUNK_BYTES", 100)
+
+    chunks = prep._csv_chunks(csv)
+    assert len(chunks) > 100
+    data = b"".join(prep._read_lines(csv, *chunk) for chunk in chunks)
+    assert data.decode().splitlines() == lines
+
+    parts = prep._parse_chunk(csv, *chunks[5], "tile", "id", {})
+    assert sorted(parts) == ["T0", "T1", "T2"]
+    assert all((part["tile"] == tname).all() for tname, part in parts.items())